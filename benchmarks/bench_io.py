@@ -0,0 +1,100 @@
+"""
+Benchmark the reading of columns from a large prepared Novonix file,
+built by repeating the data in the prepared example file.
+
+To run it from the root of the repository, with preparenovonix
+installed or within the PYTHONPATH:
+    python benchmarks/bench_io.py [number of rows]
+"""
+import sys, os.path
+import tempfile
+import time
+import numpy as np
+import preparenovonix.novonix_variables as nv
+from preparenovonix.novonix_io import NovonixFile
+from preparenovonix.novonix_io import get_num_measurements
+from preparenovonix.novonix_io import read_column
+from preparenovonix.novonix_io import read_columns
+
+exfile_prep = "example_data/example_data_prep.csv"
+
+columns = [
+    nv.col_step,
+    nv.col_t,
+    nv.col_tstep,
+    "Current (A)",
+    nv.col_v,
+    nv.col_c,
+    "Temperature (°C)",
+    nv.state_col,
+    nv.line_col,
+    nv.loop_col,
+]
+
+
+def make_file(outfile, nrows):
+    """
+    Write a prepared Novonix file with nrows data rows.
+    """
+
+    nf = NovonixFile(exfile_prep)
+    with open(exfile_prep, "rb") as ff:
+        header = ff.read(nf.data_start)
+        data = ff.read()
+
+    nrep = nrows // data.count(b"\n") + 1
+    with open(outfile, "wb") as ff:
+        ff.write(header)
+        for irep in range(nrep):
+            ff.write(data)
+
+
+def row_by_row(infile, column_name, outtype="float"):
+    """
+    Reading of a column splitting the rows one by one,
+    as done by read_column before the vectorized parser.
+    """
+
+    nf = NovonixFile(infile)
+    icol = nf.icolumn(column_name)
+    column_data = []
+    with open(infile, "r") as ff:
+        ff.seek(nf.data_start)
+        for line in ff:
+            val = line.split(",")[icol].rstrip()
+            column_data.append(val)
+    return np.array(column_data).astype(np.dtype(outtype))
+
+
+def report(label, nrows, elapsed):
+    print("{:<40} {:8.3f} s {:12.0f} rows/s".format(label, elapsed, nrows / elapsed))
+
+
+if __name__ == "__main__":
+    nrows = 1000000
+    if len(sys.argv) > 1:
+        nrows = int(sys.argv[1])
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        infile = os.path.join(tmpdir, "bench_prep.csv")
+        make_file(infile, nrows)
+        nrows = get_num_measurements(infile)
+        print("File with {} rows".format(nrows))
+
+        start = time.perf_counter()
+        old = row_by_row(infile, nv.col_v)
+        report("Row by row, 1 column", nrows, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        new = read_column(infile, nv.col_v)
+        report("read_column, 1 column", nrows, time.perf_counter() - start)
+        assert (old == new).all()
+
+        start = time.perf_counter()
+        for col in columns:
+            row_by_row(infile, col)
+        report("Row by row, {} columns".format(len(columns)), nrows, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        read_columns(infile, columns)
+        report("read_columns, {} columns".format(len(columns)), nrows, time.perf_counter() - start)
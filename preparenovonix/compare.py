@@ -3,9 +3,11 @@ import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 import preparenovonix.novonix_variables as nv
-from preparenovonix.novonix_io import read_column
+from preparenovonix.novonix_io import data_range
+from preparenovonix.novonix_io import iter_data_chunks
 from preparenovonix.novonix_io import after_file_name
-from preparenovonix.novonix_io import icolumn
+from preparenovonix.novonix_io import NovonixFile
+from preparenovonix.novonix_io import novonix_file
 
 
 def plot_vct(before_file, first_loop=0, plot_type="pdf", plot_show=False):
@@ -48,45 +50,36 @@ def plot_vct(before_file, first_loop=0, plot_type="pdf", plot_show=False):
     ### Read the voltage, step number and loop number from
     # the processed file
 
-    a_t = read_column(after_file, nv.col_t, outtype="float")
-    a_v = read_column(after_file, nv.col_v, outtype="float")
-    a_c = read_column(after_file, nv.col_c, outtype="float")
-    a_s = read_column(after_file, nv.col_step, outtype="int")
-    a_l = read_column(after_file, nv.loop_col, outtype="int")
-    a_p = read_column(after_file, nv.line_col, outtype="int")
+    nf = novonix_file(after_file)
+    names = [nv.col_t, nv.col_v, nv.col_c, nv.col_step, nv.loop_col, nv.line_col]
+    dtypes = ["float", "float", "float", "int", "int", "int"]
+    # Read only from the rows that can have a loop number above val
+    start, end = data_range(nf, loops=range(val + 1, sys.maxsize))
+    a_t, a_v, a_c, a_s, a_l, a_p = [np.zeros(0)] * len(names)
+    for row, offset, columns, chunk in iter_data_chunks(
+        nf, names, chunk_rows=None, dtypes=dtypes, start=start
+    ):
+        a_t, a_v, a_c, a_s, a_l, a_p = [columns[name] for name in names]
 
     # Find the column positions in the file
-    icol_t = icolumn(after_file, nv.col_t)
-    icol_v = icolumn(after_file, nv.col_v)
-    icol_c = icolumn(after_file, nv.col_c)
-    icol_step = icolumn(after_file, nv.col_step)
+    icol_t = nf.icolumn(nv.col_t)
+    icol_v = nf.icolumn(nv.col_v)
+    icol_c = nf.icolumn(nv.col_c)
+    icol_step = nf.icolumn(nv.col_step)
 
     ### Read the voltage and step number from the original file
-    # Since there are failed tests, these need to be jumped
-    data = "[Data]"
-    ntests = 0  # Count the number of failed tests
-    with open(before_file, "r") as ff:
-        for line in ff:
-            if line.strip():  # Jump empty lines
-                if data in line:
-                    # Count failed tests for each start of file
-                    ntests += 1
-                    idata = 0
+    # Since there are failed tests, jump to the last [Data] section
+    nf_before = NovonixFile(before_file)
 
     vv = []
     ss = []
     tt = []
     cc = []
     with open(before_file, "r") as ff:
-        for line in ff:
-            if line.strip():  # Jump empty lines
-                if data in line:
-                    # Count failed tests for each start of file
-                    idata += 1
-                    if idata == ntests:
-                        # Read the header
-                        ff.readline()
-                        break
+        ff.seek(nf_before.sections["Data"][-1])
+        # Read the [Data] line and the header
+        ff.readline()
+        ff.readline()
         for line in ff:
             tt.append(line.split(",")[icol_t])
             vv.append(line.split(",")[icol_v])
@@ -1,12 +1,41 @@
-import sys
+import io
 import numpy as np
 import preparenovonix.novonix_variables as nv
+from preparenovonix.novonix_errors import StateMismatchError
+from preparenovonix.novonix_errors import ProtocolSyntaxError
 from preparenovonix.novonix_io import replace_file
+from preparenovonix.novonix_io import temporary_file
 from preparenovonix.novonix_io import icolumn
-from preparenovonix.novonix_io import read_column
+from preparenovonix.novonix_io import novonix_file
+from preparenovonix.novonix_io import iter_data_chunks
+from preparenovonix.novonix_io import column_positions
+from preparenovonix.novonix_io import parse_data_block
+from preparenovonix.novonix_io import newline
+from preparenovonix.novonix_io import split_rows
+from preparenovonix.novonix_io import write_columns
+from preparenovonix.novonix_io import save_segments
+from preparenovonix.novonix_io import read_segments
 from preparenovonix.novonix_io import get_command
 from preparenovonix.novonix_io import get_format
 
+# Table of the sets of measurements with a single State (0,1,...,1,2 or -1):
+# first and last data row, Step Number, State of the first row,
+# Protocol line, Loop number and first and last Run Time and Capacity
+segment_dtype = np.dtype(
+    [
+        ("start", "i8"),
+        ("end", "i8"),
+        ("step", "i8"),
+        ("state", "i8"),
+        ("line", "i8"),
+        ("loop", "i8"),
+        ("t_start", "f8"),
+        ("t_end", "f8"),
+        ("c_start", "f8"),
+        ("c_end", "f8"),
+    ]
+)
+
 
 def column_check(infile, col_name, verbose=False):
     """
@@ -15,7 +44,7 @@ def column_check(infile, col_name, verbose=False):
 
     Parameters
     -----------
-    infile : string
+    infile : string or NovonixFile
         Name of the input Novonix file
 
     col_name : string
@@ -70,9 +99,49 @@ def state_check(state):
     True
     """
 
+    state = np.asarray(state)
+    answer = state_counts_check(
+        state[0],
+        state[-1],
+        np.count_nonzero(state == 0),
+        np.count_nonzero(state == 2),
+    )
+    return answer
+
+
+def state_counts_check(first, last, nzeros, ntwos):
+    """
+    Perform tests on the State column, given a summary of it
+
+    Parameters
+    -----------
+    first : integer
+        First State value
+
+    last : integer
+        Last State value
+
+    nzeros : integer
+        Number of State=0 values
+
+    ntwos : integer
+        Number of State=2 values
+
+    Returns
+    -------
+    answer : boolean
+        True when the tests went fine
+
+    Examples
+    ---------
+    >>> import preparenovonix.novonix_add as prep
+    >>> prep.state_counts_check(0,2,1,1)
+    True
+    """
+
     answer = True
     # Check if the first and last state values have adequate values
-    if state[0] != 0 or state[-1] != 2:
+    if first != 0 or last != 2:
         answer = False
         print(
             "WARNING novonix_add.state_check \n"
@@ -80,9 +149,7 @@ def state_check(state):
         )
 
     # Check that there are the same numbers of 0s and 2s
-    izeros = np.where(np.array(state) == 0)
-    itwos = np.where(np.array(state) == 2)
-    if np.shape(izeros)[1] != np.shape(itwos)[1]:
+    if nzeros != ntwos:
         answer = False
         print(
             "WARNING novonix_add.state_check \n"
@@ -91,7 +158,544 @@ def state_check(state):
     return answer
 
 
-def novonix_add_state(infile, verbose=False):
+def state_values(steps, stimes, carry, final=False, verbose=False):
+    """
+    Given the Step Number and Step time of a chunk of data rows,
+    work out their State values with array operations:
+
+    A set of measurements starts (State=0) when the Step Number changes
+    or the Step time does not increase, and it ends (State=2) in the row
+    before the next start. A start followed by another start is a
+    single measurement (State=-1) if its Step time is 0, otherwise it
+    is a row affected by a software bug (State=-99). A single
+    measurement followed by such a row is also set to State=-99.
+    The last row of the data has State=2.
+
+    The State of the last two rows can still change with the following
+    row, thus these rows are kept in carry until the next chunk.
+
+    Parameters
+    -----------
+    steps : array of strings
+        Step Number of each row
+
+    stimes : array of floats
+        Step time of each row
+
+    carry : dictionary
+        Values carried over from previous chunks, as returned by
+        state_carry, which are updated by this function.
+
+    final : boolean
+        True for the last chunk of data
+
+    verbose : boolean
+        Yes : print out some informative statements
+
+    Returns
+    --------
+    states : array of integers
+        Final State values of the rows kept from previous chunks
+        followed by those of this chunk, in order.
+        Rows with State=-99 should be removed.
+
+    Examples
+    ---------
+    >>> import preparenovonix.novonix_add as prep
+    >>> carry = prep.state_carry('example.csv')
+    >>> print(prep.state_values(['1','1','2'],[0.,0.1,0.],carry))
+    [0]
+    >>> print(prep.state_values([],[],carry,final=True))
+    [2 2]
+    """
+
+    steps = np.asarray(steps)
+    stimes = np.asarray(stimes, dtype=float)
+    nnew = len(stimes)
+    npend = len(carry["start"])
+
+    # Starts: the Step Number changes or the Step time does not increase
+    start = np.ones(nnew, dtype=bool)
+    if nnew > 0:
+        start[0] = not (steps[0] == carry["last_step"] and stimes[0] > carry["last_t"])
+        start[1:] = ~((steps[1:] == steps[:-1]) & (stimes[1:] > stimes[:-1]))
+        carry["last_step"] = steps[-1]
+        carry["last_t"] = stimes[-1]
+
+    # The rows kept from the previous chunk go first
+    start = np.concatenate([carry["start"], start])
+    stime = np.concatenate([carry["stime"], stimes])
+    nrows = len(start)
+
+    # Rows followed by a start
+    next_start = np.zeros(nrows, dtype=bool)
+    next_start[:-1] = start[1:]
+
+    state = np.where(start, 0, 1)
+    state[next_start & ~start] = 2
+
+    # Two starts in a row
+    double = next_start & start
+    single = double & (stime < nv.eps)
+    bug = double & ~single
+    state[single] = -1
+    # Jump lines affected by software bug and
+    # 2 single measurements in a row
+    # (this can happen when current overshoots)
+    state[bug] = -99
+    prev_single = np.zeros(nrows, dtype=bool)
+    prev_single[1:] = single[:-1]
+    state[:-1][bug[1:] & single[:-1]] = -99
+
+    if verbose:
+        # Warn about the rows found in this chunk
+        il0 = carry["il"] - npend + carry["ihead"]
+        for ii in np.flatnonzero(bug[max(npend - 1, 0) :]) + max(npend - 1, 0):
+            print(
+                "WARNING line=",
+                str(il0 + ii + 1),
+                ", last step time=" + str(float(stime[ii])),
+                ": Measurement to be nv.ignored",
+            )
+            if prev_single[ii]:
+                print(
+                    "WARNING Measurement to be nv.ignored: line=",
+                    str(il0 + ii),
+                    ", last step time=" + str(float(stime[ii])),
+                )
+
+    if final:
+        if nrows > 0:
+            state[-1] = 2
+        nready = nrows
+    else:
+        nready = max(nrows - 2, 0)
+
+    # Summary of the final State values, for state_counts_check
+    states = state[:nready]
+    if nready > 0:
+        if carry["first"] is None:
+            carry["first"] = states[0]
+        carry["last"] = states[-1]
+        carry["nzeros"] += np.count_nonzero(states == 0)
+        carry["ntwos"] += np.count_nonzero(states == 2)
+
+    carry["start"] = start[nready:]
+    carry["stime"] = stime[nready:]
+    carry["il"] += nnew
+
+    return states
+
+
+def state_chunk(block, steps, stimes, carry, final=False, verbose=False):
+    r"""
+    Given a chunk of data rows, work out their State values.
+    The last two rows are kept in carry until the next chunk,
+    as their State can still change.
+
+    Parameters
+    -----------
+    block : bytes
+        Data rows, as in the file
+
+    steps : array of strings
+        Step Number of each row
+
+    stimes : array of floats
+        Step time of each row
+
+    carry : dictionary
+        Values carried over from previous chunks, as returned by
+        state_carry, which are updated by this function.
+
+    final : boolean
+        True for the last chunk of data
+
+    verbose : boolean
+        Yes : print out some informative statements
+
+    Returns
+    --------
+    block : bytes
+        Data rows for which the State is final
+
+    states : array of integers
+        State of the data rows, -99 for those to be removed
+
+    Examples
+    ---------
+    >>> import preparenovonix.novonix_add as prep
+    >>> carry = prep.state_carry('example.csv')
+    >>> prep.state_chunk(b'a,1,0.0\na,1,0.1\n',['1','1'],[0.,0.1],carry,final=True)
+    (b'a,1,0.0\na,1,0.1\n', array([0, 2]))
+    """
+
+    states = state_values(steps, stimes, carry, final=final, verbose=verbose)
+
+    npend = len(carry["stime"])
+    block, carry["data"] = split_rows(carry["data"] + block, npend)
+
+    return block, states
+
+
+def state_blocks(infile, carry, chunk_rows=None, verbose=False, gcarry=None):
+    """
+    Given a cleaned Novonix data file, work out the State column
+    by chunks of data rows.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the input Novonix file
+
+    carry : dictionary
+        Values carried over between chunks, as returned by state_carry
+
+    chunk_rows : integer
+        Number of data rows processed at a time,
+        None to process all the data at once
+
+    verbose : boolean
+        Yes : print out some informative statements
+
+    gcarry : dictionary
+        Values carried over between chunks for the table of the sets
+        of measurements, as returned by segment_carry.
+        None if the table is not needed.
+
+    Returns
+    --------
+    block : bytes
+        Data rows for which the State is final (generated)
+
+    columns : list of arrays
+        State of the data rows (generated)
+
+    keep : array of booleans
+        False for the rows with State=-99, to be removed (generated)
+
+    Examples
+    ---------
+    >>> import preparenovonix.novonix_add as prep
+    >>> infile = 'example_data/example_data_prep.csv'
+    >>> carry = prep.state_carry(infile)
+    >>> for block, columns, keep in prep.state_blocks(infile,carry):
+    ...     print(len(columns[0]))
+    5752
+    """
+
+    nf = novonix_file(infile)
+
+    if gcarry is not None:
+        icols = column_positions(nf, [nv.col_step, nv.col_t, nv.col_c])
+
+    chunks = iter_data_chunks(
+        nf, [nv.col_step, nv.col_tstep], chunk_rows, dtypes=["S", "float"]
+    )
+    for row, offset, columns, chunk in chunks:
+        block, states = state_chunk(
+            chunk,
+            columns[nv.col_step],
+            columns[nv.col_tstep],
+            carry,
+            final=(offset + len(chunk) >= nf.size),
+            verbose=verbose,
+        )
+        keep = states > -99
+        if gcarry is not None:
+            segment_block(block, states, icols, gcarry, encoding=nf.encoding)
+
+        yield block, [states], keep
+
+
+def state_carry(infile, ihead=0):
+    """
+    Initialize the values carried over from one chunk of data
+    to the next one when working out the State column.
+
+    Parameters
+    -----------
+    infile : string
+        Name of the input Novonix file
+
+    ihead : int
+        Number of header lines, including the column names
+
+    Returns
+    --------
+    carry : dictionary
+        Initial values for state_chunk. The data rows waiting for
+        their State are kept in 'data' and, by
+        novonix_prep.prepared_chunks, their Step Number, Run Time and
+        Capacity in 'steps', 'times' and 'capacity'.
+
+    Examples
+    ---------
+    >>> import preparenovonix.novonix_add as prep
+    >>> carry = prep.state_carry('example.csv')
+    >>> print(carry['last_step'])
+    -99
+    """
+
+    carry = {
+        "infile": infile,
+        "ihead": ihead,
+        "il": 0,
+        "last_step": -99,  # Create a starting last state value
+        "last_t": 99.0,  # Create a starting step time value
+        "start": np.array([], dtype=bool),
+        "stime": np.array([], dtype=float),
+        "data": b"",
+        "steps": np.array([], dtype=int),
+        "times": np.array([], dtype=float),
+        "capacity": np.array([], dtype=float),
+        "first": None,
+        "last": None,
+        "nzeros": 0,
+        "ntwos": 0,
+    }
+
+    return carry
+
+
+def segment_carry():
+    """
+    Initialize the values carried over from one chunk of data
+    to the next one when building the table of the sets of measurements.
+
+    Returns
+    --------
+    carry : dictionary
+        Initial values for segment_chunk
+
+    Examples
+    ---------
+    >>> import preparenovonix.novonix_add as prep
+    >>> carry = prep.segment_carry()
+    >>> print(carry['row'])
+    0
+    """
+
+    carry = {
+        "row": 0,
+        "open": np.zeros(0, dtype=segment_dtype),
+        "segments": [],
+    }
+
+    return carry
+
+
+def segment_chunk(states, steps, times, capacity, carry):
+    """
+    Given a chunk of data rows with final State values, add their
+    sets of measurements to the table, see segment_dtype.
+    A set starts with State 0 or -1 and ends with State 2 or -1.
+
+    Parameters
+    -----------
+    states : array of integers
+        State of each row
+
+    steps : array
+        Step Number of each row
+
+    times : array of floats
+        Run Time of each row
+
+    capacity : array of floats
+        Capacity of each row
+
+    carry : dictionary
+        Values carried over from previous chunks, as returned by
+        segment_carry, which are updated by this function.
+        The sets not finished within the chunk are kept in carry['open'].
+
+    Returns
+    --------
+    segments : numpy structured array
+        Sets of measurements finished within the chunk
+
+    Examples
+    ---------
+    >>> import numpy as np
+    >>> import preparenovonix.novonix_add as prep
+    >>> carry = prep.segment_carry()
+    >>> segments = prep.segment_chunk(np.array([0,2,-1]),np.array([1,1,0]),
+    ... np.array([0.,1.,2.]),np.array([0.,0.5,0.5]),carry)
+    >>> print(segments['start'], segments['end'])
+    [0 2] [1 2]
+    """
+
+    states = np.asarray(states)
+    times = np.asarray(times, dtype=float)
+    capacity = np.asarray(capacity, dtype=float)
+
+    istarts = np.flatnonzero((states == 0) | (states == -1))
+    iends = np.flatnonzero((states == 2) | (states == -1))
+
+    new = np.zeros(len(istarts), dtype=segment_dtype)
+    new["start"] = carry["row"] + istarts
+    new["step"] = np.asarray(steps)[istarts].astype(int)
+    new["state"] = states[istarts]
+    new["line"] = -999
+    new["loop"] = -999
+    new["t_start"] = times[istarts]
+    new["c_start"] = capacity[istarts]
+
+    # Pair the starts and ends of the sets
+    sets = np.concatenate([carry["open"], new])
+    npaired = min(len(sets), len(iends))
+    segments = sets[:npaired]
+    segments["end"] = carry["row"] + iends[:npaired]
+    segments["t_end"] = times[iends[:npaired]]
+    segments["c_end"] = capacity[iends[:npaired]]
+
+    carry["open"] = sets[npaired:]
+    carry["row"] += len(states)
+    carry["segments"].append(segments)
+
+    return segments
+
+
+def segment_block(block, states, icols, carry, encoding="utf-8"):
+    r"""
+    Given a chunk of data rows with final State values, add their
+    sets of measurements to the table, reading the Step Number,
+    Run Time and Capacity only from the first and last row of each set.
+
+    Parameters
+    -----------
+    block : bytes
+        Data rows, as in the file
+
+    states : array of integers
+        State of each row, -99 for those to be removed
+
+    icols : list of integers
+        Positions of the Step Number, Run Time and Capacity columns
+
+    carry : dictionary
+        Values carried over from previous chunks, as returned by
+        segment_carry, which are updated by this function.
+
+    encoding : string
+        Encoding of the text in the rows
+
+    Returns
+    --------
+    segments : numpy structured array
+        Sets of measurements finished within the chunk
+
+    Examples
+    ---------
+    >>> import numpy as np
+    >>> import preparenovonix.novonix_add as prep
+    >>> carry = prep.segment_carry()
+    >>> segments = prep.segment_block(b'1,0.,0.\n1,1.,0.5\n',np.array([0,2]),[0,1,2],carry)
+    >>> print(segments['t_end'])
+    [1.]
+    """
+
+    states = np.asarray(states)
+    keep = states > -99
+    bounds = keep & (states != 1)
+
+    # Rows starting or ending a set
+    if block and not block.endswith(b"\n"):
+        block = block + b"\n"
+    ends = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == newline) + 1
+    starts = np.concatenate(([0], ends[:-1]))
+    ibounds = np.flatnonzero(bounds)
+    rows = b"".join(
+        [block[ii:jj] for ii, jj in zip(starts[ibounds], ends[ibounds])]
+    )
+
+    values = parse_data_block(rows, icols, ["int", "float", "float"], encoding)
+    columns = []
+    for val in values:
+        column = np.zeros(len(states), dtype=val.dtype)
+        column[bounds] = val
+        columns.append(column[keep])
+
+    return segment_chunk(states[keep], *columns, carry)
+
+
+def segment_table(carry, lcarry=None):
+    """
+    Given the values carried over while building the table of the
+    sets of measurements, get the whole table.
+
+    Parameters
+    -----------
+    carry : dictionary
+        Values carried over between chunks, as returned by segment_carry
+
+    lcarry : dictionary
+        Values carried over between chunks for the Loop number,
+        as returned by protocol_carry, None if there are not
+        Protocol line and Loop number values
+
+    Returns
+    --------
+    segments : numpy structured array
+        Table of the sets of measurements, see segment_dtype
+
+    Examples
+    ---------
+    >>> import numpy as np
+    >>> import preparenovonix.novonix_add as prep
+    >>> carry = prep.segment_carry()
+    >>> segments = prep.segment_chunk([-1],[0],[0.],[0.],carry)
+    >>> print(len(prep.segment_table(carry)))
+    1
+    """
+
+    segments = np.concatenate(
+        [np.zeros(0, dtype=segment_dtype)] + carry["segments"]
+    )
+    if lcarry is not None:
+        segment_lines(segments, lcarry)
+
+    return segments
+
+
+def segment_lines(segments, lcarry):
+    """
+    Set the Protocol line and Loop number of the sets of measurements,
+    as found while working out those columns.
+
+    Parameters
+    -----------
+    segments : numpy structured array
+        Table of the sets of measurements, see segment_dtype,
+        which is updated by this function
+
+    lcarry : dictionary
+        Values carried over between chunks for the Loop number,
+        as returned by protocol_carry
+
+    Examples
+    ---------
+    >>> import numpy as np
+    >>> import preparenovonix.novonix_add as prep
+    >>> segments = np.zeros(1, dtype=prep.segment_dtype)
+    >>> carry = prep.protocol_carry('example.csv',True)
+    >>> carry['lines'], carry['loops'] = [np.array([3])], [np.array([1])]
+    >>> prep.segment_lines(segments,carry)
+    >>> print(segments['line'], segments['loop'])
+    [3] [1]
+    """
+
+    lines = np.concatenate([np.zeros(0, dtype=int)] + lcarry["lines"])
+    loops = np.concatenate([np.zeros(0, dtype=int)] + lcarry["loops"])
+    nsets = min(len(segments), len(lines))
+    segments["line"][:nsets] = lines[:nsets]
+    segments["loop"][:nsets] = loops[:nsets]
+
+    return
+
+
+def novonix_add_state(infile, verbose=False, chunk_rows=None, segments=False):
     """
     Given a cleaned Novonix data file, it adds a 'State' column,
     which mimimcs Basytec format with:
@@ -111,6 +715,14 @@ def novonix_add_state(infile, verbose=False):
     verbose : boolean
         Yes : print out some informative statements
 
+    chunk_rows : integer
+        Number of data rows processed at a time,
+        None to process all the data at once
+
+    segments : boolean
+        True to save the table of the sets of measurements in the
+        cache directory of the file, see novonix_io.save_segments
+
     Notes
     -----
     This code returns a Novonix file with an extra 'State' column.
@@ -119,18 +731,17 @@ def novonix_add_state(infile, verbose=False):
     ---------
     >>> import preparenovonix.novonix_add as prep
     >>> prep.novonix_add_state('example_data/example_data_prep.csv',verbose=True)
-    The file example_data/example_data_prep.csv already has a State column
+    The file already has the column State (0=Start 1=Regular 2=End -1=Single Measurement)
     """
 
+    # Index the header of the file
+    nf = novonix_file(infile)
+
     # Check if the State column already exists
-    col_exists = column_check(infile, nv.state_col, verbose=verbose)
+    col_exists = column_check(nf, nv.state_col, verbose=verbose)
     if col_exists:
         return
 
-    # Find the Step Number column
-    icol = icolumn(infile, nv.col_step)
-    icolt = icolumn(infile, nv.col_tstep)
-
     # Read the input file
     header = []
     fw = "fw"
@@ -147,94 +758,39 @@ def novonix_add_state(infile, verbose=False):
         new_head = str(line.rstrip()) + ", " + nv.state_col + " \n"
         header.append(new_head)
 
-        # Create a temporary file with the new header
-        tmp_file = "tmp.csv"
-        ihead = 0
-        with open(tmp_file, "w") as tf:
-            for item in header:
-                tf.write(str(item))
-                ihead += 1
-
-        # The State column
-        state = []
-        data = []
-        last_step = -99  # Create a starting last state value
-        last_t = 99.0  # Create a starting step time value
-        steps = []
-        # Read the data adding values to the state
-        for il, line in enumerate(ff):
-            data.append(line)
-            step = line.split(",")[icol]
-            steps.append(step)
-            stime = float(line.split(",")[icolt])
-            if step == last_step and stime > last_t:
-                state.append(1)
-            else:
-                state.append(0)
-
-                # Change the previous value
-                if len(state) > 1:
-                    if state[-2] == 0:
-                        if last_t < nv.eps:
-                            # Single measurement
-                            state[-2] = -1
-                        else:
-                            # Jump lines affected by software bug and
-                            # 2 single measurements in a row
-                            # (this can happen when current overshoots)
-                            state[-2] = -99
-                            if verbose:
-                                # Line count starts with 1, thus (il+1)
-                                print(
-                                    "WARNING line=",
-                                    str(il + ihead),
-                                    ", last step time=" + str(last_t),
-                                    ": Measurement to be nv.ignored",
-                                )
-                            if state[-3] == -1:
-                                # Avoid 2 single measurements in a row
-                                state[-3] = -99
-                                if verbose:
-                                    print(
-                                        "WARNING Measurement to be nv.ignored: line=",
-                                        str(il - 1 + ihead),
-                                        ", last step time=" + str(last_t),
-                                    )
-
-                    elif state[-2] == 1:
-                        state[-2] = 2
-                    else:
-                        sys.exit(
-                            "STOP function novonix_add_state \n"
-                            + "REASON unexpected state \n"
-                            + "      "
-                            + str(infile)
-                            + " \n"
-                        )
-            last_step = step
-            last_t = stime
-        state[-1] = 2
+    # Write the header and the data with the new column
+    # in a temporary file
+    with temporary_file(infile) as tmp_file:
+        carry = state_carry(infile, ihead=len(header))
+        gcarry = None
+        if segments:
+            gcarry = segment_carry()
+        blocks = state_blocks(
+            nf, carry, chunk_rows=chunk_rows, verbose=verbose, gcarry=gcarry
+        )
+        write_columns(tmp_file, header, blocks, encoding=nf.encoding)
 
         # Check the new column
-        check_pass = state_check(state)
+        check_pass = state_counts_check(
+            carry["first"], carry["last"], carry["nzeros"], carry["ntwos"]
+        )
         if not check_pass:
-            sys.exit("STOP novonix_add.novonix_add_state \n" + str(infile) + " \n")
-
-        # Write the new data to the temporary file
-        with open(tmp_file, "a") as tf:
-            ii = 0
-            for idata in data:
-                if state[ii] > -99:
-                    new_line = str(idata.rstrip()) + "," + str(state[ii]) + "\n"
-                    tf.write(new_line)
-                ii += 1
+            raise StateMismatchError(
+                "unexpected number of starts and ends of the sets of measurements",
+                infile=infile,
+                where="novonix_add.novonix_add_state",
+            )
 
         # Replace the input file by the tmp_file,
         # which should be bigger.
         replace_file(tmp_file, infile, newbigger=True)
 
-        if verbose:
-            print("{} contains now a State column".format(infile))
+    # Keep the table of the sets of measurements
+    if segments:
+        save_segments(infile, segment_table(gcarry))
+
+    if verbose:
+        print("{} contains now a State column".format(infile))
     return
 
 
@@ -273,7 +829,7 @@ def read_reduced_protocol(infile, verbose=False):
 
     Parameters
     -----------
-    infile : string
+    infile : string or NovonixFile
         Name of the input Novonix file
 
     verbose : boolean
@@ -296,35 +852,79 @@ def read_reduced_protocol(infile, verbose=False):
     False
     """
 
+    nf = novonix_file(infile)
+
+    # Jump to the reduced protocol within the first header
+    first_data = nf.sections["Data"][:1] or [nf.size]
+    offsets = [x for x in nf.sections["Reduced Protocol"] if x < first_data[0]]
+    if not offsets:
+        return [nv.protocol_first], False
+
+    with open(nf.infile, "rb") as fb:
+        fb.seek(offsets[0])
+        ff = io.TextIOWrapper(fb, encoding=nf.encoding)
+        protocol, protocol_exists = find_reduced_protocol(ff, nf.infile)
+
+    return protocol, protocol_exists
+
+
+def find_reduced_protocol(ff, infile=""):
+    r"""
+    Given the lines of the header of a cleaned Novonix data file,
+    read the reduced protocol if it exists.
+
+    Parameters
+    -----------
+    ff : file object or iterator over strings
+        Open file or header lines, read until the line with [Data]
+
+    infile : string
+        Name of the Novonix file, for the messages
+
+    Returns
+    --------
+    protocol : list
+        List with the reduced protocol.
+
+    protocol_exists : bool
+        False if there is no reduced protocol.
+
+    Examples
+    ---------
+    >>> import preparenovonix.novonix_add as prep
+    >>> protocol, protocol_exists = prep.find_reduced_protocol(
+    ...     ['[Summary] \n','[Data] \n'])
+    >>> print(protocol_exists)
+    False
+    """
+
     protocol_exists = False
 
     protocol = [nv.protocol_first]
 
+    ff = iter(ff)
     fw = " "
-    with open(infile, "r") as ff:
-        while fw != protocol[0].strip():
-            line = ff.readline()
-            fw = line.strip()
-            if fw == "[Data]":
-                return protocol, protocol_exists
-
-        while fw != nv.end_rprotocol.strip():
-            line = ff.readline()
-            fw = line.strip()
-            if fw == "[Data]":
-                sys.exit(
-                    "STOP novonix_add.read_reduced_protocol \n"
-                    + "REASON: line [End reduced protocol] not found \n"
-                    + "       "
-                    + str(infile)
-                    + " \n"
-                )
-            protocol.append(line)
-            protocol_exists = True
-        return protocol, protocol_exists
+    while fw != protocol[0].strip():
+        line = next(ff, "")
+        fw = line.strip()
+        if fw == "[Data]" or not line:
+            return protocol, protocol_exists
+
+    while fw != nv.end_rprotocol.strip():
+        line = next(ff, "")
+        fw = line.strip()
+        if fw == "[Data]" or not line:
+            raise ProtocolSyntaxError(
+                "line [End reduced protocol] not found",
+                infile=infile,
+                where="novonix_add.read_reduced_protocol",
+            )
+        protocol.append(line)
+        protocol_exists = True
+    return protocol, protocol_exists
 
 
-def protocol_check(infile, istate, verbose=False):
+def protocol_check(infile, istate, verbose=False, chunk_rows=None):
     """
     Given a cleaned Novonix data file
     and the expected number of different measurements from the header,
@@ -332,7 +932,7 @@ def protocol_check(infile, istate, verbose=False):
 
     Parameters
     -----------
-    infile : string
+    infile : string or NovonixFile
         Name of the input Novonix file
 
     istate : int
@@ -341,6 +941,10 @@ def protocol_check(infile, istate, verbose=False):
     verbose : boolean
         True to print information statements
 
+    chunk_rows : integer
+        Number of data rows read at a time,
+        None to read all the data at once
+
     Returns
     -------
     viable_prot : boolean
@@ -353,11 +957,60 @@ def protocol_check(infile, istate, verbose=False):
     True
     """
 
-    viable_prot = True
+    nf = novonix_file(infile)
 
     # Test that the number of protocol lines taking into account repetitions.
-    step_number = read_column(infile, nv.col_step, outtype="int")
-    state_number = read_column(infile, nv.state_col, outtype="int")
+    segments = read_segments(nf)
+    if segments is not None:
+        # The sets of measurements start with State 0 or -1
+        uniq_step, minus1 = count_steps(segments["step"], segments["state"])
+    else:
+        uniq_step = 0
+        minus1 = 0
+        chunks = iter_data_chunks(nf, [nv.col_step, nv.state_col], chunk_rows, "int")
+        for row, offset, columns, chunk in chunks:
+            nuniq, nminus1 = count_steps(columns[nv.col_step], columns[nv.state_col])
+            uniq_step += nuniq
+            minus1 += nminus1
+
+    viable_prot = protocol_steps_check(
+        istate, uniq_step, minus1, infile=nf.infile, verbose=verbose
+    )
+
+    return viable_prot
+
+
+def count_steps(step_number, state_number):
+    """
+    Given the Step Number and State of a set of data rows,
+    count the number of different steps (CC-CV is considered one).
+
+    Parameters
+    -----------
+    step_number : array of integers
+        Step Number of each row
+
+    state_number : array of integers
+        State of each row
+
+    Returns
+    -------
+    uniq_step : int
+        Number of different steps
+
+    minus1 : int
+        Number of single measurements (State=-1)
+
+    Examples
+    ---------
+    >>> import numpy as np
+    >>> import preparenovonix.novonix_add as prep
+    >>> prep.count_steps(np.array([1,1,2,8]),np.array([0,2,-1,0]))
+    (2, 1)
+    """
+
+    step_number = np.asarray(step_number)
+    state_number = np.asarray(state_number)
 
     # Find the number of different steps (CC-CV is considered one)
     ind = np.where(
@@ -371,6 +1024,47 @@ def protocol_check(infile, istate, verbose=False):
             & (step_number != nv.CCCV_CVd)
         )
     )[1]
+
+    return uniq_step, minus1
+
+
+def protocol_steps_check(istate, uniq_step, minus1, infile="", verbose=False):
+    """
+    Given the expected number of different measurements from the header
+    and the number of different steps in the data,
+    check if the obtained protocol is reasonable given the data.
+
+    Parameters
+    -----------
+    istate : int
+        Number of measurements derived from reading the protocol
+
+    uniq_step : int
+        Number of different steps in the data, from count_steps
+
+    minus1 : int
+        Number of single measurements in the data, from count_steps
+
+    infile : string
+        Name of the Novonix file, for the messages
+
+    verbose : boolean
+        True to print information statements
+
+    Returns
+    -------
+    viable_prot : boolean
+        True when the reduced protocol is adequate given the data
+
+    Examples
+    ---------
+    >>> import preparenovonix.novonix_add as prep
+    >>> prep.protocol_steps_check(103,103,0)
+    True
+    """
+
+    viable_prot = True
+
     if verbose:
         print(
             "Unique steps = {} (step=-1: {}), Steps from protocol = {}".format(
@@ -441,7 +1135,9 @@ def rep_info_not_fmtspace(line, fmt_space):
     """
 
     if fmt_space:
-        sys.exit("STOP novonix_add.rep_info_not_fmtspace: wrong format")
+        raise ProtocolSyntaxError(
+            "wrong format", where="novonix_add.rep_info_not_fmtspace"
+        )
 
     unexpected = False
     linestrip = line.strip()
@@ -503,19 +1199,227 @@ def create_end_repeat(nstep, iline, protocol, inrepeat):
     return protocol, inrepeat
 
 
-def create_reduced_protocol(infile, verbose=False):
+def reduce_protocol(ff, infile=""):
+    """
+    Given the header of a cleaned Novonix data file, get a reduced
+    protocol with one command per line.
+
+    Parameters
+    -----------
+    ff : file object
+        Open file, or io.StringIO with the header lines,
+        positioned before the [Protocol] line
+
+    infile : string
+        Name of the Novonix file, for the messages
+
+    Returns
+    --------
+    protocol : list
+        List with the reduced protocol
+
+    istate : int
+        Number of measurements expected from the protocol,
+        taking into account repetitions
+
+    Examples
+    ---------
+    >>> import preparenovonix.novonix_add as prep
+    >>> with open('example_data/example_data_prep.csv') as ff:
+    ...     protocol, istate = prep.reduce_protocol(ff)
+    >>> print(istate)
+    103
+    """
+
+    # Initialize the protocol array
+    protocol = [nv.protocol_first]
+
+    # Header line counter
+    ih = 0
+
+    # Read until the protocol starts
+    for line in ff:
+        ih += 1
+        if "[Protocol]" in line:
+            break
+
+    # Read until the first character is '[' and compare to the commands
+    continue_reading = True
+    while continue_reading:
+        line = ff.readline()
+        ih += 1
+
+        if line[0] == "[":
+            # Skip the operating limits if present
+            if line.split()[0] != "[Protocol" and line.split()[0] != "[End":
+                continue_reading = False
+
+    # Establish which format is this file
+    fmt_space, commands = get_format(line)
+
+    # Set counters to 0 for the number of lines, steps,
+    # 'State' blocks (0,1,...,1,2), commands and subcommands
+    iline = 0
+    new_line = " "
+    istep = 0
+    nstep = 0
+    inrepeat = False
+    istate = 0
+    command = " "
+    isub = 0
+    doneendrepeat = False
+
+    # Read until the end of the protocol
+    while "[End Protocol]" not in line:
+        command = get_command(line, fmt_space)
+
+        if command in commands or command.split()[0] == "Repeat":
+            iline += 1
+            if iline > 1 and not doneendrepeat:
+                # Append the new line
+                protocol.append(new_line + "] \n")
+                new_line = " "
+
+                # Create an 'End Repeat line if needed
+                if istep == nstep and inrepeat and not doneendrepeat:
+                    iline += 1
+                    protocol, inrepeat = create_end_repeat(
+                        nstep, iline, protocol, inrepeat
+                    )
+                    new_line = " "
+            doneendrepeat = False
+
+            # Get the number of repetitions and repeated steps
+            if command.split()[0] == "Repeat":
+                if inrepeat:
+                    raise ProtocolSyntaxError(
+                        "code not set to handle nested loops",
+                        infile=infile,
+                        line=ih,
+                        where="novonix_add.create_reduced_protocol",
+                    )
+
+                # Get the number of repetitions and steps within the loop
+                unexpected = False
+                if fmt_space:
+                    line = ff.readline()
+                    ih += 1
+                    fw = line.strip()
+                    if fw[1:-1].split()[0] == "Repeat":
+                        ncount = int(fw[1:-1].split()[2])
+                    else:
+                        unexpected = True
+                    line = ff.readline()
+                    ih += 1
+                    fw = line.strip()
+                    if fw[1:-1].split()[0] == "Step":
+                        nstep = int(fw[1:-1].split()[2])
+                    else:
+                        unexpected = True
+                else:
+                    ncount, nstep, unexpected = rep_info_not_fmtspace(
+                        line, fmt_space
+                    )
+
+                if unexpected:
+                    raise ProtocolSyntaxError(
+                        "unexpected protocol syntax",
+                        infile=infile,
+                        line=ih,
+                        where="novonix_add.create_reduced_protocol",
+                    )
+
+                new_line = (
+                    "[" + str(iline) + " : Repeat " + str(ncount) + " times :"
+                )
+                istep = 0
+                inrepeat = True
+            else:
+                if inrepeat:
+                    istep += 1
+                    istate = istate + ncount
+                else:
+                    istate += 1
+
+                new_line = (
+                    "[" + str(iline) + " : " + command.replace(" ", "_") + " : "
+                )
+
+        elif inrepeat and (
+            command == nv.increment1
+            or command == nv.increment1.replace(" ", "_")
+            or command == nv.increment2
+            or command == nv.increment2.replace(" ", "_")
+        ):
+            # Substract any Increment step
+            nstep = nstep - 1
+
+        else:
+            # Append subcommands without brackets,
+            # separated by semicoloms
+            isub += 1
+            subcommand = command
+
+            if subcommand not in nv.ignore:
+                if isub == 1:
+                    new_line = new_line + subcommand
+                else:
+                    new_line = new_line + ";" + subcommand
+
+            if subcommand.strip().casefold() == nv.endrepeat.casefold():
+                # Append the last line
+                protocol.append(new_line + "] \n")
+                iline += 1
+
+                # Create an 'End Repeat line for files with fmt_space=True
+                # which have an endrepeat statement
+                protocol, inrepeat = create_end_repeat(
+                    nstep, iline + 1, protocol, inrepeat
+                )
+
+                new_line = " "
+                doneendrepeat = True
+
+        # Continue reading
+        line = ff.readline()
+        ih += 1
+
+    # Add last line if not done already
+    ilast = int(protocol[-1].split()[0].split("[")[1])
+
+    if iline > ilast:
+        protocol.append(new_line + "] \n")
+
+        # Create an 'End Repeat line if needed
+        if istep == nstep and inrepeat:
+            new_line = (
+                "[" + str(iline + 1) + " : End Repeat " + str(nstep) + " steps :"
+            )
+            protocol.append(new_line + "] \n")
+            new_line = " "
+
+    protocol.append(nv.end_rprotocol)
+
+    return protocol, istate
+
+
+def create_reduced_protocol(infile, verbose=False, chunk_rows=None):
     """
     Given a Novonix data file, get a reduced protocol
     with one command per line.
 
     Parameters
     -----------
-    infile : string
+    infile : string or NovonixFile
         Name of the input Novonix file
 
     verbose : boolean
         Yes = print out some informative statements
 
+    chunk_rows : integer
+        Number of data rows read at a time to check the protocol,
+        None to read all the data at once
+
     Returns
     --------
     protocol : list
@@ -535,194 +1439,379 @@ def create_reduced_protocol(infile, verbose=False):
      [End Reduced Protocol]
     """
 
+    nf = novonix_file(infile)
+
     # Read the reduced protocol if it already exists
-    protocol, protocol_exists = read_reduced_protocol(infile, verbose=verbose)
+    protocol, protocol_exists = read_reduced_protocol(nf, verbose=verbose)
     if protocol_exists:
         return protocol, protocol_exists
 
-    # Initialize the protocol array
-    protocol = [nv.protocol_first]
+    # Create the reduced protocol (if it does not already exist)
+    with open(nf.infile, "r") as ff:
+        protocol, istate = reduce_protocol(ff, nf.infile)
 
-    # Header line counter
-    ih = 0
+    # Test the obtained protocol
+    viable_prot = protocol_check(nf, istate, verbose=verbose, chunk_rows=chunk_rows)
 
-    # Create the reduced protocol (if it does not already exist)
-    with open(infile, "r") as ff:
-        # Read until the protocol starts
-        for line in ff:
-            ih += 1
-            if "[Protocol]" in line:
-                break
+    return protocol, viable_prot
 
-        # Read until the first character is '[' and compare to the commands
-        continue_reading = True
-        while continue_reading:
-            line = ff.readline()
-            ih += 1
-
-            if line[0] == "[":
-                # Skip the operating limits if present
-                if line.split()[0] != "[Protocol" and line.split()[0] != "[End":
-                    continue_reading = False
-
-        # Establish which format is this file
-        fmt_space, commands = get_format(line)
-
-        # Set counters to 0 for the number of lines, steps,
-        # 'State' blocks (0,1,...,1,2), commands and subcommands
-        iline = 0
-        new_line = " "
-        istep = 0
-        nstep = 0
-        inrepeat = False
-        istate = 0
-        command = " "
-        isub = 0
-        doneendrepeat = False
-
-        # Read until the end of the protocol
-        while "[End Protocol]" not in line:
-            command = get_command(line, fmt_space)
-
-            if command in commands or command.split()[0] == "Repeat":
-                iline += 1
-                if iline > 1 and not doneendrepeat:
-                    # Append the new line
-                    protocol.append(new_line + "] \n")
-                    new_line = " "
 
-                    # Create an 'End Repeat line if needed
-                    if istep == nstep and inrepeat and not doneendrepeat:
-                        iline += 1
-                        protocol, inrepeat = create_end_repeat(
-                            nstep, iline, protocol, inrepeat
-                        )
-                        new_line = " "
-                doneendrepeat = False
-
-                # Get the number of repetitions and repeated steps
-                if command.split()[0] == "Repeat":
-                    if inrepeat:
-                        sys.exit(
-                            "STOP novonix_add.create_reduced_protocol \n"
-                            + "    at header line: "
-                            + str(ih)
-                            + " \n"
-                            + "REASON code not set to handle nested loops \n"
-                            + "       "
-                            + str(infile)
-                            + " \n"
-                        )
-
-                    # Get the number of repetitions and steps within the loop
-                    unexpected = False
-                    if fmt_space:
-                        line = ff.readline()
-                        ih += 1
-                        fw = line.strip()
-                        if fw[1:-1].split()[0] == "Repeat":
-                            ncount = int(fw[1:-1].split()[2])
-                        else:
-                            unexpected = True
-                        line = ff.readline()
-                        ih += 1
-                        fw = line.strip()
-                        if fw[1:-1].split()[0] == "Step":
-                            nstep = int(fw[1:-1].split()[2])
-                        else:
-                            unexpected = True
-                    else:
-                        ncount, nstep, unexpected = rep_info_not_fmtspace(
-                            line, fmt_space
-                        )
-
-                    if unexpected:
-                        sys.exit(
-                            "STOP novonix_add.create_reduced_protocol \n"
-                            + "REASON unexpected protocol syntax \n"
-                            + "       "
-                            + str(infile)
-                            + " \n"
-                        )
-
-                    new_line = (
-                        "[" + str(iline) + " : Repeat " + str(ncount) + " times :"
-                    )
-                    istep = 0
-                    inrepeat = True
-                else:
-                    if inrepeat:
-                        istep += 1
-                        istate = istate + ncount
-                    else:
-                        istate += 1
+def protocol_schedule(prot, infile=""):
+    r"""
+    Given a reduced protocol, expand it into the sequence of
+    Protocol line and Loop number expected for each set of
+    measurements with a single State (0,1,...,1,2),
+    unrolling the repetitions.
 
-                    new_line = (
-                        "[" + str(iline) + " : " + command.replace(" ", "_") + " : "
-                    )
+    Parameters
+    -----------
+    prot : list of strings
+        Reduced protocol lines, without the first and last lines
 
-            elif inrepeat and (
-                command == nv.increment1
-                or command == nv.increment1.replace(" ", "_")
-                or command == nv.increment2
-                or command == nv.increment2.replace(" ", "_")
-            ):
-                # Substract any Increment step
-                nstep = nstep - 1
+    infile : string
+        Name of the Novonix file, for the messages
 
-            else:
-                # Append subcommands without brackets,
-                # separated by semicoloms
-                isub += 1
-                subcommand = command
-
-                if subcommand not in nv.ignore:
-                    if isub == 1:
-                        new_line = new_line + subcommand
-                    else:
-                        new_line = new_line + ";" + subcommand
+    Returns
+    --------
+    linenr : array of integers
+        Protocol line of each expected set of measurements
 
-                if subcommand.strip().casefold() == nv.endrepeat.casefold():
-                    # Append the last line
-                    protocol.append(new_line + "] \n")
-                    iline += 1
+    loopnr : array of integers
+        Loop number of each expected set of measurements,
+        0 for measurements not being repeated
 
-                    # Create an 'End Repeat line for files with fmt_space=True
-                    # which have an endrepeat statement
-                    protocol, inrepeat = create_end_repeat(
-                        nstep, iline + 1, protocol, inrepeat
-                    )
+    stop : string
+        Reason of the ProtocolSyntaxError to be raised if the data reaches
+        the end of the schedule, empty if the schedule ends with the protocol
 
-                    new_line = " "
-                    doneendrepeat = True
+    Examples
+    ---------
+    >>> import preparenovonix.novonix_add as prep
+    >>> prot = ['[1 : Repeat 2 times :] \n','[2 : Open_circuit_storage : ] \n',
+    ...         '[3 : End Repeat 1 steps :] \n']
+    >>> prep.protocol_schedule(prot)
+    (array([2, 2]), array([1, 2]), '')
+    """
 
-            # Continue reading
-            line = ff.readline()
-            ih += 1
+    linenr = []
+    loopnr = []
+    stop = ""
+
+    commands = [line.split(":")[1].strip() for line in prot]
+
+    iloop = 0
+    iprot = 0
+    while iprot < len(commands):
+        command = commands[iprot]
+        if command in nv.com_prot[:-1]:
+            linenr.append(iprot + 1)
+            loopnr.append(0)
+            iprot += 1
+            continue
+        elif command.split(" ")[0].strip() != "Repeat":
+            stop = "unexpected command in reduced protocol"
+            break
+
+        # First repetition, read from the protocol
+        ntimes = int(command.split(" ")[1].strip())
+        iloop += 1
+        first_rep = iprot + 2
+        iprot += 1
+        while iprot < len(commands) and commands[iprot] in nv.com_prot[:-1]:
+            linenr.append(iprot + 1)
+            loopnr.append(iloop)
+            iprot += 1
+        if iprot == len(commands) or commands[iprot].split(" ")[0] != "End":
+            continue
+
+        # Following repetitions, from the End Repeat line
+        nrstep = int(commands[iprot].split(" ")[2].strip())
+        if iprot + 1 - first_rep != nrstep:
+            stop = (
+                "array of repeated steps has an unexpected length, "
+                + str(iprot + 1 - first_rep)
+                + " != "
+                + str(nrstep)
+            )
+            break
+        if nrstep == 0:
+            break
 
-        # Add last line if not done already
-        ilast = int(protocol[-1].split()[0].split("[")[1])
+        # With less than 2 repetitions the counters are never reset:
+        # the steps are repeated once and the protocol cannot be followed
+        nrep = max(ntimes - 1, 1)
+        linenr.extend(np.tile(np.arange(first_rep, first_rep + nrstep), nrep))
+        loopnr.extend(np.repeat(np.arange(iloop + 1, iloop + nrep + 1), nrstep))
+        iloop += nrep
+        if ntimes < 2:
+            break
+        iprot += 1
 
-        if iline > ilast:
-            protocol.append(new_line + "] \n")
+    return np.array(linenr, dtype=int), np.array(loopnr, dtype=int), stop
 
-            # Create an 'End Repeat line if needed
-            if istep == nstep and inrepeat:
-                new_line = (
-                    "[" + str(iline + 1) + " : End Repeat " + str(nstep) + " steps :"
-                )
-                protocol.append(new_line + "] \n")
-                new_line = " "
 
-        protocol.append(nv.end_rprotocol)
+def protocol_carry(infile, viable_prot):
+    """
+    Initialize the values carried over from one chunk of data
+    to the next one when working out the Loop number and
+    Protocol line columns.
+
+    Parameters
+    -----------
+    infile : string
+        Name of the input Novonix file
 
-        # Test the obtained protocol
-        viable_prot = protocol_check(infile, istate, verbose=verbose)
+    viable_prot : boolean
+        True when the reduced protocol is adequate given the data
 
-    return protocol, viable_prot
+    Returns
+    --------
+    carry : dictionary
+        Initial values for loopnr_chunk
+
+    Examples
+    ---------
+    >>> import preparenovonix.novonix_add as prep
+    >>> carry = prep.protocol_carry('example.csv',True)
+    >>> print(carry['iset'])
+    0
+    """
+
+    carry = {
+        "infile": infile,
+        "viable_prot": viable_prot,
+        "schedule": None,
+        "iset": 0,
+        "last_step": -1,
+        "open": [],
+        "lines": [],
+        "loops": [],
+    }
+
+    return carry
+
+
+def protocol_segments(prot, steps, carry):
+    r"""
+    Given the Step Number of consecutive sets of measurements
+    with a single State (0,1,...,1,2), find their line in the
+    reduced protocol and their Loop number.
+    A constant voltage step following a constant current one
+    is considered part of the same CC-CV protocol line.
+
+    Parameters
+    -----------
+    prot : list of strings
+        Reduced protocol lines, without the first and last lines
+
+    steps : array of integers
+        Step Number of each set of measurements
+
+    carry : dictionary
+        Position within the reduced protocol, as returned by
+        protocol_carry, which is updated by this function.
+
+    Returns
+    --------
+    linenr : array of integers
+        Protocol line, -999 if not found
+
+    loopnr : array of integers
+        Loop number, 0 for measurements not being repeated
+
+    Examples
+    ---------
+    >>> import numpy as np
+    >>> import preparenovonix.novonix_add as prep
+    >>> carry = prep.protocol_carry('example.csv',True)
+    >>> prep.protocol_segments(['[1 : Open_circuit_storage : ] \n'],np.array([0]),carry)
+    (array([1]), array([0]))
+    """
+
+    if carry["schedule"] is None:
+        carry["schedule"] = protocol_schedule(prot, carry["infile"])
+    sched_line, sched_loop, stop = carry["schedule"]
+
+    steps = np.asarray(steps)
+    linenr = np.full(len(steps), -999, dtype=int)
+    loopnr = np.zeros(len(steps), dtype=int)
+    if len(steps) < 1:
+        return linenr, loopnr
+
+    # CC-CV: the CV step shares the protocol line of the CC one
+    last_steps = np.concatenate(([carry["last_step"]], steps[:-1]))
+    cccv = np.isin(steps, [nv.CCCV_CVc, nv.CCCV_CVd]) & np.isin(
+        last_steps, [nv.CCCV_CCc, nv.CCCV_CCd]
+    )
+
+    # Position in the schedule of each set of measurements
+    new = (~cccv).astype(int)
+    iset = carry["iset"] + np.cumsum(new) - new
+    carry["iset"] += int(new.sum())
+    carry["last_step"] = steps[-1]
+
+    found = iset < len(sched_line)
+    if stop and not found.all():
+        raise ProtocolSyntaxError(
+            stop, infile=carry["infile"], where="novonix_add.novonix_add_loopnr"
+        )
+    linenr[found] = sched_line[iset[found]] - cccv[found]
+    loopnr[found] = sched_loop[iset[found]]
+
+    return linenr, loopnr
+
+
+def loopnr_chunk(prot, steps, states, carry):
+    r"""
+    Given a chunk of data, with their Step Number and State,
+    work out their Protocol line and Loop number.
+
+    Parameters
+    -----------
+    prot : list of strings
+        Reduced protocol lines, without the first and last lines
+
+    steps : array of integers
+        Step Number of each row
+
+    states : array of integers
+        State of each row
+
+    carry : dictionary
+        Values carried over from previous chunks, as returned by
+        protocol_carry, which are updated by this function.
+        The sets of measurements not finished within the chunk are
+        kept in carry['open'].
+
+    Returns
+    --------
+    linenr : array of integers
+        Protocol line of each row
+
+    loopnr : array of integers
+        Loop number of each row
+
+    Examples
+    ---------
+    >>> import numpy as np
+    >>> import preparenovonix.novonix_add as prep
+    >>> carry = prep.protocol_carry('example.csv',True)
+    >>> prot = ['[1 : Open_circuit_storage : ] \n']
+    >>> linenr, loopnr = prep.loopnr_chunk(prot,np.array([0,0]),np.array([0,2]),carry)
+    >>> print(linenr, loopnr)
+    [1 1] [0 0]
+    """
+
+    linenr = np.zeros(shape=len(steps), dtype=int)
+    linenr.fill(-999.0)
+    loopnr = np.zeros(shape=len(steps), dtype=int)
+    loopnr.fill(-999.0)
+
+    if carry["viable_prot"]:
+        loopnr.fill(0)
+
+    # Starts and ends of the sets of measurements for a single state
+    izeros, = np.where(np.logical_or(states == 0, states == -1))
+    itwos, = np.where(np.logical_or(states == 2, states == -1))
+
+    # Values for the sets open at the start of the chunk and the new ones
+    nopen = len(carry["open"])
+    set_line = np.full(nopen + len(izeros), -999, dtype=int)
+    set_loop = np.full(nopen + len(izeros), -999, dtype=int)
+    if nopen:
+        set_line[:nopen], set_loop[:nopen] = np.array(carry["open"], dtype=int).T
+    if carry["viable_prot"]:
+        set_line[nopen:], set_loop[nopen:] = protocol_segments(
+            prot, steps[izeros], carry
+        )
+    carry["lines"].append(set_line[nopen:])
+    carry["loops"].append(set_loop[nopen:])
+
+    # Pair the starts and ends of the sets,
+    # the unpaired ones continue in the next chunk
+    istarts = np.concatenate((np.zeros(nopen, dtype=int), izeros))
+    iends = np.full(len(istarts), len(steps) - 1, dtype=int)
+    npaired = min(len(istarts), len(itwos))
+    iends[:npaired] = itwos[:npaired]
+    carry["open"] = list(zip(set_line[npaired:].tolist(), set_loop[npaired:].tolist()))
+
+    # Fill the rows of each set
+    if len(istarts) > 0:
+        rows = np.arange(len(steps))
+        iset = np.searchsorted(istarts, rows, side="right") - 1
+        inset = iset >= 0
+        inset[inset] = rows[inset] <= iends[iset[inset]]
+        linenr[inset] = set_line[iset[inset]]
+        loopnr[inset] = set_loop[iset[inset]]
+
+    return linenr, loopnr
+
+
+def loopnr_blocks(infile, prot, carry, chunk_rows=None, gcarry=None):
+    """
+    Given a Novonix data file with a State column, work out the
+    Protocol line and Loop number columns by chunks of data rows.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the input Novonix file
+
+    prot : list of strings
+        Reduced protocol lines, without the first and last lines
+
+    carry : dictionary
+        Values carried over between chunks, as returned by protocol_carry
+
+    chunk_rows : integer
+        Number of data rows processed at a time,
+        None to process all the data at once
+
+    gcarry : dictionary
+        Values carried over between chunks for the table of the sets
+        of measurements, as returned by segment_carry.
+        None if the table is not needed.
+
+    Returns
+    --------
+    block : bytes
+        Data rows (generated)
+
+    columns : list of arrays
+        Protocol line and Loop number of the data rows (generated)
+
+    keep : None
+        All the rows are kept (generated)
+
+    Examples
+    ---------
+    >>> import preparenovonix.novonix_add as prep
+    >>> infile = 'example_data/example_data_prep.csv'
+    >>> protocol, viable_prot = prep.create_reduced_protocol(infile)
+    >>> carry = prep.protocol_carry(infile,viable_prot)
+    >>> for block, columns, keep in prep.loopnr_blocks(infile,protocol[1:-1],carry):
+    ...     print(columns[1].max())
+    4
+    """
+
+    nf = novonix_file(infile)
+
+    if gcarry is not None:
+        icols = column_positions(nf, [nv.col_step, nv.col_t, nv.col_c])
+
+    chunks = iter_data_chunks(nf, [nv.col_step, nv.state_col], chunk_rows, "int")
+    for row, offset, columns, chunk in chunks:
+        linenr, loopnr = loopnr_chunk(
+            prot, columns[nv.col_step], columns[nv.state_col], carry
+        )
+        if gcarry is not None:
+            segment_block(
+                chunk, columns[nv.state_col], icols, gcarry, encoding=nf.encoding
+            )
+        yield chunk, [linenr, loopnr], None
 
 
-def novonix_add_loopnr(infile, verbose=False):
+def novonix_add_loopnr(infile, verbose=False, chunk_rows=None, segments=False):
     """
     Given a cleaned Novonix data file, it adds a 'Loop number' column,
     with monotonically increasing numbers and
@@ -741,6 +1830,14 @@ def novonix_add_loopnr(infile, verbose=False):
     verbose : boolean
         Yes = print out some informative statements
 
+    chunk_rows : integer
+        Number of data rows processed at a time,
+        None to process all the data at once
+
+    segments : boolean
+        True to save the table of the sets of measurements in the
+        cache directory of the file, see novonix_io.save_segments
+
     Notes
     -----
     This code returns a Novonix file with two extra columns.
@@ -752,196 +1849,65 @@ def novonix_add_loopnr(infile, verbose=False):
     The file already has the column Loop number
     """
 
+    # Index the header of the file
+    nf = novonix_file(infile)
+
     # Check if the file already has the new Loop column
-    col_exists = column_check(infile, nv.loop_col, verbose=verbose)
+    col_exists = column_check(nf, nv.loop_col, verbose=verbose)
     if col_exists:
         return
 
     # Get the reduced protocol as a list
-    protocol, viable_prot = create_reduced_protocol(infile, verbose=verbose)
-
-    # Read the Step_Number column
-    steps = read_column(infile, nv.col_step, outtype="int")
-
-    # Read the States and the set of measurements for a single state
-    states = read_column(infile, nv.state_col, outtype="int")
-    izeros, = np.where(np.logical_or(states == 0, states == -1))
-    itwos, = np.where(np.logical_or(states == 2, states == -1))
-
-    linenr = np.zeros(shape=len(steps), dtype=int)
-    linenr.fill(-999.0)
-    loopnr = np.zeros(shape=len(steps), dtype=int)
-    loopnr.fill(-999.0)
-
-    if viable_prot:
-        loopnr.fill(0)
-
-        # Prepare to loop over the protocol lines
-        prot = protocol[1:-1]
-        iprot = 0
-        inrepeat = False
-        com_repeat = []
-        ntimes = 0
-        itimes = 0
-        iloop = 0
-        last_step = -1
-
-        # Loop over the measurement sets
-        for iz, it in zip(izeros, itwos):
-            # Step of the Data Subset
-            step = steps[iz]
-
-            # Read protocol line
-            continue_reading = True
-            while continue_reading:
-                command = prot[iprot].split(":")[1].strip()
-                if command.split(" ")[0].strip() == "Repeat":
-                    inrepeat = True
-                    com_repeat = []
-                    iloop += 1
-                    itimes = 0
-                    irstep = 0
-                    ntimes = int(command.split(" ")[1].strip())
-
-                    iprot += 1
-                    first_rep = iprot + 1
-                    firstend = True
-
-                elif command.split(" ")[0].strip() == "End":
-                    nrstep = int(command.split(" ")[2].strip())
-                    if firstend:
-                        irstep = 0
-                        itimes += 1
-                        iloop += 1
-                        firstend = False
-
-                    # Check that the array of repeated steps has the expected lenght
-                    if len(com_repeat) != nrstep:
-                        sys.exit(
-                            "STOP function novonix_add_loopnr \n"
-                            + "REASON array of repeated steps has an unexpected length \n"
-                            + "       "
-                            + str(len(com_repeat))
-                            + " != "
-                            + str(nrstep)
-                            + " \n"
-                            + "       "
-                            + str(infile)
-                            + " \n"
-                        )
-
-                    # Repeated commands
-                    index = nv.com_prot.index(com_repeat[irstep])
-                    sel = select_com_val(index)
-                    if sel:
-                        if (step == nv.CCCV_CVc or step == nv.CCCV_CVd) and (
-                            last_step == nv.CCCV_CCc or last_step == nv.CCCV_CCd
-                        ):
-                            # 1 protocol line for CC-CV
-                            last_step = -1
-                            irstep = irstep - 1
-
-                        # Compare the protocol and step values
-                        linenr[iz : it + 1] = first_rep + irstep
-                        loopnr[iz : it + 1] = iloop
-                        continue_reading = False
-
-                    # Adequately deal with the reduced protocol counters
-                    if itimes == ntimes - 1 and irstep == nrstep - 1:
-                        # Last command of the last repetition: reset
-                        iprot += 1
-                        inrepeat = False
-                        itimes = 0
-                        ntimes = 0
-                        nrstep = 0
-                        first_rep = 0
-                    elif itimes < ntimes - 1 and irstep == nrstep - 1:
-                        # Last command within a repetition
-                        irstep = 0
-                        itimes += 1
-                        iloop += 1
-                    else:
-                        irstep += 1
-
-                elif command in nv.com_prot[:-1]:
-                    index = nv.com_prot.index(command)
-                    sel = select_com_val(index)
-                    if sel:
-                        if (step == nv.CCCV_CVc or step == nv.CCCV_CVd) and (
-                            last_step == nv.CCCV_CCc or last_step == nv.CCCV_CCd
-                        ):
-                            # 1 protocol line for CC-CV
-                            last_step = -1
-                            iprot = iprot - 1
-                        else:
-                            if inrepeat:
-                                com_repeat.append(command)
-
-                        linenr[iz : it + 1] = iprot + 1
-                        if inrepeat:
-                            loopnr[iz : it + 1] = iloop
-                        continue_reading = False
-
-                    iprot += 1
-                    if iprot == len(prot):
-                        continue_reading = False
-                else:
-                    sys.exit(
-                        "STOP function novonix_add_loopnr \n"
-                        + "REASON unexpected command in reduced protocol \n"
-                        + "       "
-                        + str(infile)
-                        + " \n"
-                    )
-            last_step = step
+    protocol, viable_prot = create_reduced_protocol(
+        nf, verbose=verbose, chunk_rows=chunk_rows
+    )
 
-    # Create a temporary file with the new header
+    # Header with the reduced protocol and the new column names
     header = []
     fw = "fw"
-    tmp_file = "tmp.csv"
     with open(infile, "r") as ff:
-        # Read until the line with [End Protocol]
+        # Read until the line with [Data]
         while fw != "[Data]":
             line = ff.readline()
             header.append(line)
             fw = line.split()[0]
 
-        # Create a temporary file with the header as it was
-        with open(tmp_file, "w") as tf:
-            for item in header[:-1]:
-                tf.write(str(item))
-
-        # Add the reduced protocol
-        with open(tmp_file, "a") as tf:
-            for item in protocol:
-                tf.write(str(item))
-            # Add [Data] line
-            tf.write(str(header[-1]))
-
         # Read the column names and add the 'Loop' and 'Line'
         line = ff.readline()
         new_head = str(line.rstrip()) + ", " + nv.line_col + ", " + nv.loop_col + " \n"
-        with open(tmp_file, "a") as tf:
-            tf.write(str(new_head))
-
-        # Write the data + 2 new columns in the temporary file
-        for ii, line in enumerate(ff):
-            # Write the new data to the temporary file
-            with open(tmp_file, "a") as tf:
-                new_line = (
-                    line.rstrip() + "," + str(linenr[ii]) + "," + str(loopnr[ii]) + "\n"
-                )
-                tf.write(new_line)
+    header = header[:-1] + protocol + [header[-1], new_head]
+
+    # Write the header and the data with the 2 new columns
+    # in a temporary file
+    # Table of the sets of measurements, built when adding the State
+    table = None
+    gcarry = None
+    if segments:
+        table = read_segments(nf)
+        if table is None:
+            gcarry = segment_carry()
+
+    with temporary_file(infile) as tmp_file:
+        carry = protocol_carry(infile, viable_prot)
+        blocks = loopnr_blocks(
+            nf, protocol[1:-1], carry, chunk_rows=chunk_rows, gcarry=gcarry
+        )
+        write_columns(tmp_file, header, blocks, encoding=nf.encoding)
 
         # Replace the input file by the tmp_file,
         # which should be bigger.
         replace_file(tmp_file, infile, newbigger=True)
 
-        if verbose:
-            print(
-                "{} contains now the columns Loop number and Protocol line".format(
-                    infile
-                )
-            )
+    # Keep the table of the sets of measurements
+    if segments:
+        if gcarry is not None:
+            table = segment_table(gcarry)
+        segment_lines(table, carry)
+        save_segments(infile, table)
+
+    if verbose:
+        print(
+            "{} contains now the columns Loop number and Protocol line".format(infile)
+        )
 
     return
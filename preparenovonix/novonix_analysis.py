@@ -0,0 +1,684 @@
+import numpy as np
+import preparenovonix.novonix_variables as nv
+from preparenovonix.novonix_errors import OptionError
+from preparenovonix.novonix_io import novonix_file
+from preparenovonix.novonix_io import column_positions
+from preparenovonix.novonix_io import read_columns
+from preparenovonix.novonix_io import read_segments
+from preparenovonix.novonix_io import iter_data_chunks
+from preparenovonix.novonix_add import segment_carry
+from preparenovonix.novonix_add import segment_chunk
+from preparenovonix.novonix_add import segment_table
+
+# Summary of each cycle (consecutive rows with the same Loop number above 0):
+# Loop number, first and last data row, first Run Time (h), duration (h),
+# charge and discharge capacity (Ah), coulombic efficiency,
+# mean Potential (V) and minimum and maximum Temperature
+cycle_dtype = np.dtype(
+    [
+        ("loop", "i8"),
+        ("start", "i8"),
+        ("end", "i8"),
+        ("t_start", "f8"),
+        ("duration", "f8"),
+        ("charge", "f8"),
+        ("discharge", "f8"),
+        ("efficiency", "f8"),
+        ("v_mean", "f8"),
+        ("temp_min", "f8"),
+        ("temp_max", "f8"),
+    ]
+)
+
+
+def file_segments(infile, cache=True, chunk_rows=None):
+    """
+    Given a prepared Novonix data file, get the table of its sets of
+    measurements, from the saved one when possible.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the input Novonix file
+
+    cache : boolean
+        True to use the binary cache of the columns, when the table
+        needs to be built
+
+    chunk_rows : integer
+        Number of data rows read at a time when the table needs to be
+        built without the cache, None to read all the data at once
+
+    Returns
+    --------
+    segments : numpy structured array
+        Table of the sets of measurements, see novonix_add.segment_dtype
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_analysis import file_segments
+    >>> segments = file_segments('example_data/example_data_prep.csv',cache=False)
+    >>> print(segments['loop'].max())
+    4
+    """
+
+    nf = novonix_file(infile)
+
+    segments = read_segments(nf)
+    if segments is not None and (segments["loop"] > -999).all():
+        return segments
+
+    # Build the table from the columns
+    names = [nv.state_col, nv.col_step, nv.col_t, nv.col_c, nv.loop_col, nv.line_col]
+    dtypes = ["int", "int", "float", "float", "int", "int"]
+    if cache:
+        chunks = [(0, None, read_columns(nf, names, dtypes, cache=True), None)]
+    else:
+        chunks = iter_data_chunks(nf, names, chunk_rows, dtypes)
+
+    carry = segment_carry()
+    for row, offset, cols, chunk in chunks:
+        new = segment_chunk(*[cols[name] for name in names[:4]], carry)
+        # The Loop number and Protocol line are the same along a set
+        new["loop"] = cols[nv.loop_col][new["end"] - row]
+        new["line"] = cols[nv.line_col][new["end"] - row]
+
+    return segment_table(carry)
+
+
+def cycle_summary(infile, cache=True):
+    """
+    Given a prepared Novonix data file, with State, Protocol line and
+    Loop number columns, summarize each cycle: each set of consecutive
+    rows with the same Loop number, excluding those with Loop number 0.
+    The capacities and times are reduced over the table of the sets of
+    measurements and the Potential and Temperature over the rows,
+    with segment reductions over the cycle boundaries.
+
+    The capacity change of each set of measurements is taken from its
+    first row to the first row of the next set; increases are added to
+    the charge capacity and decreases to the discharge one.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the input Novonix file
+
+    cache : boolean
+        True to use the binary cache of the columns, see
+        novonix_io.read_columns, making later calls faster
+
+    Returns
+    --------
+    cycles : numpy structured array
+        One row per cycle, see cycle_dtype
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_analysis import cycle_summary
+    >>> cycles = cycle_summary('example_data/example_data_prep.csv',cache=False)
+    >>> print(cycles['loop'])
+    [1 2 3 4]
+    """
+
+    nf = novonix_file(infile)
+    segments = file_segments(nf, cache=cache)
+
+    # Groups of consecutive sets with the same Loop number
+    loops = segments["loop"]
+    first = _run_starts(loops)
+    last = np.append(first[1:], len(loops)) - 1
+    incycle = loops[first] > 0
+
+    # Capacity change of each set, until the start of the next one
+    c_next = np.append(segments["c_start"][1:], segments["c_end"][-1:])
+    dcap = c_next - segments["c_start"]
+
+    cycles = np.zeros(np.count_nonzero(incycle), dtype=cycle_dtype)
+    if len(cycles) < 1:
+        return cycles
+
+    cycles["loop"] = loops[first][incycle]
+    cycles["start"] = segments["start"][first][incycle]
+    cycles["end"] = segments["end"][last][incycle]
+    cycles["t_start"] = segments["t_start"][first][incycle]
+    cycles["duration"] = segments["t_end"][last][incycle] - cycles["t_start"]
+    cycles["charge"] = np.add.reduceat(np.maximum(dcap, 0.0), first)[incycle]
+    cycles["discharge"] = np.add.reduceat(np.maximum(-dcap, 0.0), first)[incycle]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cycles["efficiency"] = np.where(
+            cycles["charge"] > 0, cycles["discharge"] / cycles["charge"], np.nan
+        )
+
+    # Reductions over the rows of each cycle
+    names = [nv.col_v]
+    if nf.icolumn(nv.col_temp) > -1:
+        names.append(nv.col_temp)
+    cols = read_columns(nf, names, cache=cache)
+    bounds = np.column_stack([cycles["start"], cycles["end"] + 1]).ravel()
+
+    voltage = np.append(cols[nv.col_v], 0.0)
+    nrows = cycles["end"] - cycles["start"] + 1
+    cycles["v_mean"] = np.add.reduceat(voltage, bounds)[::2] / nrows
+
+    if nv.col_temp in cols:
+        temp = np.append(cols[nv.col_temp], np.nan)
+        cycles["temp_min"] = np.minimum.reduceat(temp, bounds)[::2]
+        cycles["temp_max"] = np.maximum.reduceat(temp, bounds)[::2]
+    else:
+        cycles["temp_min"] = np.nan
+        cycles["temp_max"] = np.nan
+
+    return cycles
+
+
+def select_segments(segments, loops=None):
+    """
+    Given the table of the sets of measurements, select those with
+    current flowing (not open circuit nor single measurements)
+    and, optionally, a Loop number in loops.
+
+    Parameters
+    -----------
+    segments : numpy structured array
+        Table of the sets of measurements, see novonix_add.segment_dtype
+
+    loops : range or list of integers
+        Loop numbers, None for any
+
+    Returns
+    --------
+    isets : array of integers
+        Position in the table of the selected sets
+
+    Examples
+    ---------
+    >>> import numpy as np
+    >>> from preparenovonix.novonix_add import segment_dtype
+    >>> from preparenovonix.novonix_analysis import select_segments
+    >>> segments = np.zeros(3, dtype=segment_dtype)
+    >>> segments['step'] = [0, 1, 2]
+    >>> segments['loop'] = [0, 1, 2]
+    >>> print(select_segments(segments,loops=range(2,3)))
+    [2]
+    """
+
+    sel = (segments["state"] == 0) & (segments["step"] != nv.OCV)
+    if loops is not None:
+        if isinstance(loops, range) and loops.step == 1:
+            sel &= (segments["loop"] >= loops.start) & (segments["loop"] < loops.stop)
+        else:
+            sel &= np.isin(segments["loop"], list(loops))
+
+    return np.flatnonzero(sel)
+
+
+def binned_derivative(x, y, sets, bin_width, window=1):
+    """
+    Given the values of x and y along the rows of several sets of
+    measurements, get the derivative dy/dx of each set over bins of x,
+    for all the sets at once. The changes of x and y between consecutive
+    rows of a set are added in the bin of their mid point and the
+    derivative is the ratio of the sums, after adding them over
+    'window' bins around each bin.
+
+    Parameters
+    -----------
+    x, y : arrays of floats
+        Values along the rows
+
+    sets : array of integers
+        Set of each row, with the rows of each set together
+
+    bin_width : float
+        Width of the bins of x
+
+    window : integer
+        Number of bins for the smoothing, 1 for none
+
+    Returns
+    --------
+    iset : array of integers
+        Set of each bin
+
+    center : array of floats
+        Center of each bin
+
+    deriv : array of floats
+        Derivative in each bin, NaN when x does not change
+
+    Examples
+    ---------
+    >>> import numpy as np
+    >>> from preparenovonix.novonix_analysis import binned_derivative
+    >>> x = np.array([0.,0.1,0.2,0.3])
+    >>> iset, center, deriv = binned_derivative(x,2*x,np.zeros(4,dtype=int),0.2)
+    >>> print(iset, center, deriv)
+    [0 0] [0.1 0.3] [2. 2.]
+    """
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    sets = np.asarray(sets)
+
+    # Changes between consecutive rows of the same set
+    same = sets[1:] == sets[:-1]
+    dx = np.diff(x)[same]
+    dy = np.diff(y)[same]
+    pair_set = sets[1:][same]
+    bins = np.floor(0.5 * (x[1:] + x[:-1])[same] / bin_width).astype(np.int64)
+    if len(bins) < 1:
+        return np.zeros(0, dtype=int), np.zeros(0), np.zeros(0)
+
+    # Sums over each bin of each set
+    bmin = bins.min()
+    bins = bins - bmin
+    nbins = int(bins.max()) + 1
+    keys, inverse = np.unique(pair_set * nbins + bins, return_inverse=True)
+    sum_dx = np.bincount(inverse, weights=dx, minlength=len(keys))
+    sum_dy = np.bincount(inverse, weights=dy, minlength=len(keys))
+    iset = keys // nbins
+    ibin = keys % nbins
+
+    if window > 1:
+        # Every bin between the first and last of each set
+        first = _run_starts(iset)
+        last = np.append(first[1:], len(iset)) - 1
+        lengths = ibin[last] - ibin[first] + 1
+        offsets = np.cumsum(lengths) - lengths
+        dense = np.repeat(offsets - ibin[first], np.diff(np.append(first, len(iset))))
+        dense = dense + ibin
+
+        ndense = int(lengths.sum())
+        dense_dx = np.zeros(ndense)
+        dense_dy = np.zeros(ndense)
+        dense_dx[dense] = sum_dx
+        dense_dy[dense] = sum_dy
+
+        # Moving sums within the bins of each set
+        low = np.repeat(offsets, lengths)
+        high = low + np.repeat(lengths, lengths) - 1
+        pos = np.arange(ndense)
+        half = window // 2
+        lo = np.maximum(pos - half, low)
+        hi = np.minimum(pos + window - 1 - half, high)
+        cum_dx = np.concatenate(([0.0], np.cumsum(dense_dx)))
+        cum_dy = np.concatenate(([0.0], np.cumsum(dense_dy)))
+        sum_dx = (cum_dx[hi + 1] - cum_dx[lo])[dense]
+        sum_dy = (cum_dy[hi + 1] - cum_dy[lo])[dense]
+
+    center = (ibin + bmin + 0.5) * bin_width
+    with np.errstate(divide="ignore", invalid="ignore"):
+        deriv = np.where(sum_dx != 0, sum_dy / sum_dx, np.nan)
+
+    return iset, center, deriv
+
+
+def segment_derivative(
+    infile, segments, xname, yname, loops, bin_width, window, chunk_rows, cache, relative
+):
+    """
+    Given a prepared Novonix data file, get the binned derivative of
+    the column yname with respect to the column xname for the selected
+    sets of measurements, see select_segments and binned_derivative.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the input Novonix file
+
+    segments : numpy structured array
+        Table of the sets of measurements, see file_segments
+
+    xname, yname : strings
+        Names of the columns
+
+    loops : range or list of integers
+        Loop numbers, None for any
+
+    bin_width : float
+        Width of the bins of the xname column
+
+    window : integer
+        Number of bins for the smoothing, 1 for none
+
+    chunk_rows : integer
+        Approximate number of data rows read at a time, None to read
+        the columns at once
+
+    cache : boolean
+        True to use the binary cache of the columns,
+        when reading them at once
+
+    relative : boolean
+        True to take the xname values with respect to
+        the first row of each set, in absolute value
+
+    Returns
+    --------
+    iset, center, deriv : arrays
+        Set of measurements, center of the bin and derivative
+
+    Examples
+    ---------
+    >>> import preparenovonix.novonix_variables as nv
+    >>> from preparenovonix.novonix_analysis import segment_derivative
+    >>> from preparenovonix.novonix_analysis import file_segments
+    >>> infile = 'example_data/example_data_prep.csv'
+    >>> segments = file_segments(infile,cache=False)
+    >>> iset, center, deriv = segment_derivative(infile,segments,
+    ...     nv.col_v,nv.col_c,None,0.01,1,None,False,False)
+    """
+
+    nf = novonix_file(infile)
+    isets = select_segments(segments, loops=loops)
+    starts = segments["start"][isets]
+    ends = segments["end"][isets]
+
+    # Groups of sets read together
+    if chunk_rows is None:
+        groups = [np.arange(len(isets))]
+    else:
+        groups = []
+        first = 0
+        for ii in range(1, len(isets) + 1):
+            if ii == len(isets) or ends[ii] - starts[first] + 1 > chunk_rows:
+                groups.append(np.arange(first, ii))
+                first = ii
+
+    if chunk_rows is None:
+        cols = read_columns(nf, [xname, yname], cache=cache)
+
+    results = []
+    for group in groups:
+        if len(group) < 1:
+            continue
+        row0 = starts[group[0]]
+        if chunk_rows is not None:
+            # Read only the rows spanned by the group
+            nrows = int(ends[group[-1]] - row0 + 1)
+            chunks = iter_data_chunks(nf, [xname, yname], nrows, first_row=int(row0))
+            row, offset, cols, chunk = next(chunks)
+            chunks.close()
+
+        # Rows of each set in the group
+        lengths = ends[group] - starts[group] + 1
+        sets = np.repeat(isets[group], lengths)
+        rows = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        rows = rows + np.repeat(starts[group] - row0 * (chunk_rows is not None), lengths)
+
+        x = cols[xname][rows]
+        y = cols[yname][rows]
+        if relative:
+            x = np.abs(x - np.repeat(x[np.cumsum(lengths) - lengths], lengths))
+        results.append(binned_derivative(x, y, sets, bin_width, window=window))
+
+    if not results:
+        return np.zeros(0, dtype=int), np.zeros(0), np.zeros(0)
+    iset, center, deriv = [np.concatenate(val) for val in zip(*results)]
+
+    return iset, center, deriv
+
+
+def derivative_table(segments, iset, center, deriv, names):
+    """
+    Build the table of a binned derivative, adding the Loop number,
+    Protocol line and Step Number of each set of measurements.
+    """
+
+    dtype = [
+        ("set", "i8"),
+        ("loop", "i8"),
+        ("line", "i8"),
+        ("step", "i8"),
+        (names[0], "f8"),
+        (names[1], "f8"),
+    ]
+    table = np.zeros(len(iset), dtype=dtype)
+    table["set"] = iset
+    for name in ["loop", "line", "step"]:
+        table[name] = segments[name][iset]
+    table[names[0]] = center
+    table[names[1]] = deriv
+
+    return table
+
+
+def dqdv(infile, loops=None, bin_width=0.005, window=1, chunk_rows=None, cache=True):
+    """
+    Given a prepared Novonix data file, get the differential capacity,
+    dQ/dV, of each set of measurements with current flowing, computing
+    all the sets at once over bins of Potential.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the input Novonix file
+
+    loops : range or list of integers
+        Loop numbers, None for any
+
+    bin_width : float
+        Width of the Potential bins (V)
+
+    window : integer
+        Number of bins for the smoothing, 1 for none
+
+    chunk_rows : integer
+        Approximate number of data rows read at a time, keeping the
+        memory use bounded for very large files. None to read the
+        columns at once.
+
+    cache : boolean
+        True to use the binary cache of the columns,
+        when reading them at once
+
+    Returns
+    --------
+    table : numpy structured array
+        One row per bin with data: set (position in the table of the
+        sets of measurements), loop, line, step, potential (bin center)
+        and dqdv (Ah/V)
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_analysis import dqdv
+    >>> table = dqdv('example_data/example_data_prep.csv',loops=range(1,2),cache=False)
+    >>> print(table['loop'].max())
+    1
+    """
+
+    nf = novonix_file(infile)
+    segments = file_segments(nf, cache=cache, chunk_rows=chunk_rows)
+    iset, center, deriv = segment_derivative(
+        nf, segments, nv.col_v, nv.col_c, loops, bin_width, window, chunk_rows, cache, False
+    )
+
+    return derivative_table(segments, iset, center, deriv, ["potential", "dqdv"])
+
+
+def dvdq(infile, loops=None, bin_width=0.001, window=1, chunk_rows=None, cache=True):
+    """
+    Given a prepared Novonix data file, get dV/dQ of each set of
+    measurements with current flowing, computing all the sets at once
+    over bins of the capacity charged or discharged within the set.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the input Novonix file
+
+    loops : range or list of integers
+        Loop numbers, None for any
+
+    bin_width : float
+        Width of the capacity bins (Ah)
+
+    window : integer
+        Number of bins for the smoothing, 1 for none
+
+    chunk_rows : integer
+        Approximate number of data rows read at a time, keeping the
+        memory use bounded for very large files. None to read the
+        columns at once.
+
+    cache : boolean
+        True to use the binary cache of the columns,
+        when reading them at once
+
+    Returns
+    --------
+    table : numpy structured array
+        One row per bin with data: set (position in the table of the
+        sets of measurements), loop, line, step, capacity (bin center,
+        from the start of the set) and dvdq (V/Ah)
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_analysis import dvdq
+    >>> table = dvdq('example_data/example_data_prep.csv',loops=[2],cache=False)
+    >>> print(table['loop'].min())
+    2
+    """
+
+    nf = novonix_file(infile)
+    segments = file_segments(nf, cache=cache, chunk_rows=chunk_rows)
+    iset, center, deriv = segment_derivative(
+        nf, segments, nv.col_c, nv.col_v, loops, bin_width, window, chunk_rows, cache, True
+    )
+
+    return derivative_table(segments, iset, center, deriv, ["capacity", "dvdq"])
+
+
+def resample_segments(
+    infile,
+    names=None,
+    npoints=100,
+    grid="time",
+    loops=None,
+    dtype="float64",
+    cache=True,
+):
+    """
+    Given a prepared Novonix data file, resample each set of
+    measurements with current flowing onto a uniform grid of npoints,
+    interpolating all the sets at once.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the input Novonix file
+
+    names : list of strings
+        Names of the columns to resample, None for the Potential,
+        Current, Capacity and Temperature (if present)
+
+    npoints : integer
+        Number of points of the grid of each set
+
+    grid : string
+        'time' for a grid uniform in Run Time or 'capacity' for a grid
+        uniform in the capacity charged or discharged within the set
+
+    loops : range or list of integers
+        Loop numbers, None for any
+
+    dtype : string
+        Type of the output arrays, 'float32' to halve their memory
+
+    cache : boolean
+        True to use the binary cache of the columns, see
+        novonix_io.read_columns
+
+    Returns
+    --------
+    isets : array of integers
+        Position in the table of the sets of measurements (see
+        file_segments) of each resampled set
+
+    data : dictionary of numpy arrays
+        Array of shape (len(isets), npoints) per column name
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_analysis import resample_segments
+    >>> isets, data = resample_segments('example_data/example_data_prep.csv',npoints=50,cache=False)
+    >>> print(data['Potential (V)'].shape == (len(isets), 50))
+    True
+    """
+
+    if grid == "time":
+        xname = nv.col_t
+    elif grid == "capacity":
+        xname = nv.col_c
+    else:
+        raise OptionError(
+            "grid should be 'time' or 'capacity', not " + str(grid),
+            where="novonix_analysis.resample_segments",
+        )
+
+    nf = novonix_file(infile)
+    if names is None:
+        names = [nv.col_v, nv.col_i, nv.col_c]
+        if nf.icolumn(nv.col_temp) > -1:
+            names.append(nv.col_temp)
+
+    segments = file_segments(nf, cache=cache)
+    isets = select_segments(segments, loops=loops)
+    nsets = len(isets)
+    if nsets < 1:
+        return isets, {name: np.zeros((0, npoints), dtype=dtype) for name in names}
+
+    cols = read_columns(nf, list(dict.fromkeys(names + [xname])), cache=cache)
+
+    # Rows of the selected sets, one after the other
+    starts = segments["start"][isets]
+    lengths = segments["end"][isets] - starts + 1
+    first = np.cumsum(lengths) - lengths
+    last = first + lengths - 1
+    rows = np.arange(lengths.sum()) + np.repeat(starts - first, lengths)
+    rank = np.repeat(np.arange(nsets), lengths)
+
+    # Position along each set, from 0 to 1, made non-decreasing
+    x = cols[xname][rows]
+    x = x - x[first][rank]
+    if grid == "capacity":
+        x = np.abs(x)
+    x = np.maximum(x, 0.0)
+    span = np.maximum.reduceat(x, first)
+    span[span <= 0] = 1.0
+    # Sets are kept apart by an offset of 2 per set
+    key = np.maximum.accumulate(2.0 * rank + x / span[rank])
+
+    # Bracketing rows of each grid point within its set
+    targets = (
+        2.0 * np.arange(nsets)[:, None] + np.linspace(0.0, 1.0, npoints)[None, :]
+    ).ravel()
+    lo = np.repeat(first, npoints)
+    hi = np.repeat(last, npoints)
+    pos = np.clip(np.searchsorted(key, targets, side="right") - 1, lo, hi)
+    nxt = np.minimum(pos + 1, hi)
+    dkey = key[nxt] - key[pos]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weight = np.where(dkey > 0, (targets - key[pos]) / dkey, 0.0)
+    weight = np.clip(weight, 0.0, 1.0).astype(dtype)
+
+    data = {}
+    for name in names:
+        yy = cols[name][rows]
+        ylo = yy[pos].astype(dtype)
+        yhi = yy[nxt].astype(dtype)
+        data[name] = (ylo + weight * (yhi - ylo)).reshape(nsets, npoints)
+
+    return isets, data
+
+
+def _run_starts(values):
+    """
+    Positions of the first element of each run of equal consecutive values.
+    """
+
+    values = np.asarray(values)
+    new = np.ones(len(values), dtype=bool)
+    new[1:] = values[1:] != values[:-1]
+    return np.flatnonzero(new)
@@ -1,7 +1,15 @@
-import sys
+import io
+import numpy as np
 import preparenovonix.novonix_variables as nv
+from preparenovonix.novonix_errors import ColumnError
 from preparenovonix.novonix_io import replace_file
-from preparenovonix.novonix_io import icolumn
+from preparenovonix.novonix_io import temporary_file
+from preparenovonix.novonix_io import novonix_file
+from preparenovonix.novonix_io import iter_data_chunks
+from preparenovonix.novonix_io import select_rows
+from preparenovonix.novonix_io import replace_column
+from preparenovonix.novonix_io import write_columns
+from preparenovonix.novonix_io import last_line_before
 
 
 summary = "[Summary]"
@@ -40,14 +48,14 @@ def count_tests(infile):
     return ntests
 
 
-def header_data_columns(head_line, data_cols, header):
+def header_data_columns(head_line, data_cols, header, infile=None):
     """
     Given a Novonix data file, compare the columns
     according to the data and the header.
     If there are more data columns than implied in the header,
     dummy colum names are added (dum#).
     If there are less data columns than implied in the header,
-    the program stops.
+    ColumnError is raised.
 
     Parameters
     -----------
@@ -60,6 +68,9 @@ def header_data_columns(head_line, data_cols, header):
     header: array of strings
         Header. If needed, this header will be modified.
 
+    infile : string
+        Name of the Novonix data file, for the messages
+
     Examples
     ---------
     >>> from preparenovonix.novonix_clean import header_data_columns
@@ -88,9 +99,10 @@ def header_data_columns(head_line, data_cols, header):
         header.append(new_head)
 
     elif diff < 0:
-        sys.exit(
-            "STOP novonix_clean.header_data_columns \n"
-            + "REASON less data columns than header names \n"
+        raise ColumnError(
+            "less data columns than header names",
+            infile=infile,
+            where="novonix_clean.header_data_columns",
         )
     else:
         header.append(head_line)
@@ -102,6 +114,8 @@ def capacity_failed_tests(icapacity, ntests, infile):
     """
     Given a Novonix data file, add up the last capacity
     measurement of each failed test in the file.
+    The last measurements are read backwards from the
+    start of each test, located with the index of the file.
 
     Parameters
     -----------
@@ -111,7 +125,7 @@ def capacity_failed_tests(icapacity, ntests, infile):
     ntests : int
         Number of tests in the file
 
-    infile : string
+    infile : string or NovonixFile
         Input file
 
     Returns
@@ -124,75 +138,109 @@ def capacity_failed_tests(icapacity, ntests, infile):
     Examples
     ---------
     >>> from preparenovonix.novonix_clean import capacity_failed_tests
-    >>> capacity_failed_tests(2,"example_data/example_data.csv")
+    >>> capacity_failed_tests(7,2,"example_data/example_data.csv")
     0.4956497995
     """
 
     last_capacity = 0.0
     if ntests > 1:
-        itest = 0
-        lastline = " "
-        with open(infile, "r") as ff:
-            for line in ff:
-                if line.strip():
-                    if summary in line:
-                        itest += 1
-
-                        if ntests > 1 and itest > 1:
-                            # Add last capacity of each failed test
-                            last_capacity = last_capacity + float(
-                                lastline.split(",")[icapacity]
-                            )
-                        if itest == ntests:
-                            return last_capacity
-                    lastline = line
+        nf = novonix_file(infile)
+        with open(nf.infile, "rb") as ff:
+            for offset in nf.sections["Summary"][1:ntests]:
+                # Add last capacity of each failed test
+                lastline = last_line_before(ff, offset).decode(nf.encoding)
+                last_capacity = last_capacity + float(lastline.split(",")[icapacity])
 
     return last_capacity
 
 
-def cleannovonix(infile):
+def clean_carry(infile):
     """
-    Given a Novonix file remove blank lines, correct the header,
-    remove failed tests if needed.
+    Given a Novonix data file, initialize the values carried over
+    from one chunk of data to the next one when cleaning the data.
 
     Parameters
     -----------
-    infile : string
+    infile : string or NovonixFile
         Name of the input Novonix file
 
-    Notes
-    -----
-    This code returns a cleaned Novonix file
+    Returns
+    --------
+    carry : dictionary
+        Initial values for clean_chunk: first_row (True until the first
+        data row is seen), last_t (last kept run time), icapacity
+        (capacity column), ntests (number of tests), last_capacity
+        (capacity to be added in case of failed tests) and nread and
+        nkept (number of data rows read and kept, counted by
+        novonix_prep.prepared_chunks).
 
     Examples
     ---------
-    >>> from preparenovonix.novonix_clean import cleannovonix
-    >>> cleannovonix('example_data/example_data.csv')
+    >>> from preparenovonix.novonix_clean import clean_carry
+    >>> carry = clean_carry('example_data/example_data.csv')
+    >>> print(carry['ntests'])
+    2
     """
 
-    # Count the number of tests
-    ntests = count_tests(infile)
+    nf = novonix_file(infile)
 
     # Find the capacity colum
-    icapacity = icolumn(infile, nv.col_c)
-    # Find the run time column
-    iruntime = icolumn(infile, nv.col_t)
+    icapacity = nf.icolumn(nv.col_c)
+
+    carry = {
+        "first_row": True,
+        "last_t": -1.0,
+        "icapacity": icapacity,
+        "ntests": nf.ntests,
+        "last_capacity": capacity_failed_tests(icapacity, nf.ntests, nf),
+        "nread": 0,
+        "nkept": 0,
+    }
 
-    # Deal with the capacity of the failed tests
-    last_capacity = capacity_failed_tests(icapacity, ntests, infile)
+    return carry
+
+
+def clean_header(infile):
+    """
+    Given a Novonix data file, get the header of its last test,
+    without blank lines and with as many column names as data columns.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the input Novonix file
+
+    Returns
+    --------
+    header : list of strings
+        Header lines, ending with the [Data] line and the column names
+
+    start : int
+        Byte offset of the first data row of the last test
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_clean import clean_header
+    >>> header, start = clean_header('example_data/example_data.csv')
+    >>> print(header[-2].strip())
+    [Data]
+    """
+
+    nf = novonix_file(infile)
+    ntests = nf.ntests
 
     # Start reading the last test
     # Remove blank lines if present in the header
-    itest = 0
     header = []
-    with open(infile, "r") as ff:
+    with open(nf.infile, "rb") as fb:
+        if ntests > 0:
+            fb.seek(nf.sections["Summary"][ntests - 1])
+        ff = io.TextIOWrapper(fb, encoding=nf.encoding)
         for line in ff:
             if line.strip():
                 if summary in line:
-                    itest += 1
-                    if itest == ntests:
-                        header.append(summary + " \n")
-                        break
+                    header.append(summary + " \n")
+                    break
 
         # Read until the line with [Data]
         for line in ff:
@@ -214,49 +262,256 @@ def cleannovonix(infile):
         # Check that the number of data columns matches the header
         line_data1 = ff.readline()
         data = line_data1.split(",")
-        header_data_columns(line, data, header)
-
-        # Create a temporary file without blanck lines
-        # and new header if needed
-        tmp_file = "tmp.csv"
-        with open(tmp_file, "w") as tf:
-            for item in header:
-                tf.write(str(item))
-
-        # Append the data jumping any line with time going backwards
-        with open(tmp_file, "a") as tf:
-            # Write the first data row
-            if ntests > 1:
-                # Modify the Capacity column in case of failed tests
-                new_capacity = float(data[icapacity]) + float(last_capacity)
-                data[icapacity] = str(new_capacity)
-
-                new_line = data[0]
-                for col in data[1:]:
-                    new_line = new_line + "," + col
-                tf.write(new_line)
-            else:
-                tf.write(line_data1)
-
-            # Write the rest of the data
-            last_t = -1.0
-            for line in ff:
-                columns = line.split(",")
-                if float(columns[iruntime]) < last_t:
-                    continue
-                last_t = float(columns[iruntime])
-
-                if ntests > 1:
-                    # Modify the Capacity column in case of failed tests
-                    new_capacity = float(columns[icapacity]) + float(last_capacity)
-                    columns[icapacity] = str(new_capacity)
-
-                    new_line = columns[0]
-                    for col in columns[1:]:
-                        new_line = new_line + "," + col
-                    tf.write(new_line)
-                else:
-                    tf.write(line)
+        header_data_columns(line, data, header, infile=nf.infile)
+
+    # Byte offset of the first data row of the last test
+    with open(nf.infile, "rb") as ff:
+        ff.seek(nf.sections["Data"][-1])
+        ff.readline()
+        for bline in ff:
+            if bline.strip():
+                break
+        start = ff.tell()
+
+    return header, start
+
+
+def clean_mask(runtime, carry):
+    """
+    Given the run time of a chunk of data rows, find the rows to be kept:
+    those without the time going backwards. The first data row
+    is always kept.
+
+    Parameters
+    -----------
+    runtime : array of floats
+        Run time of each row
+
+    carry : dictionary
+        Values carried over from previous chunks, as returned by
+        clean_carry. first_row and last_t are updated.
+
+    Returns
+    --------
+    keep : array of booleans
+        True for the rows to be kept
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_clean import clean_mask
+    >>> carry = {'first_row':True,'last_t':-1.}
+    >>> print(clean_mask([3.,1.,2.,1.5],carry))
+    [ True  True  True False]
+    """
+
+    runtime = np.asarray(runtime, dtype=float)
+    keep = np.ones(len(runtime), dtype=bool)
+    if len(runtime) < 1:
+        return keep
+
+    # The first data row does not set the time
+    times = runtime
+    if carry["first_row"]:
+        carry["first_row"] = False
+        times = runtime[1:]
+
+    if np.isnan(times).any() or np.isnan(carry["last_t"]):
+        # Comparisons with NaN, row by row
+        last_t = carry["last_t"]
+        for ii, t in enumerate(times, start=len(runtime) - len(times)):
+            if t < last_t:
+                keep[ii] = False
+                continue
+            last_t = t
+        carry["last_t"] = last_t
+        return keep
+
+    # Rows with a time below the maximum of the previous ones are dropped
+    last_t = np.maximum.accumulate(np.concatenate(([carry["last_t"]], times)))
+    keep[len(runtime) - len(times) :] = times >= last_t[:-1]
+    carry["last_t"] = float(last_t[-1])
+
+    return keep
+
+
+def clean_block(block, keep, capacity, carry):
+    r"""
+    Given a chunk of data rows, select the rows to be kept and,
+    in case of failed tests, add to the capacity
+    the last capacity of the failed tests.
+    The rest of the text of the rows is kept as it is.
+
+    Parameters
+    -----------
+    block : bytes
+        Data rows, as in the file
+
+    keep : array of booleans
+        True for the rows to be kept
+
+    capacity : array of floats
+        Capacity of each row
+
+    carry : dictionary
+        Values carried over from previous chunks, as returned by
+        clean_carry.
+
+    Returns
+    --------
+    new_block : bytes
+        Cleaned data rows
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_clean import clean_block
+    >>> carry = {'icapacity':2,'ntests':2,'last_capacity':1.}
+    >>> clean_block(b'a,1,0.1,x\nb,0.5,0.2,y\n',[True,False],[0.1,0.2],carry)
+    b'a,1,1.1,x\n'
+    """
+
+    # As read in text mode
+    if b"\r\n" in block:
+        block = block.replace(b"\r\n", b"\n")
+
+    keep = np.asarray(keep, dtype=bool)
+    new_block = select_rows(block, keep)
+
+    if carry["ntests"] > 1:
+        # Modify the Capacity column in case of failed tests
+        new_capacity = np.asarray(capacity, dtype=float)[keep] + float(
+            carry["last_capacity"]
+        )
+        new_block = replace_column(new_block, carry["icapacity"], new_capacity)
+
+    return new_block
+
+
+def clean_chunk(block, runtime, capacity, carry):
+    r"""
+    Given a chunk of data rows, remove those with the run time
+    going backwards and, in case of failed tests, add to the capacity
+    the last capacity of the failed tests.
+
+    Parameters
+    -----------
+    block : bytes
+        Data rows, as in the file
+
+    runtime : array of floats
+        Run time of each row
+
+    capacity : array of floats
+        Capacity of each row
+
+    carry : dictionary
+        Values carried over from previous chunks, as returned by
+        clean_carry, which are updated by this function.
+
+    Returns
+    --------
+    new_block : bytes
+        Cleaned data rows
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_clean import clean_chunk
+    >>> carry = {'first_row':False,'last_t':-1.,'icapacity':2,'ntests':1,'last_capacity':0.}
+    >>> clean_chunk(b'a,1,0.1\nb,0.5,0.2\n',[1.,0.5],[0.1,0.2],carry)
+    b'a,1,0.1\n'
+    """
+
+    keep = clean_mask(runtime, carry)
+    new_block = clean_block(block, keep, capacity, carry)
+
+    return new_block
+
+
+def clean_blocks(infile, start, carry, chunk_rows=None):
+    r"""
+    Given a Novonix data file, clean its data rows by chunks.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the input Novonix file
+
+    start : int
+        Byte offset of the first data row to be read, from clean_header
+
+    carry : dictionary
+        Values carried over between chunks, as returned by clean_carry
+
+    chunk_rows : integer
+        Number of data rows processed at a time,
+        None to process all the data at once
+
+    Returns
+    --------
+    block : bytes
+        Cleaned data rows (generated)
+
+    columns : None
+        No new columns (generated)
+
+    keep : None
+        All the rows are written (generated)
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_clean import clean_header, clean_carry, clean_blocks
+    >>> infile = 'example_data/example_data.csv'
+    >>> header, start = clean_header(infile)
+    >>> for block, columns, keep in clean_blocks(infile,start,clean_carry(infile)):
+    ...     print(block.count(b"\n"))
+    5753
+    """
+
+    nf = novonix_file(infile)
+    if start >= nf.size:
+        return
+
+    chunks = iter_data_chunks(nf, [nv.col_t, nv.col_c], chunk_rows, start=start)
+    for row, offset, columns, chunk in chunks:
+        block = clean_chunk(chunk, columns[nv.col_t], columns[nv.col_c], carry)
+        yield block, None, None
+
+
+def cleannovonix(infile, chunk_rows=None):
+    """
+    Given a Novonix file remove blank lines, correct the header,
+    remove failed tests if needed.
+
+    Parameters
+    -----------
+    infile : string
+        Name of the input Novonix file
+
+    chunk_rows : integer
+        Number of data rows processed at a time,
+        None to process all the data at once
+
+    Notes
+    -----
+    This code returns a cleaned Novonix file
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_clean import cleannovonix
+    >>> cleannovonix('example_data/example_data.csv')
+    """
+
+    # Index the header of the file
+    nf = novonix_file(infile)
+
+    # Header of the last test, without blank lines
+    header, start = clean_header(nf)
+
+    # Create a temporary file without blanck lines
+    # and new header if needed, jumping any line with time going backwards
+    with temporary_file(infile) as tmp_file:
+        carry = clean_carry(nf)
+        blocks = clean_blocks(nf, start, carry, chunk_rows=chunk_rows)
+        write_columns(tmp_file, header, blocks, encoding=nf.encoding)
 
         # Replace the input file with the new one
         replace_file(tmp_file, infile, newbigger=False)
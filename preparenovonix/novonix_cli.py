@@ -0,0 +1,329 @@
+import sys
+import glob
+import os.path
+import argparse
+from preparenovonix.novonix_io import after_file_name
+from preparenovonix.novonix_errors import NovonixError
+from preparenovonix.novonix_prep import prepare_many
+from preparenovonix.novonix_watch import watch_folder
+
+
+def expand_files(patterns):
+    """
+    Given file names or glob patterns, get the list of input files,
+    leaving out the '_prep' files of other files in the list.
+
+    Parameters
+    -----------
+    patterns : list of strings
+        File names or glob patterns (for shells not expanding them)
+
+    Returns
+    --------
+    files : list of strings
+        Names of the input files, without repetitions
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_cli import expand_files
+    >>> print(expand_files(['example_data/example_data*.csv']))
+    ['example_data/example_data.csv']
+    """
+
+    files = []
+    seen = set()
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            names = sorted(glob.glob(pattern))
+        else:
+            names = [pattern]
+        for ff in names:
+            if ff not in seen:
+                seen.add(ff)
+                files.append(ff)
+
+    outputs = set(after_file_name(ff) for ff in files)
+    return [ff for ff in files if os.path.abspath(ff) not in outputs]
+
+
+def parse_args(argv=None):
+    """
+    Parse the command line arguments.
+
+    Parameters
+    -----------
+    argv : list of strings
+        Arguments, None for sys.argv[1:]
+
+    Returns
+    --------
+    args : argparse.Namespace
+        Parsed arguments
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_cli import parse_args
+    >>> args = parse_args(['prepare','a.csv','--jobs','4','--no-state'])
+    >>> print(args.jobs, args.addstate)
+    4 False
+    """
+
+    parser = argparse.ArgumentParser(
+        prog="preparenovonix",
+        description="Clean and add extra information to Novonix data files.",
+    )
+    commands = parser.add_subparsers(dest="command")
+
+    prep = commands.add_parser(
+        "prepare",
+        help="Prepare Novonix data files",
+        description="Prepare Novonix data files, several at a time.",
+    )
+    prep.add_argument("files", nargs="+", help="Files or glob patterns")
+    prep.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of processes (default: number of cores)",
+    )
+    prep.add_argument(
+        "--no-state",
+        dest="addstate",
+        action="store_false",
+        help="Do not add the State column",
+    )
+    prep.add_argument(
+        "--no-protocol",
+        dest="lprotocol",
+        action="store_false",
+        help="Do not add the reduced protocol and the columns "
+        + "Protocol line and Loop number",
+    )
+    prep.add_argument(
+        "--segments",
+        action="store_true",
+        help="Save the table of the sets of measurements "
+        + "in the cache directory of the '_prep' files",
+    )
+    prep.add_argument(
+        "--out-dir",
+        default=None,
+        help="Directory for the '_prep' files (default: that of each file)",
+    )
+    prep.add_argument(
+        "--overwrite", action="store_true", help="Overwrite the input files"
+    )
+    prep.add_argument(
+        "--force",
+        action="store_true",
+        help="Prepare also the files with a '_prep' file newer than them",
+    )
+    prep.add_argument(
+        "--append",
+        action="store_true",
+        help="Keep a checkpoint and, for files still being written, "
+        + "prepare only the rows appended since the last call",
+    )
+    prep.add_argument(
+        "--manifest",
+        default=None,
+        help="Manifest of prepared files (JSON lines); the files unchanged "
+        + "since they were recorded in it are skipped",
+    )
+    prep.add_argument(
+        "--chunk-rows",
+        type=int,
+        default=None,
+        help="Number of data rows processed at a time",
+    )
+    prep.add_argument("-v", "--verbose", action="store_true")
+
+    watch = commands.add_parser(
+        "watch",
+        help="Prepare the Novonix data files landing in a directory",
+        description="Watch a directory and prepare the Novonix data files "
+        + "landing in it, and the rows appended to them as they grow.",
+    )
+    watch.add_argument("inbox", help="Directory to be watched")
+    watch.add_argument(
+        "--out",
+        dest="out_dir",
+        default=None,
+        help="Directory for the '_prep' files (default: the watched one)",
+    )
+    watch.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of processes (default: number of cores)",
+    )
+    watch.add_argument(
+        "--queue",
+        type=int,
+        default=None,
+        help="Maximum number of files handed to the processes at a time "
+        + "(default: twice the number of workers)",
+    )
+    watch.add_argument(
+        "--interval",
+        type=float,
+        default=1.0,
+        help="Maximum number of seconds between scans of the directory",
+    )
+    watch.add_argument(
+        "--settle",
+        type=float,
+        default=2.0,
+        help="Seconds a file has to remain unchanged before preparing it",
+    )
+    watch.add_argument(
+        "--status",
+        default=None,
+        help="JSON file where the counters (queue depth, files/sec, "
+        + "bytes/sec, ...) are written after each scan",
+    )
+    watch.add_argument(
+        "--no-state",
+        dest="addstate",
+        action="store_false",
+        help="Do not add the State column",
+    )
+    watch.add_argument(
+        "--no-protocol",
+        dest="lprotocol",
+        action="store_false",
+        help="Do not add the reduced protocol and the columns "
+        + "Protocol line and Loop number",
+    )
+    watch.add_argument(
+        "--segments",
+        action="store_true",
+        help="Save the table of the sets of measurements "
+        + "in the cache directory of the '_prep' files",
+    )
+    watch.add_argument(
+        "--manifest",
+        default=None,
+        help="Manifest of prepared files (JSON lines)",
+    )
+    watch.add_argument(
+        "--chunk-rows",
+        type=int,
+        default=None,
+        help="Number of data rows processed at a time",
+    )
+    watch.add_argument(
+        "--max-cycles",
+        type=int,
+        default=None,
+        help="Stop after this number of scans (default: run until interrupted)",
+    )
+    watch.add_argument("-v", "--verbose", action="store_true")
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.error("a command is required: prepare or watch")
+    return args
+
+
+def main(argv=None):
+    """
+    Command line entry point: preparenovonix prepare FILES [options]
+    or preparenovonix watch INBOX [options].
+    The package is imported once and the files are handed out to a
+    pool of processes, see novonix_prep.prepare_many and
+    novonix_watch.watch_folder.
+
+    Parameters
+    -----------
+    argv : list of strings
+        Arguments, None for sys.argv[1:]
+
+    Returns
+    --------
+    status : integer
+        0 if all the files were prepared or skipped, 1 otherwise
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_cli import main
+    >>> status = main(['prepare','example_data/*.csv','--jobs','2'])  # doctest: +SKIP
+    """
+
+    args = parse_args(argv)
+
+    if args.command == "watch":
+        try:
+            counters = watch_folder(
+                args.inbox,
+                outdir=args.out_dir,
+                workers=args.workers,
+                addstate=args.addstate,
+                lprotocol=args.lprotocol,
+                chunk_rows=args.chunk_rows,
+                manifest=args.manifest,
+                interval=args.interval,
+                settle=args.settle,
+                queue_size=args.queue,
+                status=args.status,
+                max_cycles=args.max_cycles,
+                verbose=args.verbose,
+                segments=args.segments,
+            )
+        except NovonixError as err:
+            print(str(err).strip(), file=sys.stderr)
+            return 1
+        print(
+            "{} prepared, {} skipped, {} failed, {} not Novonix files".format(
+                counters["prepared"],
+                counters["skipped"],
+                counters["failed"],
+                counters["rejected"],
+            )
+        )
+        return int(counters["failed"] > 0)
+
+    files = expand_files(args.files)
+    if not files:
+        print("No files to prepare", file=sys.stderr)
+        return 1
+
+    if args.out_dir is not None:
+        os.makedirs(args.out_dir, exist_ok=True)
+
+    records = prepare_many(
+        files,
+        jobs=args.jobs,
+        addstate=args.addstate,
+        lprotocol=args.lprotocol,
+        overwrite=args.overwrite,
+        verbose=args.verbose,
+        chunk_rows=args.chunk_rows,
+        outdir=args.out_dir,
+        skip_prepared=not args.force,
+        manifest=args.manifest,
+        append=args.append,
+        segments=args.segments,
+    )
+
+    counts = {"prepared": 0, "skipped": 0, "failed": 0}
+    for record in records:
+        counts[record["status"]] += 1
+        if record["status"] == "failed":
+            print(
+                "Failed {}: {}".format(record["file"], record["error"].strip()),
+                file=sys.stderr,
+            )
+    print(
+        "{} prepared, {} skipped (already prepared or unchanged), {} failed".format(
+            counts["prepared"], counts["skipped"], counts["failed"]
+        )
+    )
+
+    return int(counts["failed"] > 0)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+import sys
+import functools
+
+
+class NovonixError(Exception):
+    """
+    Problem found handling a Novonix data file. The message keeps
+    the format of the STOP messages of previous versions.
+
+    Parameters
+    -----------
+    reason : string
+        Description of the problem
+
+    infile : string or NovonixFile
+        Name of the file, None if not known
+
+    line : integer
+        Header line where the problem was found, None if not known
+
+    where : string
+        Function where the problem was found
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_errors import NovonixError
+    >>> err = NovonixError('bad file','a.csv',where='novonix_io.novonix_file')
+    >>> print(err.infile, err.reason)
+    a.csv bad file
+    """
+
+    def __init__(self, reason, infile=None, line=None, where=None):
+        # The name of the file, also if given its header index
+        infile = getattr(infile, "infile", infile)
+        self.reason = str(reason)
+        self.infile = None if infile is None else str(infile)
+        self.line = line
+        self.where = where
+        super().__init__(self.reason)
+
+    def __reduce__(self):
+        # Keep all the attributes when sent from a worker process
+        return (self.__class__, (self.reason, self.infile, self.line, self.where))
+
+    def __str__(self):
+        msg = "STOP "
+        if self.where is not None:
+            msg = msg + self.where + " \n"
+        if self.line is not None:
+            msg = msg + "    at header line: " + str(self.line) + " \n"
+        msg = msg + "REASON " + self.reason + " \n"
+        if self.infile is not None:
+            msg = msg + "       " + self.infile + " \n"
+        return msg
+
+
+class NotNovonixError(NovonixError):
+    """
+    The file does not exist or does not look like a Novonix data file.
+    """
+
+
+class ColumnError(NovonixError):
+    """
+    Column not found, or less data columns than expected.
+    """
+
+
+class StateMismatchError(NovonixError):
+    """
+    The State column does not have the expected number of
+    starts (0) and ends (2) of the sets of measurements.
+    """
+
+
+class ProtocolSyntaxError(NovonixError):
+    """
+    The protocol or the reduced protocol in the header can not be read.
+    """
+
+
+class OutputError(NovonixError):
+    """
+    The prepared file is not as expected, for example smaller than
+    the input one.
+    """
+
+
+class OptionError(NovonixError, ValueError):
+    """
+    Invalid combination or value of the parameters.
+    """
+
+
+def exit_on_error(func):
+    """
+    Wrap a function so that a NovonixError stops the program with
+    its message, as in previous versions of the package.
+
+    Parameters
+    -----------
+    func : function
+        Function to be wrapped
+
+    Returns
+    --------
+    wrapper : function
+        Function with the same parameters, raising SystemExit
+        instead of NovonixError
+
+    Examples
+    ---------
+    >>> import preparenovonix.novonix_prep as prep
+    >>> from preparenovonix.novonix_errors import exit_on_error
+    >>> prepare_novonix = exit_on_error(prep.prepare_novonix)
+    >>> nread, nkept = prepare_novonix('example_data/example_data.csv',addstate=True,lprotocol=True)  # doctest: +SKIP
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except NovonixError as err:
+            sys.exit(str(err))
+
+    return wrapper
@@ -1,326 +1,2522 @@
-import sys, os.path
+import os.path
+import locale, mmap, re, warnings
+import errno, hashlib, json
 import numpy as np
-from shutil import move, copy
+from contextlib import contextmanager
+from itertools import compress
+from shutil import move, copy, copymode, rmtree
 import preparenovonix.novonix_variables as nv
+from preparenovonix.novonix_errors import NotNovonixError
+from preparenovonix.novonix_errors import ColumnError
+from preparenovonix.novonix_errors import OutputError
 
+# Size of the blocks, in bytes, used to read large files
+blocksize = 2 ** 24
 
-def after_file_name(file_to_open):
+# Number of data rows between the offsets kept in the file index
+index_rows = 10000
+
+# Characters used to separate values
+comma = ord(",")
+blank = ord(" ")
+newline = ord("\n")
+
+
+def after_file_name(file_to_open, outdir=None):
+    """
+    Given a file name return as:
+    [file_to_open root]_prep.[file-to_open_ending]
+
+    Parameters
+    ----------
+    file_to_open : string
+        Name of the input file.
+
+    outdir : string
+        Directory of the new file, None for that of the input file.
+
+    Returns
+    --------
+    after_file : string
+        Full path to the (new) file.
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import after_file_name
+    >>> after_file_name('example_data/example_data.csv')
+    """
+
+    # Extract the path and file name
+    dirname, fname = os.path.split(os.path.abspath(file_to_open))
+
+    root = fname.split(".")[0]
+    ending = fname.split(".")[1]
+    fname = root + "_prep." + ending
+    if outdir is not None:
+        dirname = os.path.abspath(outdir)
+    after_file = os.path.join(dirname, fname)
+
+    return after_file
+
+
+def get_infile(file_to_open, overwrite=False):
+    """
+    Given a file name return it after dealing
+    with possible issues with the path  and 
+    copy it if the overwrite flag is set to True.
+
+    Parameters
+    ----------
+    infile_name : string
+        Name of the input file.
+
+    overwrite: boolean
+        Yes : overwrite the input file
+        No  : a new file will be created, appending '_prep' at the end of the
+              original file file
+
+    Returns
+    --------
+    infile : string
+        Path to the (new) file.
+
+    fname : string
+        File name withouth the path.
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import get_infile
+    >>> get_infile('example_data/example_data.csv',overwrite=False)
+    """
+
+    # Extract the path and file name
+    dirname, fname = os.path.split(os.path.abspath(file_to_open))
+
+    if overwrite:
+        infile = os.path.join(dirname, fname)
+    else:
+        infile = after_file_name(file_to_open)
+        # If *prep* file already exists, it will be replaced.
+        copy(file_to_open, infile)
+
+    return infile, fname
+
+
+class NovonixFile:
+    """
+    Index of the header of a Novonix data file, built with a single
+    pass over the header lines. The sections of the file
+    ([Summary], [Protocol], [Reduced Protocol] and [Data]) are
+    located, only when needed, with a fast scan over the whole file.
+
+    All the novonix_io functions accepting the name of a Novonix
+    data file also accept a NovonixFile. Note that the index refers
+    to the file as it was when the index was built.
+
+    Parameters
+    -----------
+    infile : string
+        Name of the input Novonix data file
+
+    Attributes
+    -----------
+    infile : string
+        Name of the input Novonix data file
+
+    isnovonix : boolean
+        True when the file seems to be a Novonix data file
+
+    reason : string
+        Explanation of why the file is not a Novonix data file
+
+    error : NotNovonixError
+        Error with the reason, None for a Novonix data file
+
+    col_names : list
+        Names of the columns in the file
+
+    icols : dictionary
+        Position of each column, with the casefolded names as keys
+
+    data_start : integer
+        Byte offset of the first data row in the file
+
+    size : integer
+        Size of the file in bytes
+
+    mtime : integer
+        Modification time of the file in nanoseconds
+
+    encoding : string
+        Encoding used to read the text in the file
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import NovonixFile
+    >>> nf = NovonixFile('example_data/example_data.csv')
+    >>> print(nf.icolumn('Step Number'), nf.ntests)
+    2 2
+    """
+
+    # Header sections that are indexed
+    section_names = ["Summary", "Protocol", "Reduced Protocol", "Data"]
+
+    def __init__(self, infile):
+        self.infile = infile
+        self.isnovonix = True
+        self.reason = ""
+        self.error = None
+        self.col_names = []
+        self.icols = {}
+        self.data_start = -1
+        self.size = 0
+        self.mtime = 0
+        self.encoding = locale.getpreferredencoding(False)
+        self._header_sections = None
+        self._sections = None
+
+        # Test if the file exists
+        if not os.path.isfile(infile):
+            self._not_novonix("Input file not found")
+            return
+
+        stat = os.stat(infile)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+
+        self._read_header()
+
+    def _not_novonix(self, reason):
+        self.isnovonix = False
+        self.error = NotNovonixError(
+            reason, infile=self.infile, where="novonix_io.isnovonix"
+        )
+        self.reason = str(self.error)
+
+    def _read_header(self):
+        """
+        Read the header once, checking that it looks like a Novonix data
+        file, allowing for blank lines and commas after the commands
+        due to having open the file in Excel.
+        """
+
+        encoding = self.encoding
+        keyws = ["Summary", "Novonix", "Protocol", "Data"]
+        ikeyw = 0
+        last_line = None
+        col_line = None
+        after_data = False
+        sections = {name: [] for name in self.section_names}
+
+        offset = 0
+        with open(self.infile, "rb") as ff:
+            for bline in ff:
+                line = bline.decode(encoding, errors="replace")
+                line_offset = offset
+                offset += len(bline)
+
+                for name in self.section_names:
+                    if "[" + name + "]" in line:
+                        sections[name].append(line_offset)
+
+                # The column names follow the first [Data] line
+                if after_data:
+                    col_line = line
+                    after_data = False
+                elif col_line is None and "[Data]" in line:
+                    after_data = True
+
+                if not line.strip():
+                    continue
+
+                char1 = line.strip()[0]
+                if char1 in nv.numberstr:
+                    if ikeyw < len(keyws):
+                        self._not_novonix(
+                            "Reached the end of the input file without the "
+                            + keyws[ikeyw]
+                            + " entry"
+                        )
+                        return
+                    # The data starts
+                    self.data_start = line_offset
+                    break
+
+                if ikeyw < len(keyws):
+                    # Read until different header statement
+                    if keyws[ikeyw] in line:
+                        ikeyw += 1
+                else:
+                    last_line = line.strip()
+
+        self._header_sections = sections
+
+        if col_line is not None:
+            for coln1 in col_line.split(","):
+                coln = coln1.replace("\n", "").replace("\r", "").strip()
+                self.col_names.append(coln)
+            for ii, coln in enumerate(self.col_names):
+                self.icols.setdefault(coln.casefold(), ii)
+
+        if last_line is None:
+            self._not_novonix("No data header found in input file")
+            return
+
+        # From the data header, read the column names
+        colnames = [x.strip() for x in last_line.split(",")]
+
+        # Check the existance of the "Step Number" column
+        if nv.col_step not in colnames:
+            self._not_novonix('No "Step Number" column found in input file')
+            return
+
+        # Check the existance of the "Step time" column
+        if nv.col_tstep not in colnames:
+            self._not_novonix('No "Step Time" column found in input file')
+            return
+
+    @property
+    def sections(self):
+        """
+        Byte offsets of the lines starting each header section,
+        with one entry per test in the file.
+        """
+
+        if self._sections is None:
+            index = read_index(self)
+            if index is None:
+                self._sections = self._scan_sections()
+            else:
+                self._sections = index["sections"]
+        return self._sections
+
+    @property
+    def ntests(self):
+        """
+        Number of tests in the file, given by the number of [Summary] lines.
+        """
+
+        return len(self.sections["Summary"])
+
+    def _scan_sections(self):
+        """
+        Find the sections beyond the first header with a
+        single scan over the rest of the file.
+        """
+
+        sections = {}
+        for name in self.section_names:
+            sections[name] = list(self._header_sections[name])
+
+        if self.data_start < 0 or self.data_start >= self.size:
+            return sections
+
+        pattern = re.compile(
+            rb"\[(" + "|".join(self.section_names).encode() + rb")\]"
+        )
+        with open(self.infile, "rb") as ff:
+            with mmap.mmap(ff.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                last = {}
+                for match in pattern.finditer(mm, self.data_start):
+                    name = match.group(1).decode()
+                    start = mm.rfind(b"\n", 0, match.start()) + 1
+                    if last.get(name) != start:
+                        sections[name].append(start)
+                        last[name] = start
+        return sections
+
+    def icolumn(self, column_name):
+        """
+        Position of the column with name 'column_name' or -1 if not found.
+        """
+
+        return self.icols.get(column_name.casefold(), -1)
+
+
+def novonix_file(infile):
+    """
+    Given a Novonix data file, return its header index,
+    raising NotNovonixError if the file is not a Novonix data file.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the input Novonix data file or its header index
+
+    Returns
+    --------
+    nf : NovonixFile
+        Header index of the file
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import novonix_file
+    >>> nf = novonix_file('example_data/example_data.csv')
+    >>> print(nf.col_names[2])
+    Step Number
+    """
+
+    if isinstance(infile, NovonixFile):
+        nf = infile
+    else:
+        nf = NovonixFile(infile)
+
+    # Check if the file has the expected structure for a Novonix data file
+    if not nf.isnovonix:
+        raise NotNovonixError(nf.error.reason, infile=nf.infile, where=nf.error.where)
+
+    return nf
+
+
+def isnovonix(infile):
+    """
+    Given a data file, check if it exists and
+    if looks like a Novonix data file, allowing for blank lines
+    and commas after the commands due to having open the file in Excel
+
+    Parameters
+    ----------
+    infile : string or NovonixFile
+        Name of the input Novonix data file
+
+    Returns
+    --------
+    answer : boolean
+        Yes=the file seems to be a Novonix data file
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import isnovonix
+    >>> isnovonix('example_data/example_data.csv')
+    True
+    """
+
+    if isinstance(infile, NovonixFile):
+        nf = infile
+    else:
+        nf = NovonixFile(infile)
+
+    answer = nf.isnovonix
+    if not answer:
+        print(nf.reason)
+
+    return answer
+
+
+def icolumn(infile, column_name):
+    """
+    Given a Novonix data file, find the column position of the
+    given column_name
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the input Novonix data file
+
+    column_name : string
+        Name of the column name to find
+
+    icolumn : integer
+        icolumn = -1 : the column has not been found.
+        If icolumn > -1: icolumn is the index of the column.
+
+    Returns
+    --------
+    icol : integer
+       Position of the column with name 'column_name',
+       in the range form 0 to the number of columns - 1
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import icolumn
+    >>> icolumn('example_data/example_data.csv','Step Number')
+    2
+    """
+
+    nf = novonix_file(infile)
+
+    return nf.icolumn(column_name)
+
+
+def read_column(infile, column_name, outtype="float", cache=False):
+    """
+    Given a Novonix data file, read a column as an array of the
+    type given in the variable astype.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the input Novonix data file
+
+    column_name : string
+        Name of the column to be read
+
+    outtype : string
+        Type of data of the column to be read
+
+    cache : boolean
+        True to use the binary cache of the columns, see read_columns
+
+    Returns
+    --------
+    column_data : numpy array of the given type
+        Column of interest read as a str
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import read_column
+    >>> col = read_column('example_data/example_data_prep.csv',
+    'Step Number',outtype='int')
+    >>> print(col[0])
+    0
+    """
+
+    column = read_columns(infile, [column_name], outtype, cache=cache)[column_name]
+
+    return column
+
+
+def read_columns(infile, names, dtypes="float", cache=False):
+    """
+    Given a Novonix data file, read several columns at once,
+    splitting each data row only once.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the input Novonix data file
+
+    names : list of strings
+        Names of the columns to be read
+
+    dtypes : string or list of strings
+        Type of data of the columns to be read, either one for all
+        the columns or one per column
+
+    cache : boolean
+        True to keep the columns in binary files next to the input file,
+        see cache_dir. Cached columns are returned as read-only memory
+        maps and the cache is rebuilt when the input file changes.
+
+    Returns
+    --------
+    columns : dictionary
+        Numpy arrays of the given types, with the column names as keys
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import read_columns
+    >>> cols = read_columns('example_data/example_data_prep.csv',
+    ... ['Step Number','Run Time (h)'],dtypes=['int','float'])
+    >>> print(cols['Step Number'][0])
+    0
+    """
+
+    nf = novonix_file(infile)
+
+    if isinstance(dtypes, str):
+        dtypes = [dtypes] * len(names)
+
+    icols = column_positions(nf, names)
+
+    if cache:
+        values = read_cached_columns(nf, icols, dtypes)
+    else:
+        values = parse_columns(nf, icols, dtypes)
+
+    columns = {}
+    for column_name, val in zip(names, values):
+        columns[column_name] = val
+
+    return columns
+
+
+def column_positions(infile, names):
+    """
+    Given a Novonix data file, find the position of the given columns,
+    raising ColumnError if any of them is not found.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the input Novonix data file
+
+    names : list of strings
+        Names of the columns
+
+    Returns
+    --------
+    icols : list of integers
+        Position of each column
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import column_positions
+    >>> column_positions('example_data/example_data_prep.csv',['Step Number'])
+    [2]
+    """
+
+    nf = novonix_file(infile)
+
+    icols = []
+    for column_name in names:
+        icol = nf.icolumn(column_name)
+        if icol < 0:
+            raise ColumnError(
+                column_name + " column not found",
+                infile=nf.infile,
+                where="novonix_io.column_positions",
+            )
+        icols.append(icol)
+
+    return icols
+
+
+def iter_data_chunks(
+    infile,
+    names,
+    chunk_rows=100000,
+    dtypes="float",
+    start=None,
+    first_row=0,
+    size=blocksize,
+    end=None,
+):
+    """
+    Given a Novonix data file, read the data section in chunks
+    of a fixed number of rows, keeping in memory only one chunk
+    at a time.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the input Novonix data file
+
+    names : list of strings
+        Names of the columns to be read
+
+    chunk_rows : integer
+        Number of data rows per chunk,
+        None to read all the rows as a single chunk
+
+    dtypes : string or list of strings
+        Type of data of the columns to be read, either one for all
+        the columns or one per column
+
+    start : integer
+        Byte offset of a data row to start reading from,
+        by default the start of the data
+
+    first_row : integer
+        Row number of the row at start. When start is not given,
+        the reading starts at this data row, found with the file index.
+
+    size : integer
+        Approximate size in bytes of the blocks read from the file.
+        Together with chunk_rows, it sets the memory used.
+
+    end : integer
+        Byte offset to stop reading at, by default the end of the file
+
+    Returns
+    --------
+    row : integer
+        Number of the first data row of the chunk (generated)
+
+    offset : integer
+        Byte offset of the chunk in the file (generated)
+
+    columns : dictionary
+        Numpy arrays with the chunk values, with the column names
+        as keys (generated)
+
+    chunk : bytes
+        Data rows of the chunk, as in the file (generated)
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import iter_data_chunks
+    >>> for row, offset, cols, chunk in iter_data_chunks(
+    ... 'example_data/example_data_prep.csv',['Step Number'],chunk_rows=2000):
+    ...     print(row, offset)
+    0 29124
+    2000 253658
+    4000 473668
+    """
+
+    nf = novonix_file(infile)
+
+    if isinstance(dtypes, str):
+        dtypes = [dtypes] * len(names)
+    icols = column_positions(nf, names)
+    if not chunk_rows:
+        chunk_rows = np.inf
+    if start is None and first_row > 0:
+        start = row_offset(nf, first_row)
+
+    row = first_row
+    offset = None
+    pending = []
+    npending = 0
+    for boffset, block in data_blocks(nf, start=start, size=size, end=end):
+        if offset is None:
+            offset = boffset
+        ends = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == 10) + 1
+        if not block.endswith(b"\n"):
+            ends = np.append(ends, len(block))
+
+        pos = 0
+        iend = 0
+        while npending + len(ends) - iend >= chunk_rows:
+            # Complete a chunk
+            iend = iend + chunk_rows - npending
+            pending.append(block[pos : ends[iend - 1]])
+            pos = ends[iend - 1]
+
+            chunk = b"".join(pending)
+            values = parse_data_block(
+                chunk, icols, dtypes, encoding=nf.encoding, infile=nf, row=row
+            )
+            yield row, offset, dict(zip(names, values)), chunk
+
+            row += chunk_rows
+            offset += len(chunk)
+            pending = []
+            npending = 0
+
+        if pos < len(block):
+            pending.append(block[pos:])
+            npending += len(ends) - iend
+
+    if pending:
+        chunk = b"".join(pending)
+        values = parse_data_block(
+            chunk, icols, dtypes, encoding=nf.encoding, infile=nf, row=row
+        )
+        yield row, offset, dict(zip(names, values)), chunk
+
+
+def parse_columns(infile, icols, dtypes):
+    """
+    Given a Novonix data file, parse the columns in the
+    positions icols, by blocks of rows.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the input Novonix data file
+
+    icols : list of integers
+        Positions of the columns to be read
+
+    dtypes : list of strings
+        Type of data of each column
+
+    Returns
+    --------
+    values : list of numpy arrays
+        Values of each column
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import parse_columns
+    >>> step, = parse_columns('example_data/example_data_prep.csv',[2],['int'])
+    >>> print(step[0])
+    0
+    """
+
+    nf = novonix_file(infile)
+
+    parts = [[] for icol in icols]
+    row = 0
+    for offset, block in data_blocks(nf):
+        values = parse_data_block(
+            block, icols, dtypes, encoding=nf.encoding, infile=nf, row=row
+        )
+        for part, val in zip(parts, values):
+            part.append(val)
+        if values:
+            row += len(values[0])
+
+    values = []
+    for part, dtype in zip(parts, dtypes):
+        if part:
+            values.append(np.concatenate(part))
+        else:
+            values.append(np.array([], dtype=np.dtype(dtype)))
+
+    return values
+
+
+def select_rows(block, keep):
+    r"""
+    Given a block of data rows, keep only the selected ones.
+
+    Parameters
+    -----------
+    block : bytes
+        Data rows, as in the file
+
+    keep : array of booleans
+        True for the rows to be kept
+
+    Returns
+    --------
+    block : bytes
+        Selected data rows
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import select_rows
+    >>> select_rows(b"a,1\nb,2\nc,3\n", [True, False, True])
+    b'a,1\nc,3\n'
+    """
+
+    if np.all(keep):
+        return block
+
+    rows = block.split(b"\n")
+    last = rows.pop()
+    rows = [row + b"\n" for row in rows]
+    if last:
+        rows.append(last)
+
+    return b"".join(compress(rows, keep))
+
+
+def split_rows(block, nlast):
+    r"""
+    Split a block of data rows, leaving apart its last rows.
+
+    Parameters
+    -----------
+    block : bytes
+        Data rows, as in the file
+
+    nlast : int
+        Number of rows at the end of the block to be left apart
+
+    Returns
+    --------
+    head : bytes
+        Data rows up to the last nlast ones
+
+    tail : bytes
+        Last nlast data rows
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import split_rows
+    >>> split_rows(b"a,1\nb,2\nc,3\n", 2)
+    (b'a,1\n', b'b,2\nc,3\n')
+    """
+
+    end = len(block)
+    if block.endswith(b"\n"):
+        end -= 1
+
+    for ii in range(nlast):
+        end = block.rfind(b"\n", 0, end)
+        if end < 0:
+            return b"", block
+
+    return block[: end + 1], block[end + 1 :]
+
+
+def format_column(values):
+    """
+    Format an array of numbers as str() does for each of them,
+    with vectorized operations.
+
+    Parameters
+    -----------
+    values : array of integers or floats
+        Values to be formatted
+
+    Returns
+    --------
+    text : array of bytes
+        Formatted values
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import format_column
+    >>> format_column([2, -999, 15])
+    array([b'2', b'-999', b'15'], dtype='|S4')
+    """
+
+    values = np.asarray(values)
+    if values.dtype.kind not in "biu":
+        return values.astype(bytes)
+
+    # Write the digits of the absolute values, left aligned
+    value = np.abs(values.astype(np.int64))
+    ndigits = np.ones(len(value), dtype=int)
+    power = 10
+    while len(value) > 0 and power <= value.max():
+        ndigits += value >= power
+        power *= 10
+
+    negative = values < 0
+    width = int(ndigits.max(initial=1)) + int(negative.any())
+    chars = np.zeros((len(value), width), dtype=np.uint8)
+    for idigit in range(ndigits.max(initial=1) - 1, -1, -1):
+        inside = idigit < ndigits
+        digit = np.where(inside, value % 10 + ord("0"), 0)
+        chars[:, idigit] = np.where(inside, digit, chars[:, idigit])
+        value = np.where(inside, value // 10, value)
+
+    # Add the sign
+    if negative.any():
+        chars[negative, 1:] = chars[negative, :-1]
+        chars[negative, 0] = ord("-")
+
+    return chars.view("S{}".format(width)).ravel()
+
+
+def append_columns(block, columns, keep=None):
+    r"""
+    Given a block of data rows, append new columns to them.
+    The rows are kept as they are, except for any trailing white space.
+
+    Parameters
+    -----------
+    block : bytes
+        Data rows, as in the file
+
+    columns : list of arrays
+        Values of the new columns, one per data row
+
+    keep : array of booleans
+        True for the rows to be written, None to write all of them
+
+    Returns
+    --------
+    new_block : bytes
+        Data rows with the new columns
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import append_columns
+    >>> append_columns(b"a,1 \nb,2\n", [[0, 2], [1.5, 3.0]])
+    b'a,1,0,1.5\nb,2,2,3.0\n'
+    """
+
+    # Rows without trailing white spaces
+    rows = block.split(b"\n")
+    if not rows[-1]:
+        rows.pop()
+    rows = [row.rstrip() for row in rows]
+
+    columns = [np.asarray(values) for values in columns]
+    if keep is not None:
+        rows = list(compress(rows, keep))
+        columns = [values[keep] for values in columns]
+    if not rows:
+        return b""
+
+    # Text to be added to each row: ,value1,value2...\n
+    pieces = [rows]
+    for ii, values in enumerate(columns):
+        text = format_column(values)
+        chars = np.zeros((len(rows), text.itemsize + 2), dtype=np.uint8)
+        chars[:, 0] = comma
+        chars[:, 1:-1] = text.view(np.uint8).reshape(len(rows), text.itemsize)
+        if ii == len(columns) - 1:
+            width = np.count_nonzero(chars, axis=1)
+            chars[np.arange(len(rows)), width] = newline
+        pieces.append(chars.view("S{}".format(chars.shape[1])).ravel().tolist())
+    if not columns:
+        pieces.append([b"\n"] * len(rows))
+
+    new_rows = [None] * (len(rows) * len(pieces))
+    for ii, piece in enumerate(pieces):
+        new_rows[ii :: len(pieces)] = piece
+
+    return b"".join(new_rows)
+
+
+def replace_column(block, icol, values):
+    r"""
+    Given a block of data rows, replace the text of one of their columns.
+    The rest of the text in the rows is kept as it is.
+
+    Parameters
+    -----------
+    block : bytes
+        Data rows, as in the file
+
+    icol : int
+        Position of the column to be replaced
+
+    values : array
+        New values of the column, one per data row
+
+    Returns
+    --------
+    new_block : bytes
+        Data rows with the new values
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import replace_column
+    >>> replace_column(b"a,1,x\nb,2,y\n", 1, [0.5, 3])
+    b'a,0.5,x\nb,3.0,y\n'
+    """
+
+    if not block:
+        return block
+
+    # Start and end of each row
+    buf = np.frombuffer(block, dtype=np.uint8)
+    ends = np.flatnonzero(buf == newline)
+    if buf[-1] != newline:
+        ends = np.append(ends, len(buf))
+    starts = np.concatenate(([0], ends[:-1] + 1))
+
+    # Start and end of the field in each row
+    commas = np.flatnonzero(buf == comma)
+    first = np.searchsorted(commas, starts)
+    ncommas = np.searchsorted(commas, ends) - first
+    if (ncommas < icol).any():
+        raise ColumnError(
+            "less than " + str(icol + 1) + " columns in some data rows",
+            where="novonix_io.replace_column",
+        )
+    if icol > 0:
+        fstarts = commas[first + icol - 1] + 1
+    else:
+        fstarts = starts
+    fends = ends.copy()
+    inside = ncommas > icol
+    fends[inside] = commas[first[inside] + icol]
+
+    # Text between fields, followed by the new values
+    spans = [
+        block[istart:iend]
+        for istart, iend in zip(
+            [0] + fends.tolist(), fstarts.tolist() + [len(block)]
+        )
+    ]
+    new_rows = [None] * (2 * len(spans) - 1)
+    new_rows[::2] = spans
+    new_rows[1::2] = format_column(values).tolist()
+
+    return b"".join(new_rows)
+
+
+def write_columns(outfile, header, blocks, encoding=None, offset=None):
+    r"""
+    Write a data file with new columns, in one pass:
+    the header lines and then the blocks of data rows,
+    with the new columns appended to them.
+
+    Parameters
+    -----------
+    outfile : string
+        Name of the file to be written
+
+    header : list of strings
+        Header lines, including the column names
+
+    blocks : iterator
+        Blocks of data rows, as tuples (block, columns, keep),
+        as used by append_columns. If columns is None,
+        the data rows are written as they are.
+
+    encoding : string
+        Encoding for the header, by default the preferred one
+
+    offset : integer
+        Byte offset in an existing outfile from which its content is
+        replaced by the blocks, without writing the header.
+        None to write a new file.
+
+    Examples
+    ---------
+    >>> import os, shutil, tempfile
+    >>> from preparenovonix.novonix_io import write_columns
+    >>> tmp_dir = tempfile.mkdtemp()
+    >>> outfile = os.path.join(tmp_dir, 'new.csv')
+    >>> write_columns(outfile, ['[Data] \n', 'a, b, c \n'], [(b"x,1\n", [[2]], None)])
+    >>> print(open(outfile).read().splitlines()[-1])
+    x,1,2
+    >>> shutil.rmtree(tmp_dir)
+    """
+
+    if encoding is None:
+        encoding = locale.getpreferredencoding(False)
+
+    mode = "wb"
+    if offset is not None:
+        mode = "r+b"
+    with open(outfile, mode, buffering=blocksize) as tf:
+        if offset is None:
+            tf.write("".join(header).encode(encoding))
+        else:
+            tf.seek(offset)
+            tf.truncate()
+        for block, columns, keep in blocks:
+            if columns is None:
+                if keep is not None:
+                    block = select_rows(block, keep)
+                tf.write(block)
+            else:
+                tf.write(append_columns(block, columns, keep=keep))
+
+
+def cache_dir(infile):
+    """
+    Given a Novonix data file, get the name of the directory
+    next to it that holds its cached columns:
+    [file_to_open].cache
+
+    Parameters
+    ----------
+    infile : string or NovonixFile
+        Name of the input Novonix data file
+
+    Returns
+    --------
+    cdir : string
+        Full path to the cache directory
+
+    Examples
+    ---------
+    >>> import os.path
+    >>> from preparenovonix.novonix_io import cache_dir
+    >>> os.path.basename(cache_dir('example_data/example_data_prep.csv'))
+    'example_data_prep.csv.cache'
+    """
+
+    if isinstance(infile, NovonixFile):
+        infile = infile.infile
+
+    dirname, fname = os.path.split(os.path.abspath(infile))
+    cdir = os.path.join(dirname, fname + ".cache")
+
+    return cdir
+
+
+def clear_cache(infile):
+    """
+    Given a Novonix data file, remove its cached columns, if any.
+
+    Parameters
+    ----------
+    infile : string or NovonixFile
+        Name of the input Novonix data file
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import clear_cache
+    >>> clear_cache('example_data/example_data_prep.csv')
+    """
+
+    rmtree(cache_dir(infile), ignore_errors=True)
+    return
+
+
+def file_key(infile):
+    """
+    Given a Novonix data file, get the values identifying its content:
+    size, modification time and hash of the header.
+
+    Parameters
+    ----------
+    infile : string or NovonixFile
+        Name of the input Novonix data file
+
+    Returns
+    --------
+    key : dictionary
+        Size, modification time (ns) and SHA-1 of the header
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import file_key
+    >>> file_key('example_data/example_data_prep.csv')['size']
+    667549
+    """
+
+    nf = novonix_file(infile)
+
+    with open(nf.infile, "rb") as ff:
+        header = ff.read(nf.data_start)
+
+    key = {
+        "size": nf.size,
+        "mtime": nf.mtime,
+        "header": hashlib.sha1(header).hexdigest(),
+    }
+
+    return key
+
+
+def read_cached_columns(infile, icols, dtypes):
+    """
+    Given a Novonix data file, read the columns in the positions icols
+    from its binary cache, parsing and caching first any missing column.
+    The cache is rebuilt if the file has changed since it was written.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the input Novonix data file
+
+    icols : list of integers
+        Positions of the columns to be read
+
+    dtypes : list of strings
+        Type of data of each column
+
+    Returns
+    --------
+    values : list of numpy arrays
+        Values of each column, as read-only memory maps when possible
+
+    Examples
+    ---------
+    >>> import shutil, tempfile
+    >>> from preparenovonix.novonix_io import read_cached_columns
+    >>> tmp_dir = tempfile.mkdtemp()
+    >>> infile = shutil.copy('example_data/example_data_prep.csv',tmp_dir)
+    >>> step, = read_cached_columns(infile,[2],['int'])
+    >>> print(step[0])
+    0
+    >>> shutil.rmtree(tmp_dir)
+    """
+
+    nf = novonix_file(infile)
+    cdir = cache_dir(nf)
+    metafile = os.path.join(cdir, "columns.json")
+
+    # Check that the cache corresponds to the current file
+    key = file_key(nf)
+    meta = _read_json(metafile)
+    if meta is None or meta.get("key") != key:
+        # Remove only the columns, the index is checked on its own
+        for colfile in (meta or {}).get("columns", []):
+            try:
+                os.remove(os.path.join(cdir, colfile))
+            except OSError:
+                pass
+        meta = {"key": key, "columns": []}
+
+    colfiles = [
+        "column{}_{}.npy".format(icol, np.dtype(dtype).name)
+        for icol, dtype in zip(icols, dtypes)
+    ]
+    missing = []
+    for colfile in colfiles:
+        if colfile in missing:
+            continue
+        if colfile not in meta["columns"] or not os.path.isfile(
+            os.path.join(cdir, colfile)
+        ):
+            missing.append(colfile)
+
+    parsed = {}
+    if missing:
+        ii = [colfiles.index(colfile) for colfile in missing]
+        new_values = parse_columns(
+            nf, [icols[i] for i in ii], [dtypes[i] for i in ii]
+        )
+        parsed = dict(zip(missing, new_values))
+        try:
+            os.makedirs(cdir, exist_ok=True)
+            for colfile in missing:
+                _save_npy(os.path.join(cdir, colfile), parsed[colfile])
+                if colfile not in meta["columns"]:
+                    meta["columns"].append(colfile)
+            _write_json(metafile, meta)
+        except OSError:
+            # The cache cannot be written: use the parsed columns
+            meta["columns"] = [
+                colfile for colfile in meta["columns"] if colfile not in missing
+            ]
+
+    values = []
+    for colfile in colfiles:
+        if colfile not in meta["columns"]:
+            values.append(parsed[colfile])
+            continue
+        path = os.path.join(cdir, colfile)
+        try:
+            values.append(np.load(path, mmap_mode="r"))
+        except ValueError:
+            # Empty arrays cannot be memory mapped
+            values.append(np.load(path))
+
+    return values
+
+
+def index_file(infile):
+    """
+    Given a Novonix data file, get the name of its index file,
+    kept in the cache directory: [file_to_open].cache/index.json
+
+    Parameters
+    ----------
+    infile : string or NovonixFile
+        Name of the input Novonix data file
+
+    Returns
+    --------
+    ifile : string
+        Full path to the index file
+
+    Examples
+    ---------
+    >>> import os.path
+    >>> from preparenovonix.novonix_io import index_file
+    >>> os.path.basename(index_file('example_data/example_data_prep.csv'))
+    'index.json'
+    """
+
+    return os.path.join(cache_dir(infile), "index.json")
+
+
+def build_index(infile, every=index_rows):
+    """
+    Given a Novonix data file, find with a single pass the byte offsets
+    of the lines starting each header section and of one every
+    'every' data rows, and save them in the index file.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the input Novonix data file
+
+    every : integer
+        Number of data rows between the recorded row offsets
+
+    Returns
+    --------
+    index : dictionary
+        key (see file_key), sections (byte offsets of the lines starting
+        each section), data_start, every, rows (byte offsets of the
+        data rows 0, every, 2*every...) and nrows (number of data rows)
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import build_index
+    >>> import shutil, tempfile
+    >>> tmp_dir = tempfile.mkdtemp()
+    >>> infile = shutil.copy('example_data/example_data_prep.csv',tmp_dir)
+    >>> index = build_index(infile,every=2000)
+    >>> print(index['rows'], index['nrows'])
+    [29124, 253658, 473668] 5752
+    >>> shutil.rmtree(tmp_dir)
+    """
+
+    nf = novonix_file(infile)
+
+    sections = {}
+    for name in nf.section_names:
+        sections[name] = list(nf._header_sections[name])
+    pattern = re.compile(rb"\[(" + "|".join(nf.section_names).encode() + rb")\]")
+
+    rows = []
+    nrows = 0
+    last = {}
+    for offset, block in data_blocks(nf):
+        # Byte offsets of the rows starting in this block
+        ends = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == newline)
+        if not block.endswith(b"\n"):
+            ends = np.append(ends, len(block) - 1)
+        starts = np.concatenate(([0], ends[:-1] + 1)) + offset
+        rows.extend(starts[(-nrows) % every :: every].tolist())
+        nrows += len(starts)
+
+        # Section lines after the first header
+        if b"[" not in block:
+            continue
+        for match in pattern.finditer(block):
+            name = match.group(1).decode()
+            start = offset + block.rfind(b"\n", 0, match.start()) + 1
+            if last.get(name) != start:
+                sections[name].append(start)
+                last[name] = start
+
+    index = {
+        "key": file_key(nf),
+        "sections": sections,
+        "data_start": nf.data_start,
+        "every": every,
+        "rows": rows,
+        "nrows": nrows,
+    }
+    try:
+        os.makedirs(cache_dir(nf), exist_ok=True)
+        _write_json(index_file(nf), index)
+    except OSError:
+        # The index cannot be saved: use it only this time
+        pass
+
+    return index
+
+
+def read_index(infile):
+    """
+    Given a Novonix data file, read its index file, if it exists
+    and it corresponds to the current file.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the input Novonix data file
+
+    Returns
+    --------
+    index : dictionary
+        Index of the file (see build_index) or None
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import read_index
+    >>> index = read_index('example_data/example_data.csv')
+    """
+
+    if isinstance(infile, NovonixFile) and not infile.isnovonix:
+        return None
+    nf = novonix_file(infile)
+
+    index = _read_json(index_file(nf))
+    if index is None or index.get("key") != file_key(nf):
+        return None
+
+    return index
+
+
+def file_index(infile, every=index_rows):
+    """
+    Given a Novonix data file, get its index, building and saving
+    it when there is none or the file has changed since it was built.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the input Novonix data file
+
+    every : integer
+        Number of data rows between the recorded row offsets,
+        used when the index is built
+
+    Returns
+    --------
+    index : dictionary
+        Index of the file (see build_index)
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import file_index
+    >>> import shutil, tempfile
+    >>> tmp_dir = tempfile.mkdtemp()
+    >>> infile = shutil.copy('example_data/example_data_prep.csv',tmp_dir)
+    >>> index = file_index(infile)
+    >>> print(index['sections']['Data'])
+    [28845]
+    >>> shutil.rmtree(tmp_dir)
+    """
+
+    nf = novonix_file(infile)
+
+    index = read_index(nf)
+    if index is None:
+        index = build_index(nf, every=every)
+
+    return index
+
+
+def row_offset(infile, row):
+    """
+    Given a Novonix data file, find the byte offset of a data row,
+    jumping to the nearest row recorded in the file index.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the input Novonix data file
+
+    row : integer
+        Number of the data row, starting from 0
+
+    Returns
+    --------
+    offset : integer
+        Byte offset of the row, the size of the file if there
+        are not that many rows
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import row_offset
+    >>> row_offset('example_data/example_data_prep.csv',2000)
+    253658
+    """
+
+    nf = novonix_file(infile)
+    index = file_index(nf)
+
+    if row >= index["nrows"]:
+        return nf.size
+
+    irow, skip = divmod(row, index["every"])
+    offset = index["rows"][irow]
+    if skip == 0:
+        return offset
+
+    # Move forward from the recorded row
+    with open(nf.infile, "rb") as ff:
+        ff.seek(offset)
+        for ii in range(skip):
+            offset += len(ff.readline())
+
+    return offset
+
+
+def save_segments(infile, segments):
+    """
+    Given a Novonix data file, save the table of its sets of
+    measurements in its cache directory, as segments.npy,
+    together with the values identifying the file, see file_key.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the input Novonix data file
+
+    segments : numpy structured array
+        Table of the sets of measurements, one row per set
+
+    Examples
+    ---------
+    >>> import shutil, tempfile
+    >>> import numpy as np
+    >>> from preparenovonix.novonix_io import save_segments, read_segments
+    >>> tmp_dir = tempfile.mkdtemp()
+    >>> infile = shutil.copy('example_data/example_data_prep.csv',tmp_dir)
+    >>> save_segments(infile,np.zeros(0))
+    >>> print(len(read_segments(infile)))
+    0
+    >>> shutil.rmtree(tmp_dir)
+    """
+
+    nf = novonix_file(infile)
+    cdir = cache_dir(nf)
+    try:
+        os.makedirs(cdir, exist_ok=True)
+        _save_npy(os.path.join(cdir, "segments.npy"), segments)
+        _write_json(os.path.join(cdir, "segments.json"), {"key": file_key(nf)})
+    except OSError:
+        # The table cannot be saved
+        pass
+    return
+
+
+def read_segments(infile):
+    """
+    Given a Novonix data file, read the table of its sets of
+    measurements, if it exists and it corresponds to the current file.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the input Novonix data file
+
+    Returns
+    --------
+    segments : numpy structured array
+        Table of the sets of measurements, see
+        novonix_add.segment_dtype, or None
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import read_segments
+    >>> segments = read_segments('example_data/example_data_prep.csv')
+    """
+
+    if isinstance(infile, NovonixFile) and not infile.isnovonix:
+        return None
+    nf = novonix_file(infile)
+    cdir = cache_dir(nf)
+
+    meta = _read_json(os.path.join(cdir, "segments.json"))
+    if meta is None or meta.get("key") != file_key(nf):
+        return None
+    try:
+        segments = np.load(os.path.join(cdir, "segments.npy"))
+    except (OSError, ValueError):
+        return None
+
+    return segments
+
+
+def rows_end(infile, size=4096):
+    """
+    Given a file, get the byte offset after its last end of line,
+    leaving out a last row that is still being written.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the file
+
+    size : integer
+        Initial number of bytes read from the end of the file
+
+    Returns
+    --------
+    end : integer
+        Byte offset after the last end of line, 0 if there is none
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import rows_end
+    >>> print(rows_end('example_data/example_data_prep.csv'))
+    667549
+    """
+
+    if isinstance(infile, NovonixFile):
+        infile = infile.infile
+
+    with open(infile, "rb") as ff:
+        offset = ff.seek(0, os.SEEK_END)
+        while offset > 0:
+            start = max(offset - size, 0)
+            ff.seek(start)
+            inl = ff.read(offset - start).rfind(b"\n")
+            if inl >= 0:
+                return start + inl + 1
+            offset = start
+
+    return 0
+
+
+def save_checkpoint(infile, checkpoint):
+    """
+    Keep the checkpoint of the preparation of a Novonix data file,
+    in infile.cache, tagged with the key of infile.
+    The scalars are stored in checkpoint.json and the arrays
+    (such as the rows waiting for their State) in checkpoint.npz,
+    thus reading them back does not run any code.
+
+    Parameters
+    -----------
+    infile : string
+        Name of the prepared Novonix data file
+
+    checkpoint : dictionary
+        Values needed to resume the preparation,
+        see novonix_prep.prepare_novonix
+
+    Examples
+    ---------
+    >>> import shutil, tempfile
+    >>> from preparenovonix.novonix_io import save_checkpoint, read_checkpoint
+    >>> tmp_dir = tempfile.mkdtemp()
+    >>> infile = shutil.copy('example_data/example_data_prep.csv',tmp_dir)
+    >>> save_checkpoint(infile,{'end':0})
+    >>> print(read_checkpoint(infile))
+    {'end': 0}
+    >>> shutil.rmtree(tmp_dir)
+    """
+
+    nf = NovonixFile(infile)
+    cdir = cache_dir(nf)
+    os.makedirs(cdir, exist_ok=True)
+
+    arrays = {}
+    content = _encode_checkpoint(checkpoint, arrays)
+    # Tag shared by both files, to detect a pair not saved together
+    tag = os.urandom(8).hex()
+    arrays["tag"] = np.array(tag)
+
+    outfile = os.path.join(cdir, "checkpoint.npz")
+    with temporary_file(outfile) as tmp_file:
+        with open(tmp_file, "wb") as ff:
+            np.savez(ff, **arrays)
+        os.replace(tmp_file, outfile)
+    _write_json(
+        os.path.join(cdir, "checkpoint.json"),
+        {"key": file_key(nf), "tag": tag, "checkpoint": content},
+    )
+
+
+def read_checkpoint(infile):
+    """
+    Read the checkpoint of the preparation of a Novonix data file,
+    if it exists and infile has not changed since it was saved.
+    A missing or malformed checkpoint is taken as no checkpoint.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the prepared Novonix data file
+
+    Returns
+    --------
+    checkpoint : dictionary
+        Values needed to resume the preparation, or None
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import read_checkpoint
+    >>> checkpoint = read_checkpoint('example_data/example_data_prep.csv')
     """
-    Given a file name return as:
-    [file_to_open root]_prep.[file-to_open_ending]
+
+    if isinstance(infile, NovonixFile):
+        infile = infile.infile
+    if not os.path.isfile(infile):
+        return None
+    # The file is indexed again, as it may have changed
+    nf = NovonixFile(infile)
+    if not nf.isnovonix:
+        return None
+
+    cdir = cache_dir(nf)
+    saved = _read_json(os.path.join(cdir, "checkpoint.json"))
+    if not isinstance(saved, dict) or saved.get("key") != file_key(nf):
+        return None
+
+    try:
+        with np.load(os.path.join(cdir, "checkpoint.npz"), allow_pickle=False) as npz:
+            arrays = {name: npz[name] for name in npz.files}
+        if str(arrays.pop("tag")) != saved["tag"]:
+            return None
+        checkpoint = _decode_checkpoint(saved["checkpoint"], arrays)
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+    if not isinstance(checkpoint, dict):
+        return None
+
+    return checkpoint
+
+
+def _encode_checkpoint(value, arrays):
+    """
+    Turn the values of a checkpoint into JSON content, moving the numpy
+    arrays and scalars and the bytes into arrays, a dictionary updated
+    in place.
+    """
+    if isinstance(value, (np.ndarray, np.generic, bytes)):
+        name = "a" + str(len(arrays))
+        if isinstance(value, bytes):
+            arrays[name] = np.frombuffer(value, dtype=np.uint8)
+            return {"__bytes__": name}
+        arrays[name] = np.asarray(value)
+        return {"__array__": name, "scalar": isinstance(value, np.generic)}
+    if isinstance(value, tuple):
+        return {"__tuple__": [_encode_checkpoint(vv, arrays) for vv in value]}
+    if isinstance(value, list):
+        return [_encode_checkpoint(vv, arrays) for vv in value]
+    if isinstance(value, dict):
+        return {str(kk): _encode_checkpoint(vv, arrays) for kk, vv in value.items()}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    raise TypeError("unexpected value in checkpoint: " + type(value).__name__)
+
+
+def _decode_checkpoint(content, arrays):
+    """
+    Inverse of _encode_checkpoint.
+    """
+    if isinstance(content, list):
+        return [_decode_checkpoint(vv, arrays) for vv in content]
+    if not isinstance(content, dict):
+        return content
+    if "__bytes__" in content:
+        return arrays[content["__bytes__"]].tobytes()
+    if "__array__" in content:
+        values = arrays[content["__array__"]]
+        return values[()] if content["scalar"] else values
+    if "__tuple__" in content:
+        return tuple(_decode_checkpoint(vv, arrays) for vv in content["__tuple__"])
+    return {kk: _decode_checkpoint(vv, arrays) for kk, vv in content.items()}
+
+
+def file_hash(infile, size=blocksize):
+    """
+    Given a file, get the SHA-1 of its content, reading it in blocks
+    so that the memory use does not depend on the size of the file.
 
     Parameters
-    ----------
-    file_to_open : string
-        Name of the input file.
+    -----------
+    infile : string
+        Name of the file
+
+    size : integer
+        Size of the blocks read, in bytes
 
     Returns
     --------
-    after_file : string
-        Full path to the (new) file.
+    digest : string
+        SHA-1 of the content of the file, as hexadecimal digits
 
     Examples
     ---------
-    >>> from preparenovonix.novonix_io import after_file_name
-    >>> after_file_name('example_data/example_data.csv')
+    >>> from preparenovonix.novonix_io import file_hash
+    >>> digest = file_hash('example_data/example_data.csv')
     """
 
-    # Extract the path and file name
-    dirname, fname = os.path.split(os.path.abspath(file_to_open))
+    sha = hashlib.sha1()
+    with open(infile, "rb") as ff:
+        for block in iter(lambda: ff.read(size), b""):
+            sha.update(block)
 
-    root = fname.split(".")[0]
-    ending = fname.split(".")[1]
-    fname = root + "_prep." + ending
-    after_file = os.path.join(dirname, fname)
+    return sha.hexdigest()
 
-    return after_file
 
+def read_manifest(manifest):
+    """
+    Read a manifest of prepared files: a JSON-lines file with one entry
+    per preparation. The last entry of each source file is kept.
 
-def get_infile(file_to_open, overwrite=False):
+    Parameters
+    -----------
+    manifest : string
+        Name of the manifest file
+
+    Returns
+    --------
+    entries : dictionary
+        Last entry (dictionary) for each source file (absolute path).
+        Empty if the manifest does not exist.
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import read_manifest
+    >>> entries = read_manifest('manifest.jsonl')
     """
-    Given a file name return it after dealing
-    with possible issues with the path  and 
-    copy it if the overwrite flag is set to True.
+
+    entries = {}
+    try:
+        with open(manifest, "r") as ff:
+            for line in ff:
+                try:
+                    entry = json.loads(line)
+                    entries[entry["source"]] = entry
+                except (ValueError, TypeError, KeyError):
+                    # Lines cut by an interrupted writing
+                    continue
+    except OSError:
+        pass
+
+    return entries
+
+
+def append_manifest(manifest, entry):
+    """
+    Append an entry to a manifest of prepared files, as a single
+    line write so that several processes can share the manifest.
 
     Parameters
-    ----------
-    infile_name : string
-        Name of the input file.
+    -----------
+    manifest : string
+        Name of the manifest file
 
-    overwrite: boolean
-        Yes : overwrite the input file
-        No  : a new file will be created, appending '_prep' at the end of the
-              original file file
+    entry : dictionary
+        Entry with, at least, the source file (absolute path)
+
+    Examples
+    ---------
+    >>> import os, shutil, tempfile
+    >>> from preparenovonix.novonix_io import append_manifest, read_manifest
+    >>> tmp_dir = tempfile.mkdtemp()
+    >>> manifest = os.path.join(tmp_dir,'manifest.jsonl')
+    >>> append_manifest(manifest,{'source':'/data/a.csv'})
+    >>> print(list(read_manifest(manifest)))
+    ['/data/a.csv']
+    >>> shutil.rmtree(tmp_dir)
+    """
+
+    line = json.dumps(entry, sort_keys=True) + "\n"
+    with open(manifest, "a") as ff:
+        ff.write(line)
+
+
+def data_range(infile, t_min=None, t_max=None, loops=None):
+    """
+    Given a cleaned Novonix data file, find the byte range of the data
+    rows that can have a run time within [t_min, t_max] and a loop
+    number in loops. The run time is non-decreasing after cleaning and
+    so is the loop number, apart from the rows with loop number 0.
+    The range is found with a binary search over the rows recorded
+    in the file index, reading one row per step.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the input Novonix data file
+
+    t_min, t_max : float
+        Limits of the run time (h), None for no limit
+
+    loops : range or list of integers
+        Loop numbers, None for any
 
     Returns
     --------
-    infile : string
-        Path to the (new) file.
+    start : integer
+        Byte offset of the first row of the range
 
-    fname : string
-        File name withouth the path.
+    end : integer
+        Byte offset after the last row of the range
 
     Examples
     ---------
-    >>> from preparenovonix.novonix_io import get_infile
-    >>> get_infile('example_data/example_data.csv',overwrite=False)
+    >>> from preparenovonix.novonix_io import data_range
+    >>> import shutil, tempfile
+    >>> tmp_dir = tempfile.mkdtemp()
+    >>> infile = shutil.copy('example_data/example_data_prep.csv',tmp_dir)
+    >>> data_range(infile,loops=range(2,3))
+    (29124, 667549)
+    >>> shutil.rmtree(tmp_dir)
     """
 
-    # Extract the path and file name
-    dirname, fname = os.path.split(os.path.abspath(file_to_open))
+    nf = novonix_file(infile)
+    index = file_index(nf)
 
-    if overwrite:
-        infile = os.path.join(dirname, fname)
-    else:
-        infile = after_file_name(file_to_open)
-        # If *prep* file already exists, it will be replaced.
-        copy(file_to_open, infile)
+    start, end = index["data_start"], nf.size
+    if index["nrows"] == 0:
+        return start, end
 
-    return infile, fname
+    with open(nf.infile, "rb") as ff:
+        if t_min is not None or t_max is not None:
+            icol = column_positions(nf, [nv.col_t])[0]
+            start, end = _sorted_range(
+                ff, index["rows"], icol, t_min, t_max, start, end
+            )
 
+        lmin, lmax = loop_limits(loops)
+        if lmin is not None and lmin > 0:
+            icol = column_positions(nf, [nv.loop_col])[0]
+            start, end = _sorted_range(
+                ff, index["rows"], icol, lmin, lmax, start, end, skip=0
+            )
 
-def isnovonix(infile):
+    return start, max(start, end)
+
+
+def loop_limits(loops):
     """
-    Given a data file, check if it exists and
-    if looks like a Novonix data file, allowing for blank lines
-    and commas after the commands due to having open the file in Excel
+    Given the loop numbers of a query, get their minimum and maximum.
 
     Parameters
-    ----------
-    infile : string
-        Name of the input Novonix data file
+    -----------
+    loops : range or list of integers
+        Loop numbers, None for any
 
     Returns
     --------
-    answer : boolean
-        Yes=the file seems to be a Novonix data file
+    lmin, lmax : integers
+        Minimum and maximum loop numbers, None for no limits
 
     Examples
     ---------
-    >>> from preparenovonix.novonix_io import isnovonix
-    >>> isnovonix('example_data/example_data.csv')
-    True
+    >>> from preparenovonix.novonix_io import loop_limits
+    >>> loop_limits(range(2,5))
+    (2, 4)
     """
 
-    answer = True
+    if loops is None:
+        return None, None
 
-    # Test if the file exists
-    if not os.path.isfile(infile):
-        answer = False
-        print(
-            "STOP novonix_io.isnovonix \n"
-            + "REASON Input file not found: "
-            + str(infile)
-            + " \n"
-        )
-        return answer
-    else:
-        with open(infile, "r") as ff:
-            # Read until different header statement
-            keyws = ["Summary", "Novonix", "Protocol", "Data"]
-            for keyw in keyws:
-                for line in ff:
-                    if line.strip():
-                        char1 = line.strip()[0]
-                        if char1 in nv.numberstr:
-                            answer = False
-                            print(
-                                "STOP novonix_io.isnovonix \n"
-                                + "REASON Reached the end of the input file \n"
-                                + "       "
-                                + str(infile)
-                                + ", \n"
-                                + "       without the "
-                                + keyw
-                                + " entry."
-                            )
-                            return answer
-                        else:
-                            if keyw in line:
-                                break
-
-            # Read until the data starts
-            for line in ff:
-                if line.strip():
-                    char1 = line.strip()[0]
-                    if char1 in nv.numberstr:
-                        break
-                    else:
-                        last_line = line.strip()
-
-            # From the data header, read the column names
-            colnames = last_line.split(",")
-
-            # Remove triling blancks and end of lines
-            colnames = [x.strip() for x in colnames]
-
-            # Check the existance of the "Step Number" column
-            if nv.col_step not in colnames:
-                answer = False
-                print(
-                    "STOP novonix_io.isnovonix \n"
-                    + 'REASON No "Step Number" colum found in input file \n'
-                    + "       "
-                    + str(infile)
-                    + " \n"
-                )
-                return answer
-
-            # Check the existance of the "Step time" column
-            if nv.col_tstep not in colnames:
-
-                answer = False
-                print(
-                    "STOP novonix_io.isnovonix \n"
-                    + 'REASON No "Step Time" colum found in input file \n'
-                    + "       "
-                    + str(infile)
-                    + " \n"
-                )
-                return answer
+    if isinstance(loops, range) and loops.step == 1:
+        return loops.start, loops.stop - 1
 
-    return answer
+    loops = np.asarray(list(loops), dtype=int)
+    if len(loops) == 0:
+        return 0, -1
+    return int(loops.min()), int(loops.max())
 
 
-def icolumn(infile, column_name):
+def _sorted_range(ff, rows, icol, vmin, vmax, start, end, skip=None):
     """
-    Given a Novonix data file, find the column position of the
-    given column_name
+    Binary search over the recorded rows of the limits of a
+    non-decreasing column, ignoring the rows with the value skip
+    and those that cannot be read as a number. The byte range
+    [start, end) is narrowed to the rows that can be within [vmin, vmax].
+    """
+
+    probes = {}
+
+    def value(irow):
+        # Value of the first usable recorded row from irow on
+        while irow < len(rows):
+            if irow not in probes:
+                ff.seek(rows[irow])
+                try:
+                    val = float(ff.readline().split(b",")[icol])
+                except (IndexError, ValueError):
+                    val = np.nan
+                probes[irow] = val
+            val = probes[irow]
+            if val == val and val != skip:
+                return irow, val
+            irow += 1
+        return irow, np.inf
+
+    def first_row(test):
+        lo, hi = 0, len(rows)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if test(value(mid)[1]):
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    if vmin is not None:
+        # Rows before a recorded value below vmin are all below it
+        irow = first_row(lambda val: val >= vmin)
+        if irow > 0:
+            start = max(start, rows[value(irow - 1)[0]])
+
+    if vmax is not None:
+        # Rows from a recorded value above vmax are all above it
+        irow = value(first_row(lambda val: val > vmax))[0]
+        if irow < len(rows):
+            end = min(end, rows[irow])
+
+    return start, end
+
+
+def read_rows(infile, names, dtypes="float", t_min=None, t_max=None, loops=None):
+    """
+    Given a cleaned Novonix data file, read the columns for the rows
+    with a run time within [t_min, t_max] and a loop number in loops,
+    reading from the file only the byte range given by data_range.
 
     Parameters
     -----------
-    infile : string
+    infile : string or NovonixFile
         Name of the input Novonix data file
 
-    column_name : string
-        Name of the column name to find
+    names : list of strings
+        Names of the columns to be read
 
-    icolumn : integer
-        icolumn = -1 : the column has not been found.
-        If icolumn > -1: icolumn is the index of the column.
+    dtypes : string or list of strings
+        Type of data of the columns to be read, either one for all
+        the columns or one per column
+
+    t_min, t_max : float
+        Limits of the run time (h), None for no limit
+
+    loops : range or list of integers
+        Loop numbers, None for any
 
     Returns
     --------
-    icol : integer
-       Position of the column with name 'column_name',
-       in the range form 0 to the number of columns - 1
+    columns : dictionary
+        Numpy arrays with the selected rows, with the column names as keys
 
     Examples
     ---------
-    >>> from preparenovonix.novonix_io import icolumn
-    >>> icolumn('example_data/example_data.csv','Step Number')
-    2
+    >>> from preparenovonix.novonix_io import read_rows
+    >>> cols = read_rows('example_data/example_data_prep.csv',
+    ... ['Step Number'],dtypes='int',loops=range(2,3))
+    >>> print(len(cols['Step Number']))
+    878
     """
 
-    icol = -1
+    nf = novonix_file(infile)
+
+    if isinstance(dtypes, str):
+        dtypes = [dtypes] * len(names)
+    icols = column_positions(nf, names)
+
+    start, end = data_range(nf, t_min=t_min, t_max=t_max, loops=loops)
+    with open(nf.infile, "rb") as ff:
+        ff.seek(start)
+        block = ff.read(end - start)
+
+    # Columns needed to select the rows
+    extra = []
+    if t_min is not None or t_max is not None:
+        extra.append(column_positions(nf, [nv.col_t])[0])
+    if loops is not None:
+        extra.append(column_positions(nf, [nv.loop_col])[0])
+
+    values = parse_data_block(
+        block,
+        icols + extra,
+        dtypes + ["float"] * len(extra),
+        encoding=nf.encoding,
+        infile=nf,
+    )
+
+    keep = np.ones(len(values[0]), dtype=bool) if values else None
+    if t_min is not None or t_max is not None:
+        times = values[len(icols)]
+        if t_min is not None:
+            keep &= times >= t_min
+        if t_max is not None:
+            keep &= times <= t_max
+    if loops is not None:
+        loop = values[-1]
+        if isinstance(loops, range) and loops.step == 1:
+            keep &= (loop >= loops.start) & (loop < loops.stop)
+        else:
+            keep &= np.isin(loop, np.asarray(list(loops), dtype=float))
 
-    # Check if the file has the expected structure for a Novonix data file
-    answer = isnovonix(infile)
-    if not answer:
-        sys.exit("STOP Input not from Novonix, {}".format(infile))
+    columns = {}
+    for column_name, val in zip(names, values):
+        columns[column_name] = val[keep]
 
-    with open(infile, "r") as ff:
-        # Read until the line with [Data]
-        for line in ff:
-            if "[Data]" in line:
-                break
+    return columns
 
-        # From the data header, read the column names
-        line = ff.readline()
-        colnames = line.split(",")
 
-        # Find the position of the given column name
-        ii = 0
-        for col in colnames:
-            cs = col.strip()
-            if column_name.casefold() == cs.casefold():
-                icol = ii
-                return icol
-            ii += 1
+def _read_json(infile):
+    """
+    Read a JSON file, returning None if it does not exist or is corrupted.
+    """
+    try:
+        with open(infile, "r") as ff:
+            return json.load(ff)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(outfile, content):
+    """
+    Write a JSON file, replacing any previous one atomically.
+    """
+    with temporary_file(outfile) as tmp_file:
+        with open(tmp_file, "w") as ff:
+            json.dump(content, ff)
+        os.replace(tmp_file, outfile)
+
 
-    return icol
+def _save_npy(outfile, values):
+    """
+    Save an array into a .npy file, replacing any previous one atomically.
+    """
+    with temporary_file(outfile) as tmp_file:
+        with open(tmp_file, "wb") as ff:
+            np.save(ff, values)
+        os.replace(tmp_file, outfile)
 
 
-def read_column(infile, column_name, outtype="float"):
+def last_line_before(ff, offset, size=4096):
     """
-    Given a Novonix data file, read a column as an array of the
-    type given in the variable astype.
+    Given a file open in binary mode, read backwards from a byte offset
+    to get the last line, before it, which is not blank.
 
     Parameters
     -----------
-    infile : string
+    ff : file object
+        File open in binary mode
+
+    offset : integer
+        Byte offset of the start of a line
+
+    size : integer
+        Initial number of bytes read before the offset
+
+    Returns
+    --------
+    line : bytes
+        Last non-blank line before the offset, without the
+        trailing white spaces. Empty if there is none.
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import last_line_before
+    >>> with open('example_data/example_data.csv','rb') as ff:
+    ...     print(last_line_before(ff, 135735).split(b',')[0])
+    b'Date and Time'
+    """
+
+    while True:
+        start = max(offset - size, 0)
+        ff.seek(start)
+        text = ff.read(offset - start).rstrip()
+        inl = text.rfind(b"\n")
+        if inl >= 0 or start == 0:
+            return text[inl + 1 :]
+        size *= 2
+
+
+def data_blocks(infile, start=None, size=blocksize, end=None):
+    """
+    Given a Novonix data file, read the data section
+    in large blocks of complete rows.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
         Name of the input Novonix data file
 
-    column_name : string
-        Name of the column to be read
+    start : integer
+        Byte offset to start reading from,
+        by default the start of the data
 
-    outtype : string
-        Type of data of the column to be read
+    end : integer
+        Byte offset to stop reading at, by default the end of the file
+
+    size : integer
+        Approximate size in bytes of the blocks
 
     Returns
     --------
-    column_data : numpy array of the given type
-        Column of interest read as a str
+    offset : integer
+        Byte offset of the block in the file (generated)
+
+    block : bytes
+        Block of complete data rows (generated)
 
     Examples
     ---------
-    >>> from preparenovonix.novonix_io import read_column
-    >>> col = read_column('example_data/example_data_prep.csv',
-    'Step Number',outtype='int')
-    >>> print(col[0])
-    0
+    >>> from preparenovonix.novonix_io import data_blocks
+    >>> for offset, block in data_blocks('example_data/example_data_prep.csv'):
+    ...     print(offset)
+    29124
     """
 
-    # Check if the file has the expected structure for a Novonix data file
-    answer = isnovonix(infile)
-    if not answer:
-        sys.exit("STOP Input not from Novonix, {}".format(infile))
-
-    # Find the position of the given column name
-    icol = icolumn(infile, column_name)
-    if icol < 0:
-        sys.exit(
-            "STOP novonix_io.readcolumn \n"
-            + "REASON "
-            + column_name
-            + " columnn \n"
-            + "      not found in "
-            + str(infile)
-            + " \n"
-        )
+    nf = novonix_file(infile)
+    if start is None:
+        start = nf.data_start
+
+    def read_from(ff, position):
+        if end is None:
+            return ff.read(size)
+        return ff.read(max(min(size, end - position), 0))
+
+    with open(nf.infile, "rb") as ff:
+        offset = start
+        ff.seek(offset)
+        data = read_from(ff, offset)
+        while data:
+            # Cut the block after the last complete row
+            iend = data.rfind(b"\n") + 1
+            if iend == 0:
+                # Last row without an end of line or a very long row
+                more = read_from(ff, offset + len(data))
+                if more:
+                    data = data + more
+                    continue
+                iend = len(data)
+
+            if iend < len(data):
+                yield offset, data[:iend]
+            else:
+                yield offset, data
+            offset += iend
+            ff.seek(offset)
+            data = read_from(ff, offset)
+
+
+def parse_data_block(block, icols, dtypes, encoding="utf-8", infile=None, row=0):
+    r"""
+    Given a block of complete data rows, read the columns
+    in the positions icols with vectorized operations.
+    Only rows with an unexpected number of columns are split
+    one by one.
+
+    Parameters
+    -----------
+    block : bytes
+        Block of complete data rows
 
-    # Initialise empty list
-    column_data = []
+    icols : list of integers
+        Positions of the columns to be read
 
-    with open(infile, "r") as ff:
-        # Read until the data starts
-        for line in ff:
-            if line.strip():
-                char1 = line.strip()[0]
-                if char1 in nv.numberstr:
-                    break
+    dtypes : list of strings
+        Type of data of each column
 
-        # Read first value of the column
-        val = line.split(",")[icol].rstrip()
-        column_data.append(val)
+    encoding : string
+        Encoding of the file, used for columns read as strings
 
-        # Read the rest of the column of interest
-        for line in ff:
-            val = line.split(",")[icol].rstrip()
-            column_data.append(val)
+    infile : string or NovonixFile
+        Name of the file, for the error raised for rows
+        with too few columns
 
-        # Transform the list into a numpy array
-        column_data = np.array(column_data)
+    row : integer
+        Number of the first data row in the block, for that error
 
-        column = column_data.astype(getattr(np, outtype))
+    Returns
+    --------
+    values : list of numpy arrays
+        Values of each column in the block
 
-    return column
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_io import parse_data_block
+    >>> parse_data_block(b"a,1,0.5\nb,2,1.5\n", [1, 2], ["int", "float"])
+    [array([1, 2]), array([0.5, 1.5])]
+    """
+
+    if not block:
+        return [np.array([], dtype=np.dtype(dtype)) for dtype in dtypes]
+
+    if not block.endswith(b"\n"):
+        block = block + b"\n"
+
+    # Position of the end of each row and of each comma
+    buf = np.frombuffer(block, dtype=np.uint8)
+    ends = np.flatnonzero(buf == ord("\n"))
+    commas = np.flatnonzero(buf == comma)
+
+    # Number of columns in each row
+    ncommas = np.diff(np.concatenate(([0], np.searchsorted(commas, ends))))
+    ncols = np.bincount(ncommas).argmax() + 1
+    good = ncommas == ncols - 1
+
+    if good.all():
+        return _fields_to_arrays(block, buf, ends, commas, ncols, icols, dtypes, encoding)
+
+    # Split one by one the rows with a different number of columns
+    lines = block.split(b"\n")[: len(ends)]
+    good_block = b"\n".join([line for line, isgood in zip(lines, good) if isgood])
+    good_values = parse_data_block(good_block, icols, dtypes, encoding=encoding)
+    ibad = np.flatnonzero(~good)
+    bad_rows = [lines[irow].split(b",") for irow in ibad]
+    for irow, fields in zip(ibad, bad_rows):
+        if icols and len(fields) <= max(icols):
+            raise ColumnError(
+                "less than {} columns in data row {}: {!r}".format(
+                    max(icols) + 1, row + irow, lines[irow]
+                ),
+                infile=infile,
+                where="novonix_io.parse_data_block",
+            )
+
+    values = []
+    for icol, dtype, good_val in zip(icols, dtypes, good_values):
+        bad_val = _to_array([fields[icol] for fields in bad_rows], dtype, encoding)
+        val = np.empty(len(ends), dtype=np.result_type(good_val, bad_val))
+        val[good] = good_val
+        val[~good] = bad_val
+        values.append(val)
+
+    return values
+
+
+def _fields_to_arrays(block, buf, ends, commas, ncols, icols, dtypes, encoding):
+    """
+    Given a block of rows, all with ncols columns, convert the columns
+    of interest into arrays. The numerical columns are extracted
+    together and parsed with a single call to numpy.
+    """
+
+    nrows = len(ends)
+    values = [None] * len(icols)
+
+    # Start and end (after the separator) of each field
+    stops = np.empty((nrows, ncols), dtype=np.int64)
+    stops[:, :-1] = commas.reshape(nrows, ncols - 1) + 1
+    stops[:, -1] = ends + 1
+    starts = np.empty((nrows, ncols), dtype=np.int64)
+    starts[:, 0] = 0
+    starts[1:, 0] = stops[:-1, -1]
+    starts[:, 1:] = stops[:, :-1]
+
+    # Extract the bytes of the numerical columns,
+    # marking the start and end of each field
+    numeric = [
+        ii for ii, dtype in enumerate(dtypes) if np.dtype(dtype).kind in "biuf"
+    ]
+    ucols = sorted(set([icols[ii] for ii in numeric]))
+    if ucols:
+        # Keep only the bytes in the numerical columns,
+        # either gathering them or blanking the rest
+        drop = [icol for icol in range(ncols) if icol not in ucols]
+        widths = stops[0] - starts[0]
+        if widths[ucols].sum() <= widths[drop].sum():
+            selected = buf[_ranges_index(starts[:, ucols], stops[:, ucols])]
+        else:
+            selected = buf.copy()
+            if drop:
+                selected[_ranges_index(starts[:, drop], stops[:, drop])] = blank
+        selected[selected == comma] = blank
+
+        numbers = None
+        with warnings.catch_warnings():
+            # Raise an error if not all the text can be parsed
+            warnings.simplefilter("error", DeprecationWarning)
+            try:
+                numbers = np.fromstring(selected.tobytes(), sep=" ")
+            except (DeprecationWarning, ValueError):
+                pass
+
+        if numbers is not None and len(numbers) == nrows * len(ucols):
+            numbers = numbers.reshape(nrows, len(ucols))
+            for ii in numeric:
+                val = numbers[:, ucols.index(icols[ii])]
+                if np.dtype(dtypes[ii]).kind in "iu" and not (
+                    np.all(val == np.round(val)) and np.all(np.abs(val) < 2 ** 53)
+                ):
+                    # Not exact as floats: the fields are parsed one by one
+                    continue
+                values[ii] = val.astype(np.dtype(dtypes[ii]))
+
+    # Slice the fields of any other column
+    for ii, val in enumerate(values):
+        if val is None:
+            icol = icols[ii]
+            val = [
+                block[istart:istop]
+                for istart, istop in zip(
+                    starts[:, icol].tolist(), (stops[:, icol] - 1).tolist()
+                )
+            ]
+            values[ii] = _to_array(val, dtypes[ii], encoding)
+
+    return values
+
+
+def _ranges_index(starts, stops):
+    """
+    Positions of all the bytes within the ranges [starts, stops),
+    taken in the order given by the flattened arrays.
+    """
+
+    starts = starts.ravel()
+    stops = stops.ravel()
+    lengths = stops - starts
+    itype = np.int32 if stops[-1] < 2 ** 31 else np.int64
+    steps = np.ones(lengths.sum(), dtype=itype)
+    steps[0] = starts[0]
+    steps[np.cumsum(lengths[:-1])] = starts[1:] - stops[:-1] + 1
+    return np.cumsum(steps, dtype=itype)
+
+
+def _to_array(tokens, dtype, encoding):
+    """
+    Convert a list of byte tokens into an array of the given type.
+    """
+
+    dtype = np.dtype(dtype)
+    column_data = np.array(tokens, dtype=bytes)
+    if dtype.kind in "SU":
+        column_data = np.char.rstrip(column_data)
+        if dtype.kind == "U":
+            column_data = np.char.decode(column_data, encoding)
+        return column_data
+    return column_data.astype(dtype)
+
+
+@contextmanager
+def temporary_file(outfile):
+    """
+    Context manager creating a new empty temporary file, with a unique name,
+    in the same directory as outfile. The temporary file is removed
+    on exit if it has not been moved by then, for example with replace_file.
+    This allows to prepare several files at the same time, from different
+    threads or processes.
+
+    Parameters
+    ----------
+    outfile : string
+        Name of the file to be finally written
+
+    Returns
+    --------
+    tmp_file : string
+        Name of the temporary file
+
+    Examples
+    ---------
+    >>> import os, shutil, tempfile
+    >>> from preparenovonix.novonix_io import temporary_file, replace_file
+    >>> tmp_dir = tempfile.mkdtemp()
+    >>> outfile = os.path.join(tmp_dir, "example_copy.csv")
+    >>> with temporary_file(outfile) as tmp_file:
+    ...     with open(tmp_file, "w") as tf:
+    ...         nw = tf.write("Example")
+    ...     replace_file(tmp_file, outfile)
+    >>> print(os.listdir(tmp_dir))
+    ['example_copy.csv']
+    >>> shutil.rmtree(tmp_dir)
+    """
+
+    dirname, fname = os.path.split(os.path.abspath(outfile))
+
+    # Create the file only if its name is not already in use
+    while True:
+        tmp_file = os.path.join(
+            dirname, ".{}.{}.tmp".format(fname, os.urandom(6).hex())
+        )
+        try:
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except FileExistsError:
+            continue
+        os.close(fd)
+        break
+
+    try:
+        yield tmp_file
+    finally:
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+
+
+@contextmanager
+def appended_file(outfile, offset):
+    r"""
+    Context manager for replacing in place the content of outfile after
+    a byte offset. On exit the file is flushed to disk. If an exception
+    is raised, the replaced bytes, and the modification time of the file,
+    are restored. Only the bytes after offset are kept in memory.
+
+    Parameters
+    ----------
+    outfile : string
+        Name of the file to be completed
+
+    offset : integer
+        Byte offset from which the content of outfile is replaced
+
+    Examples
+    ---------
+    >>> import os, shutil, tempfile
+    >>> from preparenovonix.novonix_io import appended_file
+    >>> tmp_dir = tempfile.mkdtemp()
+    >>> outfile = os.path.join(tmp_dir, "a.csv")
+    >>> with open(outfile, "w") as ff:
+    ...     nw = ff.write("1,2\n3,")
+    >>> with appended_file(outfile, 4):
+    ...     with open(outfile, "r+") as ff:
+    ...         nw = ff.seek(4)
+    ...         nw = ff.write("3,4\n")
+    >>> print(open(outfile).read().split())
+    ['1,2', '3,4']
+    >>> shutil.rmtree(tmp_dir)
+    """
+
+    stat = os.stat(outfile)
+    with open(outfile, "rb") as ff:
+        ff.seek(offset)
+        tail = ff.read()
+
+    try:
+        yield
+    except BaseException:
+        # Leave the file as it was
+        with open(outfile, "r+b") as ff:
+            ff.seek(offset)
+            ff.truncate()
+            ff.write(tail)
+            ff.flush()
+            os.fsync(ff.fileno())
+        os.utime(outfile, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        raise
+
+    # Flush the completed file to disk
+    fd = os.open(outfile, os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
 def replace_file(newfile, infile, newbigger=False):
     """
     Replace infile by newfile, testing, if adequate,
     if the new file is larger than the older.
+    The new file is flushed to disk and then renamed, thus infile
+    is never seen incomplete. If infile exists, its permissions are kept.
 
     Parameters
     ----------
@@ -346,15 +2542,45 @@ def replace_file(newfile, infile, newbigger=False):
         size_original = os.stat(infile).st_size
         size_tmp = os.stat(newfile).st_size
         if size_original > size_tmp:
-            sys.exit(
-                "STOP novonix_io.replace_file \n"
-                + "REASON new file is smaller than the original one \n"
-                + "       "
-                + str(infile)
+            raise OutputError(
+                "new file is smaller than the original one",
+                infile=infile,
+                where="novonix_io.replace_file",
             )
 
+    # Flush the new file to disk
+    fd = os.open(newfile, os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    if os.path.isfile(infile):
+        copymode(infile, newfile)
+
     # Replace the input file with the new one
-    move(newfile, infile)
+    try:
+        os.replace(newfile, infile)
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+        # The files are in different file systems
+        move(newfile, infile)
+
+    # Flush the renaming to disk, where possible
+    if hasattr(os, "O_DIRECTORY"):
+        try:
+            fd = os.open(
+                os.path.dirname(os.path.abspath(infile)), os.O_RDONLY | os.O_DIRECTORY
+            )
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
     return
 
 
@@ -443,7 +2669,7 @@ def get_col_names(infile):
 
     Parameters
     -----------
-    infile : string
+    infile : string or NovonixFile
         Name of the input Novonix data file
 
     Returns
@@ -459,25 +2685,9 @@ def get_col_names(infile):
     Step Number
     """
 
-    # Check if the file has the expected structure for a Novonix data file
-    answer = isnovonix(infile)
-    if not answer:
-        sys.exit("STOP Input not from Novonix, {}".format(infile))
-
-    # Initialise the list
-    col_names = []
-
-    with open(infile, "r") as ff:
-        # Read until the line with [Data]
-        for line in ff:
-            if "[Data]" in line:
-                break
+    nf = novonix_file(infile)
 
-        # Read the column names
-        col_names1 = ff.readline().split(",")
-        for i, coln1 in enumerate(col_names1):
-            coln = coln1.replace("\n", "").replace("\r", "").strip()
-            col_names.append(coln)
+    col_names = list(nf.col_names)
 
     return col_names
 
@@ -489,7 +2699,7 @@ def get_num_measurements(infile):
 
     Parameters
     -----------
-    infile : string
+    infile : string or NovonixFile
         Name of the input Novonix data file
 
     Returns
@@ -504,26 +2714,25 @@ def get_num_measurements(infile):
     5752
     """
 
-    # Check if the file has the expected structure for a Novonix data file
-    answer = isnovonix(infile)
-    if not answer:
-        sys.exit("STOP Input not from Novonix, {}".format(infile))
+    nf = novonix_file(infile)
 
-    nmeasurements = 0
+    # Include first measurement
+    nmeasurements = 1
 
-    with open(infile, "r") as ff:
-        # Read until the data starts
-        for line in ff:
-            if line.strip():
-                char1 = line.strip()[0]
-                if char1 in nv.numberstr:
-                    break
+    with open(nf.infile, "rb") as ff:
+        # Jump to the start of the data
+        ff.seek(nf.data_start)
 
-        # Include first measurement
-        nmeasurements += 1
+        # Count all the measurements, by blocks
+        last_char = b""
+        block = ff.read(blocksize)
+        while block:
+            nmeasurements += block.count(b"\n")
+            last_char = block[-1:]
+            block = ff.read(blocksize)
 
-        # Count all the measurements
-        for line in ff:
-            nmeasurements += 1
+    # Do not count the end of the last line
+    if last_char == b"\n":
+        nmeasurements -= 1
 
     return nmeasurements
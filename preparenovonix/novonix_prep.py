@@ -1,20 +1,655 @@
+import io
 import sys
+import os.path
+import re
+import copy
+import time
+import hashlib
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 import preparenovonix.novonix_variables as nv
-from preparenovonix.novonix_io import get_infile
-from preparenovonix.novonix_io import icolumn
+from preparenovonix import __version__
+from preparenovonix.novonix_io import after_file_name
+from preparenovonix.novonix_io import NovonixFile
+from preparenovonix.novonix_io import novonix_file
 from preparenovonix.novonix_io import isnovonix
-from preparenovonix.novonix_add import create_reduced_protocol
-from preparenovonix.novonix_add import novonix_add_loopnr
-from preparenovonix.novonix_add import novonix_add_state
-from preparenovonix.novonix_clean import cleannovonix
+from preparenovonix.novonix_io import iter_data_chunks
+from preparenovonix.novonix_io import column_positions
+from preparenovonix.novonix_io import replace_file
+from preparenovonix.novonix_io import temporary_file
+from preparenovonix.novonix_io import appended_file
+from preparenovonix.novonix_io import select_rows
+from preparenovonix.novonix_io import split_rows
+from preparenovonix.novonix_io import write_columns
+from preparenovonix.novonix_io import append_columns
+from preparenovonix.novonix_io import rows_end
+from preparenovonix.novonix_io import data_blocks
+from preparenovonix.novonix_io import save_checkpoint
+from preparenovonix.novonix_io import read_checkpoint
+from preparenovonix.novonix_io import save_segments
+from preparenovonix.novonix_io import file_hash
+from preparenovonix.novonix_io import read_manifest
+from preparenovonix.novonix_io import append_manifest
+from preparenovonix.novonix_errors import NovonixError
+from preparenovonix.novonix_errors import NotNovonixError
+from preparenovonix.novonix_errors import StateMismatchError
+from preparenovonix.novonix_errors import OptionError
+from preparenovonix.novonix_errors import exit_on_error
+from preparenovonix.novonix_add import column_check
+from preparenovonix.novonix_add import state_carry
+from preparenovonix.novonix_add import state_values
+from preparenovonix.novonix_add import state_counts_check
+from preparenovonix.novonix_add import find_reduced_protocol
+from preparenovonix.novonix_add import reduce_protocol
+from preparenovonix.novonix_add import count_steps
+from preparenovonix.novonix_add import protocol_steps_check
+from preparenovonix.novonix_add import protocol_carry
+from preparenovonix.novonix_add import loopnr_chunk
+from preparenovonix.novonix_add import segment_carry
+from preparenovonix.novonix_add import segment_chunk
+from preparenovonix.novonix_add import segment_table
+from preparenovonix.novonix_clean import clean_header
+from preparenovonix.novonix_clean import clean_carry
+from preparenovonix.novonix_clean import clean_mask
+from preparenovonix.novonix_clean import clean_block
+
+
+def prepared_chunks(
+    infile,
+    start,
+    ccarry,
+    scarry=None,
+    chunk_rows=None,
+    read_states=False,
+    read_lines=True,
+    verbose=False,
+    gcarry=None,
+    sha=None,
+    end=None,
+    final=True,
+    before_final=None,
+):
+    r"""
+    Given a Novonix data file, clean its data and, if required,
+    work out the State column, by chunks of data rows.
+
+    Parameters
+    -----------
+    infile : string or NovonixFile
+        Name of the input Novonix file
+
+    start : int
+        Byte offset of the first data row to be read, from clean_header
+
+    ccarry : dictionary
+        Values carried over between chunks for the cleaning,
+        as returned by clean_carry
+
+    scarry : dictionary
+        Values carried over between chunks for the State column,
+        as returned by state_carry. None if the State column is not
+        to be worked out.
+
+    chunk_rows : integer
+        Number of data rows processed at a time,
+        None to process all the data at once
+
+    read_states : boolean
+        True to read the State column from the file,
+        when it is not worked out
+
+    read_lines : boolean
+        False to only get the Step Number and State of the rows
+
+    verbose : boolean
+        Yes = print out some informative statements
+
+    gcarry : dictionary
+        Values carried over between chunks for the table of the sets
+        of measurements, as returned by segment_carry. None if the
+        table is not needed or the State is not known.
+
+    sha : hashlib object
+        Hash updated with the raw data rows, as they are read.
+        None if not needed.
+
+    end : integer
+        Byte offset to stop reading at, by default the end of the file
+
+    final : boolean
+        True if the data read are the last ones, so that the State of
+        the last rows is final. False to keep them waiting in scarry
+        (for example, when more rows are going to be appended).
+
+    before_final : function
+        Function called, without arguments, once all the data have been
+        read and before the State of the last rows is made final
+
+    Returns
+    --------
+    block : bytes
+        Cleaned data rows, None if read_lines is False (generated)
+
+    steps : array of integers
+        Step Number of the rows, None if the State is not needed
+        (generated)
+
+    states : array of integers
+        State of the rows, None if the State is not needed (generated)
+
+    Examples
+    ---------
+    >>> import preparenovonix.novonix_prep as prep
+    >>> from preparenovonix.novonix_clean import clean_header, clean_carry
+    >>> infile = 'example_data/example_data.csv'
+    >>> header, start = clean_header(infile)
+    >>> for block, steps, states in prep.prepared_chunks(
+    ...         infile,start,clean_carry(infile)):
+    ...     print(block.count(b"\n"))
+    5753
+    """
+
+    nf = novonix_file(infile)
+
+    names = [nv.col_t, nv.col_c]
+    dtypes = ["float", "float"]
+    if scarry is not None:
+        names.extend([nv.col_step, nv.col_tstep])
+        dtypes.extend(["S", "float"])
+    elif read_states:
+        names.extend([nv.col_step, nv.state_col])
+        dtypes.extend(["int", "int"])
+
+    stop = nf.size if end is None else end
+    chunks = []
+    if start < stop:
+        chunks = iter_data_chunks(nf, names, chunk_rows, dtypes, start=start, end=end)
+    for row, offset, columns, chunk in chunks:
+        if sha is not None:
+            sha.update(chunk)
+
+        # Clean the data
+        keep = clean_mask(columns[nv.col_t], ccarry)
+        ccarry["nread"] += len(keep)
+        block = None
+        if read_lines:
+            block = clean_block(chunk, keep, columns[nv.col_c], ccarry)
+
+        # Run Time and Capacity of the cleaned rows
+        times = columns[nv.col_t][keep]
+        capacity = columns[nv.col_c][keep]
+        if ccarry["ntests"] > 1:
+            capacity = capacity + float(ccarry["last_capacity"])
+
+        if scarry is None:
+            steps = None
+            states = None
+            if read_states:
+                steps = columns[nv.col_step][keep]
+                states = columns[nv.state_col][keep]
+                if gcarry is not None:
+                    segment_chunk(states, steps, times, capacity, gcarry)
+            ccarry["nkept"] += len(times)
+            yield block, steps, states
+            continue
+
+        # Work out the State, final for all but the last rows
+        steps = columns[nv.col_step][keep]
+        states = state_values(
+            steps, columns[nv.col_tstep][keep], scarry, verbose=verbose
+        )
+        yield state_rows(
+            states, steps.astype(int), times, capacity, block, ccarry, scarry, gcarry
+        )
+
+    if before_final is not None:
+        before_final()
+
+    if scarry is not None and final:
+        # The last rows of the file
+        states = state_values([], [], scarry, final=True, verbose=verbose)
+        block = None
+        if read_lines:
+            block = b""
+        rows = state_rows(
+            states,
+            np.array([], dtype=int),
+            np.array([], dtype=float),
+            np.array([], dtype=float),
+            block,
+            ccarry,
+            scarry,
+            gcarry,
+        )
+        if len(rows[1]) > 0:
+            yield rows
+
+
+def state_rows(states, steps, times, capacity, block, ccarry, scarry, gcarry=None):
+    """
+    Given the State of the rows waiting for it and of a new chunk of
+    rows, get the rows with a final State, keeping the rest in scarry.
+    The rows with State=-99 are removed.
+
+    Parameters
+    -----------
+    states : array of integers
+        Final State values, as returned by novonix_add.state_values
+
+    steps : array of integers
+        Step Number of the new rows
+
+    times : array of floats
+        Run Time of the new rows
+
+    capacity : array of floats
+        Capacity of the new rows
+
+    block : bytes
+        New data rows, None if they are not needed
+
+    ccarry : dictionary
+        Values carried over when cleaning the data,
+        as returned by clean_carry
+
+    scarry : dictionary
+        Values carried over when working out the State,
+        as returned by state_carry, with the waiting rows
+
+    gcarry : dictionary
+        Values carried over for the table of the sets of measurements,
+        as returned by segment_carry. None if not needed.
+
+    Returns
+    --------
+    block : bytes
+        Data rows with a final State, None if block is None
+
+    steps : array of integers
+        Step Number of the rows
+
+    states : array of integers
+        State of the rows
+
+    Examples
+    ---------
+    >>> import numpy as np
+    >>> import preparenovonix.novonix_prep as prep
+    >>> from preparenovonix.novonix_add import state_carry, state_values
+    >>> scarry = state_carry('example.csv')
+    >>> states = state_values([1,1,1],[0.,0.1,0.2],scarry)
+    >>> ccarry = {'nkept': 0}
+    >>> print(prep.state_rows(states,np.array([1,1,1]),np.zeros(3),np.zeros(3),None,ccarry,scarry)[2])
+    [0]
+    """
+
+    nready = len(states)
+
+    steps = np.concatenate([scarry["steps"], steps])
+    scarry["steps"] = steps[nready:]
+    steps = steps[:nready]
+    times = np.concatenate([scarry["times"], times])
+    scarry["times"] = times[nready:]
+    times = times[:nready]
+    capacity = np.concatenate([scarry["capacity"], capacity])
+    scarry["capacity"] = capacity[nready:]
+    capacity = capacity[:nready]
+    if block is not None:
+        block, scarry["data"] = split_rows(
+            scarry["data"] + block, len(scarry["steps"])
+        )
+
+    # Remove the rows with State=-99
+    ind = states > -99
+    if block is not None:
+        block = select_rows(block, ind)
+    if gcarry is not None:
+        segment_chunk(states[ind], steps[ind], times[ind], capacity[ind], gcarry)
+    ccarry["nkept"] += int(ind.sum())
+
+    return block, steps[ind], states[ind]
+
+
+def prepared_blocks(chunks, add_state=False, prot=None, lcarry=None):
+    """
+    Given the chunks of prepared data rows, get the new columns
+    to be appended to them.
+
+    Parameters
+    -----------
+    chunks : iterator
+        Prepared chunks, as generated by prepared_chunks
+
+    add_state : boolean
+        True to append the State column
+
+    prot : list of strings
+        Reduced protocol lines, without the first and last lines,
+        None if the Loop number and Protocol line are not to be appended
+
+    lcarry : dictionary
+        Values carried over between chunks for the Loop number,
+        as returned by protocol_carry
+
+    Returns
+    --------
+    block : bytes
+        Data rows (generated)
+
+    columns : list of arrays
+        New columns, None if there are none (generated)
+
+    keep : None
+        All the rows are kept (generated)
+
+    Examples
+    ---------
+    >>> import preparenovonix.novonix_prep as prep
+    >>> from preparenovonix.novonix_clean import clean_header, clean_carry
+    >>> infile = 'example_data/example_data.csv'
+    >>> header, start = clean_header(infile)
+    >>> chunks = prep.prepared_chunks(infile,start,clean_carry(infile))
+    >>> for block, columns, keep in prep.prepared_blocks(chunks):
+    ...     print(columns)
+    None
+    """
+
+    for block, steps, states in chunks:
+        columns = []
+        if add_state:
+            columns.append(states)
+        if prot is not None:
+            columns.extend(loopnr_chunk(prot, steps, states, lcarry))
+        yield block, (columns or None), None
+
+
+def counted_blocks(blocks, written):
+    r"""
+    Given blocks of data rows with new columns, as generated by
+    prepared_blocks, append the new columns to them, adding
+    the number of bytes of the rows to written['bytes'].
+
+    Parameters
+    -----------
+    blocks : iterator
+        Blocks of data rows, as tuples (block, columns, keep)
+
+    written : dictionary
+        Number of bytes written, in written['bytes'], which is updated
+
+    Returns
+    --------
+    block : bytes
+        Data rows, with the new columns (generated)
+
+    columns : None
+        The new columns are already in the rows (generated)
+
+    keep : None
+        All the rows are kept (generated)
+
+    Examples
+    ---------
+    >>> import numpy as np
+    >>> import preparenovonix.novonix_prep as prep
+    >>> written = {'bytes': 0}
+    >>> for block, columns, keep in prep.counted_blocks(
+    ...         [(b"x,1\n", [np.array([2])], None)], written):
+    ...     print(block, written['bytes'])
+    b'x,1,2\n' 6
+    """
+
+    for block, columns, keep in blocks:
+        if columns is not None:
+            block = append_columns(block, columns, keep=keep)
+        elif keep is not None:
+            block = select_rows(block, keep)
+        written["bytes"] += len(block)
+        yield block, None, None
+
+
+def check_state_counts(scarry, infile):
+    """
+    Check the State values worked out for a prepared file,
+    raising StateMismatchError if they are not consistent.
+
+    Parameters
+    -----------
+    scarry : dictionary
+        Values carried over when working out the State, as returned by
+        state_carry, None if the State column has not been added
+
+    infile : string
+        Name of the prepared Novonix file
+
+    Examples
+    ---------
+    >>> import preparenovonix.novonix_prep as prep
+    >>> prep.check_state_counts(None,'example_data/example_data_prep.csv')
+    """
+
+    if scarry is None:
+        return
+
+    check_pass = state_counts_check(
+        scarry["first"], scarry["last"], scarry["nzeros"], scarry["ntwos"]
+    )
+    if not check_pass:
+        raise StateMismatchError(
+            "unexpected number of starts and ends of the sets of measurements",
+            infile=infile,
+            where="novonix_add.novonix_add_state",
+        )
+
+
+def check_protocol_counts(
+    nf, start, check, infile, chunk_rows=None, end=None, verbose=False
+):
+    """
+    Test a reduced protocol against the number of sets of measurements
+    in the prepared data, counting them from the byte offset start.
+
+    Parameters
+    -----------
+    nf : NovonixFile
+        Index of the input Novonix file
+
+    start : integer
+        Byte offset of the first data row to be counted
+
+    check : dictionary
+        Values carried over: ccarry and scarry (as returned by
+        clean_carry and state_carry, None if the file has a State
+        column), istate (number of sets expected from the protocol)
+        and uniq_step and minus1 (counts so far), which are updated
+
+    infile : string
+        Name of the prepared Novonix file
+
+    chunk_rows : integer
+        Number of data rows processed at a time
+
+    end : integer
+        Byte offset to stop reading at, by default the end of the file
+
+    verbose : boolean
+        Yes = print out some informative statements
+
+    Returns
+    --------
+    viable_prot : boolean
+        True if the reduced protocol is adequate given the data
+
+    saved : dictionary
+        Copy of check before the State of the last rows was made final,
+        to resume the counting when more rows are appended
+
+    Examples
+    ---------
+    >>> import preparenovonix.novonix_prep as prep
+    >>> from preparenovonix.novonix_io import NovonixFile
+    >>> from preparenovonix.novonix_clean import clean_header, clean_carry
+    >>> nf = NovonixFile('example_data/example_data_prep.csv')
+    >>> header, start = clean_header(nf)
+    >>> check = {'ccarry':clean_carry(nf),'scarry':None,'istate':100,'uniq_step':0,'minus1':0}
+    >>> viable_prot, saved = prep.check_protocol_counts(nf,start,check,nf.infile)
+    """
+
+    saved = {}
+
+    def keep_counts():
+        saved.update(copy.deepcopy(check))
+
+    for block, steps, states in prepared_chunks(
+        nf,
+        start,
+        check["ccarry"],
+        scarry=check["scarry"],
+        chunk_rows=chunk_rows,
+        read_states=True,
+        read_lines=False,
+        end=end,
+        before_final=keep_counts,
+    ):
+        nuniq, nminus1 = count_steps(steps, states)
+        check["uniq_step"] += nuniq
+        check["minus1"] += nminus1
+
+    viable_prot = protocol_steps_check(
+        check["istate"],
+        check["uniq_step"],
+        check["minus1"],
+        infile=infile,
+        verbose=verbose,
+    )
+
+    return viable_prot, saved
+
+
+def source_key(file_to_open, start, end, size=4096):
+    """
+    Values identifying the part of a Novonix data file read up to a
+    byte offset: SHA-1 of its header and of the bytes before the offset.
+
+    Parameters
+    -----------
+    file_to_open : string
+        Name of the input Novonix file
+
+    start : integer
+        Byte offset of the first data row
+
+    end : integer
+        Byte offset up to which the file has been read
+
+    size : integer
+        Number of bytes before end to be hashed
+
+    Returns
+    --------
+    key : dictionary
+        source (absolute path), start, end, header and tail (SHA-1)
+
+    Examples
+    ---------
+    >>> import preparenovonix.novonix_prep as prep
+    >>> key = prep.source_key('example_data/example_data.csv',135735,135735)
+    """
+
+    with open(file_to_open, "rb") as ff:
+        header = ff.read(start)
+        tail_start = max(start, end - size)
+        ff.seek(tail_start)
+        tail = ff.read(end - tail_start)
+
+    key = {
+        "source": os.path.abspath(file_to_open),
+        "start": start,
+        "end": end,
+        "header": hashlib.sha1(header).hexdigest(),
+        "tail": hashlib.sha1(tail).hexdigest(),
+    }
+
+    return key
+
+
+def checkpoint_check(checkpoint, nf, end, addstate, lprotocol):
+    """
+    Check if a Novonix data file can be prepared by resuming from the
+    checkpoint of a previous preparation: same options and version,
+    the data read then are unchanged and the new rows after them do
+    not start a new test.
+
+    Parameters
+    -----------
+    checkpoint : dictionary
+        Checkpoint, as read by novonix_io.read_checkpoint, or None
+
+    nf : NovonixFile
+        Index of the input Novonix file
+
+    end : integer
+        Byte offset after the last complete data row
+
+    addstate, lprotocol : booleans
+        Parameters of prepare_novonix
+
+    Returns
+    --------
+    checkpoint : dictionary
+        The checkpoint if it can be used, None otherwise
+
+    Examples
+    ---------
+    >>> import preparenovonix.novonix_prep as prep
+    >>> from preparenovonix.novonix_io import NovonixFile
+    >>> nf = NovonixFile('example_data/example_data.csv')
+    >>> print(prep.checkpoint_check(None,nf,nf.size,True,True))
+    None
+    """
+
+    if checkpoint is None:
+        return None
+    if checkpoint.get("version") != __version__:
+        return None
+    if checkpoint.get("options") != [bool(addstate), bool(lprotocol)]:
+        return None
+    if checkpoint["source"] != os.path.abspath(nf.infile):
+        return None
+    if checkpoint["end"] > end:
+        return None
+
+    key = source_key(nf.infile, checkpoint["start"], checkpoint["end"])
+    if [key["header"], key["tail"]] != [checkpoint["header"], checkpoint["tail"]]:
+        return None
+
+    # A new test starts with a header section
+    for offset, block in data_blocks(nf, start=checkpoint["end"], end=end):
+        if re.search(rb"(^|\n)[ \t]*\[", block):
+            return None
+
+    return checkpoint
 
 
 def prepare_novonix(
-    file_to_open, addstate=False, lprotocol=False, overwrite=False, verbose=False
+    file_to_open,
+    addstate=False,
+    lprotocol=False,
+    overwrite=False,
+    verbose=False,
+    chunk_rows=None,
+    outdir=None,
+    manifest=None,
+    sha=None,
+    append=False,
+    entry=None,
+    report=None,
+    segments=False,
 ):
     """
     Given a Novonix data file, it prepare it to be handled.
+    The file is read once (twice when the reduced protocol needs to be
+    checked against the data) and the prepared file is written once.
 
     Parameters
     -----------
@@ -35,6 +670,53 @@ def prepare_novonix(
     verbose : boolean
         Yes = print out some informative statements
 
+    chunk_rows : integer
+        Number of data rows processed at a time, keeping the memory use
+        independent of the size of the file. None to process all the data
+        at once.
+
+    outdir : string
+        Directory of the new '_prep' file, None for that of the input file
+
+    manifest : string
+        Manifest of prepared files (see novonix_io.read_manifest).
+        If the input file is unchanged since it was last prepared with
+        the same options and version, and the prepared file is as it
+        was left, nothing is done. Otherwise the preparation is
+        appended to the manifest.
+
+    sha : hashlib object
+        Hash updated with the content of the input file, as it is read.
+        Not used when appending.
+
+    append : boolean
+        True for input files still being written: a checkpoint of the
+        preparation is kept in the cache of the prepared file, and once
+        more rows have been appended to the input file, only those are
+        read and the prepared file is completed with them. A last row
+        without an end of line is left for a later call. The prepared
+        file is then the same as preparing the whole input file again.
+        The input file is prepared from the start if its header or the
+        last bytes read before have changed, or the prepared file has
+        been modified.
+
+    entry : dictionary
+        Last entry of the input file in the manifest, if already read,
+        see manifest_lookup
+
+    report : dictionary
+        Updated in place with status: 'skipped' if the file is unchanged
+        according to the manifest, 'prepared' otherwise
+
+    segments : boolean
+        True to save the table of the sets of measurements in the
+        cache directory of the prepared file, see novonix_io.save_segments
+
+    Returns
+    --------
+    nread, nkept : integers
+        Number of data rows read from the input file and written
+        to the prepared one (as recorded in the manifest, if unchanged)
 
     Notes
     -----
@@ -44,35 +726,632 @@ def prepare_novonix(
     Examples
     ---------
     >>> import preparenovonix.novonix_prep as prep
-    >>> prep.prepare_novonix('example_data/example_data.csv',addstate=True,lprotocol=True,overwrite=False,verbose= False)
+    >>> nread, nkept = prep.prepare_novonix('example_data/example_data.csv',addstate=True,lprotocol=True,overwrite=False,verbose= False)
     File example_data_prep.csv has been prepared.
+    >>> print(nread, nkept)
+    5758 5752
     """
 
-    # Get the input file to work on
-    infile, fname = get_infile(file_to_open, overwrite=overwrite)
+    if append and overwrite:
+        raise OptionError(
+            "append can not be used when overwriting the input file",
+            where="novonix_prep.prepare_novonix",
+        )
+
+    # Get the names of the input and output files
+    dirname, fname = os.path.split(os.path.abspath(file_to_open))
+    if overwrite:
+        infile = os.path.join(dirname, fname)
+    else:
+        infile = after_file_name(file_to_open, outdir=outdir)
+
+    if manifest is not None:
+        options = manifest_options(addstate, lprotocol, overwrite, outdir)
+        entry, source = manifest_lookup(file_to_open, options, manifest, entry=entry)
+        if entry is not None:
+            print("File {} is unchanged, it has not been prepared again.".format(fname))
+            if report is not None:
+                report["status"] = "skipped"
+            return entry["nread"], entry["nkept"]
+        if sha is None and source["sha1"] is None and not append:
+            sha = hashlib.sha1()
+    if report is not None:
+        report["status"] = "prepared"
+    if append:
+        sha = None
 
     # Check if the file has the expected structure for a Novonix file
-    answer = isnovonix(infile)
+    nf = NovonixFile(file_to_open)
+    answer = isnovonix(nf)
     if not answer:
-        sys.exit("STOP Input not from Novonix, {}".format(infile))
+        raise NotNovonixError(
+            nf.error.reason, infile=file_to_open, where="novonix_prep.prepare_novonix"
+        )
+
+    # Resume from the checkpoint of a previous preparation
+    end = None
+    resume = None
+    if append:
+        end = rows_end(nf)
+        resume = checkpoint_check(read_checkpoint(infile), nf, end, addstate, lprotocol)
+        if resume is not None and resume["end"] == end:
+            print("File {} has no new data rows.".format(fname))
+            return resume["nread"], resume["nkept"]
+
+    # Header of the cleaned file
+    if resume is None:
+        header, start = clean_header(nf)
+    else:
+        start = resume["start"]
+    if sha is not None:
+        with open(nf.infile, "rb") as ff:
+            sha.update(ff.read(start))
+
+    if resume is not None:
+        add_state = resume["add_state"]
+        add_loop = resume["add_loop"]
+        ccarry = resume["ccarry"]
+        scarry = resume["scarry"]
+        lcarry = resume["lcarry"]
+        gcarry = resume["gcarry"]
+        check = resume["check"]
+        prot = resume["prot"]
+        if check is not None:
+            # Test again the protocol, including the new data
+            viable_prot, check = check_protocol_counts(
+                nf, resume["end"], check, infile, chunk_rows, end=end, verbose=verbose
+            )
+            if viable_prot != lcarry["viable_prot"]:
+                resume = None
+                header, start = clean_header(nf)
+
+    if resume is None:
+        # Check which columns need to be added
+        add_state = False
+        if addstate:
+            add_state = not column_check(nf, nv.state_col, verbose=verbose)
+        add_loop = False
+        if lprotocol:
+            add_loop = not column_check(nf, nv.loop_col, verbose=verbose)
+            if add_loop and not add_state:
+                # The State column is needed
+                column_positions(nf, [nv.state_col])
+
+        ccarry = clean_carry(nf)
+        scarry = None
+        lcarry = None
+        check = None
+        prot = None
+        if add_state:
+            scarry = state_carry(infile, ihead=len(header))
+
+        # Get the reduced protocol as a list
+        if add_loop:
+            protocol, viable_prot = find_reduced_protocol(header, infile)
+            if not viable_prot:
+                protocol, istate = reduce_protocol(io.StringIO("".join(header)), infile)
+
+                # Test the obtained protocol against the prepared data
+                check = {
+                    "ccarry": dict(ccarry),
+                    "scarry": None,
+                    "istate": istate,
+                    "uniq_step": 0,
+                    "minus1": 0,
+                }
+                if add_state:
+                    check["scarry"] = state_carry(infile, ihead=len(header))
+                viable_prot, check = check_protocol_counts(
+                    nf, start, check, infile, chunk_rows, end=end, verbose=verbose
+                )
+            prot = protocol[1:-1]
+            lcarry = protocol_carry(infile, viable_prot)
+
+        # Header, with the reduced protocol and the new column names
+        if add_loop:
+            header = header[:-2] + protocol + header[-2:]
+        new_head = header[-1]
+        if add_state:
+            new_head = str(new_head.rstrip()) + ", " + nv.state_col + " \n"
+        if add_loop:
+            new_head = (
+                str(new_head.rstrip()) + ", " + nv.line_col + ", " + nv.loop_col + " \n"
+            )
+        header = header[:-1] + [new_head]
+
+        # Table of the sets of measurements, when the State is known
+        gcarry = None
+        if segments and (add_state or add_loop):
+            gcarry = segment_carry()
+
+    # Values to resume the preparation, taken before the State of
+    # the last rows is made final
+    checkpoint = {}
+    written = {"bytes": 0}
+    if resume is None:
+        written["bytes"] = len("".join(header).encode(nf.encoding))
+    else:
+        written["bytes"] = resume["out_offset"]
+
+    def keep_checkpoint():
+        checkpoint.update(
+            copy.deepcopy(
+                {
+                    "add_state": add_state,
+                    "add_loop": add_loop,
+                    "ccarry": ccarry,
+                    "scarry": scarry,
+                    "lcarry": lcarry,
+                    "gcarry": gcarry,
+                    "check": check,
+                    "prot": prot,
+                }
+            )
+        )
+        checkpoint["out_offset"] = written["bytes"]
+
+    chunks = prepared_chunks(
+        nf,
+        start if resume is None else resume["end"],
+        ccarry,
+        scarry=scarry,
+        chunk_rows=chunk_rows,
+        read_states=add_loop,
+        verbose=verbose,
+        gcarry=gcarry,
+        sha=sha,
+        end=end,
+        before_final=keep_checkpoint if append else None,
+    )
+    if add_loop:
+        blocks = prepared_blocks(chunks, add_state, prot=prot, lcarry=lcarry)
+    else:
+        blocks = prepared_blocks(chunks, add_state)
+    if append:
+        blocks = counted_blocks(blocks, written)
+
+    if resume is None:
+        # Write the prepared file in a temporary file
+        with temporary_file(infile) as tmp_file:
+            write_columns(tmp_file, header, blocks, encoding=nf.encoding)
+            check_state_counts(scarry, infile)
+
+            # Move the temporary file to the prepared one
+            replace_file(tmp_file, infile, newbigger=False)
+    else:
+        # Replace the last rows of the prepared file and append the new
+        # ones, restoring the last rows if the new ones can not be prepared
+        with appended_file(infile, resume["out_offset"]):
+            write_columns(
+                infile, None, blocks, encoding=nf.encoding, offset=resume["out_offset"]
+            )
+            check_state_counts(scarry, infile)
+
+    # Keep the table of the sets of measurements
+    if segments and gcarry is not None:
+        save_segments(infile, segment_table(gcarry, lcarry))
+
+    if append:
+        checkpoint.update(source_key(file_to_open, start, end))
+        checkpoint.update(
+            {
+                "options": [bool(addstate), bool(lprotocol)],
+                "version": __version__,
+                "nread": ccarry["nread"],
+                "nkept": ccarry["nkept"],
+            }
+        )
+        save_checkpoint(infile, checkpoint)
+
+    if verbose:
+        if add_state:
+            print("{} contains now a State column".format(infile))
+        if add_loop:
+            print(
+                "{} contains now the columns Loop number and Protocol line".format(
+                    infile
+                )
+            )
+
+    if resume is None:
+        print("File {} has been prepared.".format(fname))
+    else:
+        print("File {} has been prepared, reading only its new rows.".format(fname))
+
+    if manifest is not None:
+        if source["sha1"] is None and sha is not None:
+            source["sha1"] = sha.hexdigest()
+        elif source["sha1"] is None:
+            source["sha1"] = file_hash(file_to_open)
+        manifest_record(
+            manifest, source, options, infile, ccarry["nread"], ccarry["nkept"]
+        )
+
+    return ccarry["nread"], ccarry["nkept"]
+
+
+def manifest_options(addstate, lprotocol, overwrite, outdir):
+    """
+    Options of prepare_novonix that change the prepared file,
+    as recorded in the manifest of prepared files.
+
+    Parameters
+    -----------
+    addstate, lprotocol, overwrite, outdir :
+        Parameters of prepare_novonix
+
+    Returns
+    --------
+    options : dictionary
+        Options, with outdir as an absolute path
+
+    Examples
+    ---------
+    >>> import preparenovonix.novonix_prep as prep
+    >>> print(prep.manifest_options(True,True,False,None)['addstate'])
+    True
+    """
+
+    if outdir is not None:
+        outdir = os.path.abspath(outdir)
+
+    options = {
+        "addstate": bool(addstate),
+        "lprotocol": bool(lprotocol),
+        "overwrite": bool(overwrite),
+        "outdir": outdir,
+    }
+
+    return options
+
+
+def manifest_lookup(file_to_open, options, manifest, entry=None):
+    """
+    Check if a Novonix data file is unchanged since it was last
+    prepared, as recorded in a manifest of prepared files. It is
+    unchanged if the options and version are the same, the prepared
+    file has its recorded size and modification time and either the
+    input file has its recorded size and modification time or the
+    SHA-1 of its content (read in blocks) is the recorded one.
+
+    Parameters
+    -----------
+    file_to_open : string
+        Name of the input Novonix file
+
+    options : dictionary
+        Options, as given by manifest_options
+
+    manifest : string
+        Name of the manifest file
+
+    entry : dictionary
+        Last entry of the input file in the manifest, if already read.
+        None to read it from the manifest, {} if there is none.
+
+    Returns
+    --------
+    entry : dictionary
+        Entry of the input file if it is unchanged, None otherwise
+
+    source : dictionary
+        Absolute path (source), size, modification time (mtime, ns) and
+        SHA-1 (sha1, None if it has not been needed) of the input file
+
+    Examples
+    ---------
+    >>> import preparenovonix.novonix_prep as prep
+    >>> options = prep.manifest_options(True,True,False,None)
+    >>> entry, source = prep.manifest_lookup('example_data/example_data.csv',options,'manifest.jsonl')
+    """
+
+    path = os.path.abspath(file_to_open)
+    stat = os.stat(path)
+    source = {
+        "source": path,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "sha1": None,
+    }
+
+    if entry is None:
+        entry = read_manifest(manifest).get(path, {})
+    if not entry:
+        return None, source
+    if entry.get("options") != options or entry.get("version") != __version__:
+        return None, source
+
+    # The prepared file should be as it was left
+    try:
+        ostat = os.stat(entry["output"])
+    except (OSError, KeyError, TypeError):
+        return None, source
+    if [ostat.st_size, ostat.st_mtime_ns] != [entry["out_size"], entry["out_mtime"]]:
+        return None, source
+    if entry["output"] == path:
+        # Overwritten input file
+        return entry, source
+
+    if [source["size"], source["mtime"]] == [entry["size"], entry["mtime"]]:
+        source["sha1"] = entry["sha1"]
+        return entry, source
+
+    source["sha1"] = file_hash(path)
+    if source["sha1"] != entry["sha1"]:
+        return None, source
+
+    return entry, source
+
+
+def manifest_record(manifest, source, options, outfile, nread, nkept):
+    """
+    Append to a manifest of prepared files the entry of a prepared file.
+
+    Parameters
+    -----------
+    manifest : string
+        Name of the manifest file
+
+    source : dictionary
+        Input file, as given by manifest_lookup, with its SHA-1
+
+    options : dictionary
+        Options, as given by manifest_options
+
+    outfile : string
+        Name of the prepared file
+
+    nread, nkept : integers
+        Number of data rows read and written
+
+    Examples
+    ---------
+    >>> import os, shutil, tempfile
+    >>> import preparenovonix.novonix_prep as prep
+    >>> tmp_dir = tempfile.mkdtemp()
+    >>> manifest = os.path.join(tmp_dir,'manifest.jsonl')
+    >>> options = prep.manifest_options(True,True,False,None)
+    >>> entry, source = prep.manifest_lookup('example_data/example_data.csv',options,manifest)
+    >>> source['sha1'] = 'da39a3ee5e6b4b0d3255bfef95601890afd80709'
+    >>> prep.manifest_record(manifest,source,options,'example_data/example_data_prep.csv',5758,5752)
+    >>> shutil.rmtree(tmp_dir)
+    """
+
+    outfile = os.path.abspath(outfile)
+    ostat = os.stat(outfile)
+
+    entry = dict(source)
+    entry.update(
+        {
+            "options": options,
+            "version": __version__,
+            "output": outfile,
+            "out_size": ostat.st_size,
+            "out_mtime": ostat.st_mtime_ns,
+            "nread": int(nread),
+            "nkept": int(nkept),
+        }
+    )
+    append_manifest(manifest, entry)
+
+
+def is_prepared(file_to_open, outdir=None):
+    """
+    Check if the '_prep' file of a Novonix data file exists
+    and it is newer than it.
+
+    Parameters
+    -----------
+    file_to_open : string
+        Name of the input Novonix file
+
+    outdir : string
+        Directory of the '_prep' file, None for that of the input file
+
+    Returns
+    --------
+    prepared : boolean
+        True if the '_prep' file is newer than the input file
+
+    Examples
+    ---------
+    >>> import shutil
+    >>> import tempfile
+    >>> import preparenovonix.novonix_prep as prep
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> infile = shutil.copy('example_data/example_data.csv', tmpdir)
+    >>> print(prep.is_prepared(infile))
+    False
+    >>> shutil.rmtree(tmpdir)
+    """
+
+    outfile = after_file_name(file_to_open, outdir=outdir)
+    if not (os.path.isfile(file_to_open) and os.path.isfile(outfile)):
+        return False
+
+    return os.stat(outfile).st_mtime_ns > os.stat(file_to_open).st_mtime_ns
+
+
+def prepare_one(file_to_open, options, manifest=None, entry=None):
+    """
+    Prepare a Novonix data file, keeping any failure as part of
+    the returned record instead of stopping.
+
+    Parameters
+    -----------
+    file_to_open : string
+        Name of the input Novonix file
+
+    options : dictionary
+        Parameters of prepare_novonix
+
+    manifest : string
+        Manifest of prepared files, see prepare_novonix
+
+    entry : dictionary
+        Last entry of the input file in the manifest, if already read,
+        see manifest_lookup
+
+    Returns
+    --------
+    record : dictionary
+        file (name of the input file), status ('prepared', 'failed'
+        or 'skipped'), nread and nkept (number of data rows read and
+        written, -1 if failed), elapsed (seconds), error (message,
+        '' if not failed) and error_type (name of the exception, such as
+        NotNovonixError or StateMismatchError, '' if not failed)
+
+    Examples
+    ---------
+    >>> import preparenovonix.novonix_prep as prep
+    >>> record = prep.prepare_one('example_data/example_data.csv',{'addstate':True,'lprotocol':True})
+    File example_data.csv has been prepared.
+    >>> print(record['status'])
+    prepared
+    """
+
+    record = {
+        "file": file_to_open,
+        "status": "failed",
+        "nread": -1,
+        "nkept": -1,
+        "elapsed": 0.0,
+        "error": "",
+        "error_type": "",
+    }
+    t0 = time.perf_counter()
+    try:
+        report = {}
+        record["nread"], record["nkept"] = prepare_novonix(
+            file_to_open, manifest=manifest, entry=entry, report=report, **options
+        )
+        record["status"] = report["status"]
+    except NovonixError as err:
+        record["error"] = str(err)
+        record["error_type"] = type(err).__name__
+    except Exception as err:
+        record["error"] = "{}: {}".format(type(err).__name__, err)
+        record["error_type"] = type(err).__name__
+    record["elapsed"] = time.perf_counter() - t0
+
+    return record
+
+
+def prepare_many(
+    files,
+    jobs=None,
+    addstate=False,
+    lprotocol=False,
+    overwrite=False,
+    verbose=False,
+    chunk_rows=None,
+    outdir=None,
+    skip_prepared=False,
+    manifest=None,
+    append=False,
+    segments=False,
+):
+    """
+    Prepare several Novonix data files with a pool of processes,
+    starting with the largest files. A failure in one file does not
+    stop the others.
+
+    Parameters
+    -----------
+    files : list of strings
+        Names of the input Novonix files
+
+    jobs : integer
+        Number of processes, None for the number of cores.
+        With 1 the files are prepared one after the other, without a pool.
+
+    addstate, lprotocol, overwrite, verbose, chunk_rows, outdir, append, segments :
+        Parameters of prepare_novonix, used for all the files
+
+    skip_prepared : boolean
+        True to skip the files with a '_prep' file newer than them,
+        see is_prepared. Not used when overwriting the files.
+
+    manifest : string
+        Manifest of prepared files, see prepare_novonix. The files
+        unchanged since they were last prepared are skipped.
+
+    Returns
+    --------
+    records : list of dictionaries
+        One record per input file, in the same order, as returned
+        by prepare_one
+
+    Examples
+    ---------
+    >>> import preparenovonix.novonix_prep as prep
+    >>> records = prep.prepare_many(['example_data/example_data.csv'],jobs=2,addstate=True,lprotocol=True)  # doctest: +SKIP
+    >>> print(records[0]['status'])  # doctest: +SKIP
+    prepared
+    """
+
+    options = {
+        "addstate": addstate,
+        "lprotocol": lprotocol,
+        "overwrite": overwrite,
+        "verbose": verbose,
+        "chunk_rows": chunk_rows,
+        "outdir": outdir,
+        "append": append,
+        "segments": segments,
+    }
+
+    records = [None] * len(files)
+    if skip_prepared and not overwrite:
+        for ii, ff in enumerate(files):
+            if is_prepared(ff, outdir=outdir):
+                records[ii] = {
+                    "file": ff,
+                    "status": "skipped",
+                    "nread": -1,
+                    "nkept": -1,
+                    "elapsed": 0.0,
+                    "error": "",
+                    "error_type": "",
+                }
+    todo = [ii for ii in range(len(files)) if records[ii] is None]
+    if not todo:
+        return records
+
+    # Largest files first, so that the pool ends at about the same time
+    sizes = [os.path.getsize(ff) if os.path.isfile(ff) else 0 for ff in files]
+    order = sorted(todo, key=lambda ii: sizes[ii], reverse=True)
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = max(1, min(jobs, len(order)))
 
-    # Clean the Novonix file
-    cleannovonix(infile)
+    # Read the manifest once, handing to each file only its entry
+    entries = {}
+    if manifest is not None:
+        entries = read_manifest(manifest)
+    args = {}
+    for ii in order:
+        entry = None
+        if manifest is not None:
+            entry = entries.get(os.path.abspath(files[ii]), {})
+        args[ii] = (files[ii], options, manifest, entry)
 
-    if addstate:
-        # Check if the file has a State column and if not, create it
-        novonix_add_state(infile, verbose=verbose)
+    if jobs == 1:
+        for ii in order:
+            records[ii] = prepare_one(*args[ii])
+        return records
 
-    if lprotocol:
-        # Check if the file has a Loop number and Protocol line columns
-        # and if not, create it
-        novonix_add_loopnr(infile, verbose=verbose)
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {ii: pool.submit(prepare_one, *args[ii]) for ii in order}
+        for ii, future in futures.items():
+            records[ii] = future.result()
 
-    print("File {} has been prepared.".format(fname))
+    return records
 
 
 if __name__ == "__main__":
     if len(sys.argv) > 1:
-        prepare_novonix(
+        exit_on_error(prepare_novonix)(
             sys.argv[1], addstate=True, lprotocol=True, overwrite=False, verbose=True
         )
@@ -4,8 +4,10 @@ eps = 1.0e-5
 col_step = "Step Number"
 col_tstep = "Step Time (h)"
 col_t = "Run Time (h)"
+col_i = "Current (A)"
 col_v = "Potential (V)"
 col_c = "Capacity (Ah)"
+col_temp = "Temperature (°C)"
 
 state_col = "State (0=Start 1=Regular 2=End -1=Single Measurement)"
 loop_col = "Loop number"
@@ -0,0 +1,580 @@
+import os
+import sys
+import glob
+import json
+import time
+import select
+import signal
+import ctypes
+import ctypes.util
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from preparenovonix.novonix_io import after_file_name
+from preparenovonix.novonix_io import NovonixFile
+from preparenovonix.novonix_io import temporary_file
+from preparenovonix.novonix_io import replace_file
+from preparenovonix.novonix_errors import OptionError
+from preparenovonix.novonix_prep import is_prepared
+from preparenovonix.novonix_prep import prepare_one
+
+# inotify events signalling a new, grown or moved in file
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, "O_CLOEXEC", 0)
+
+
+def inotify_open(inbox):
+    """
+    Watch a directory with inotify, where available (Linux).
+
+    Parameters
+    -----------
+    inbox : string
+        Directory to be watched
+
+    Returns
+    --------
+    fd : integer
+        File descriptor of the inotify instance,
+        None if inotify is not available
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_watch import inotify_open
+    >>> fd = inotify_open('example_data')
+    """
+
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    wd = libc.inotify_add_watch(fd, os.fsencode(inbox), mask)
+    if wd < 0:
+        os.close(fd)
+        return None
+
+    return fd
+
+
+def wait_events(fd, timeout):
+    """
+    Wait until there are events in the watched directory
+    or the time out has passed. Without inotify, simply wait.
+
+    Parameters
+    -----------
+    fd : integer
+        File descriptor from inotify_open, None for polling
+
+    timeout : float
+        Maximum number of seconds to wait
+
+    Returns
+    --------
+    changed : boolean
+        True if inotify reported any event
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_watch import wait_events
+    >>> wait_events(None,0.1)
+    False
+    """
+
+    if fd is None:
+        time.sleep(timeout)
+        return False
+
+    ready, _, _ = select.select([fd], [], [], timeout)
+    if not ready:
+        return False
+
+    # The events are only a signal to scan the directory again
+    while True:
+        try:
+            if not os.read(fd, 65536):
+                break
+        except (BlockingIOError, InterruptedError):
+            break
+
+    return True
+
+
+def scan_folder(inbox, outdir=None):
+    """
+    Get the size and modification time of the CSV files in a directory,
+    leaving out the '_prep' files of other files in it.
+
+    Parameters
+    -----------
+    inbox : string
+        Directory with the input files
+
+    outdir : string
+        Directory for the '_prep' files, None for inbox
+
+    Returns
+    --------
+    scan : dictionary
+        (size, modification time in ns) per file name
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_watch import scan_folder
+    >>> scan = scan_folder('example_data')
+    >>> print(list(scan))
+    ['example_data/example_data.csv']
+    """
+
+    scan = {}
+    for ff in sorted(glob.glob(os.path.join(inbox, "*.csv"))):
+        try:
+            st = os.stat(ff)
+        except OSError:
+            # Removed after listing it
+            continue
+        if os.path.isfile(ff):
+            scan[ff] = (st.st_size, st.st_mtime_ns)
+
+    outputs = set(after_file_name(ff, outdir=outdir) for ff in scan)
+    return {ff: st for ff, st in scan.items() if os.path.abspath(ff) not in outputs}
+
+
+def stable_files(tracked, scan, now, settle):
+    """
+    Update the files being tracked with a new scan of the directory and
+    get those that have not changed for at least settle seconds, in two
+    scans or more, and that have not been handled as they are now.
+
+    Parameters
+    -----------
+    tracked : dictionary
+        Per file name, a dictionary with stat (last size and modification
+        time), since (time when first seen like that), scans (number of
+        scans that have seen it like that), done (stat when last handled)
+        and size (size when last prepared). Updated in place.
+
+    scan : dictionary
+        Output of scan_folder
+
+    now : float
+        Time of the scan, in seconds
+
+    settle : float
+        Seconds a file has to remain unchanged
+
+    Returns
+    --------
+    stable : list of strings
+        Names of the stable files to be handled
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_watch import stable_files
+    >>> tracked = {}
+    >>> stable_files(tracked,{'a.csv':(10,1)},0.,0.)
+    []
+    >>> stable_files(tracked,{'a.csv':(10,1)},1.,0.)
+    ['a.csv']
+    """
+
+    for ff in list(tracked):
+        if ff not in scan:
+            del tracked[ff]
+
+    stable = []
+    for ff, st in scan.items():
+        track = tracked.get(ff)
+        if track is None:
+            tracked[ff] = {"stat": st, "since": now, "scans": 1, "done": None, "size": 0}
+            continue
+        if track["stat"] != st:
+            track.update({"stat": st, "since": now, "scans": 1})
+            continue
+        track["scans"] += 1
+        if track["done"] == st or track["scans"] < 2:
+            continue
+        if now - track["since"] >= settle:
+            stable.append(ff)
+
+    return stable
+
+
+def ignore_interrupt():
+    """
+    Ignore Ctrl-C (SIGINT) in the worker processes, which would otherwise
+    stop them while the service lets them finish their files.
+
+    Examples
+    ---------
+    >>> import signal
+    >>> from preparenovonix.novonix_watch import ignore_interrupt
+    >>> handler = signal.getsignal(signal.SIGINT)
+    >>> ignore_interrupt()
+    >>> handler = signal.signal(signal.SIGINT, handler)
+    """
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def prepare_worker(file_to_open, options, manifest=None):
+    """
+    Prepare a file in a worker process of the watch-folder service,
+    ignoring Ctrl-C there, see ignore_interrupt and
+    novonix_prep.prepare_one.
+
+    Parameters
+    -----------
+    file_to_open : string
+        Name of the input Novonix file
+
+    options : dictionary
+        Parameters of novonix_prep.prepare_novonix
+
+    manifest : string
+        Manifest of prepared files, None for not using one
+
+    Returns
+    --------
+    record : dictionary
+        Record of the file, see novonix_prep.prepare_one
+
+    Examples
+    ---------
+    >>> from concurrent.futures import ProcessPoolExecutor
+    >>> from preparenovonix.novonix_watch import prepare_worker
+    >>> with ProcessPoolExecutor(max_workers=1) as pool:
+    ...     future = pool.submit(prepare_worker,'missing.csv',{'addstate':True})
+    >>> print(future.result()['status'])
+    failed
+    """
+
+    ignore_interrupt()
+    return prepare_one(file_to_open, options, manifest=manifest)
+
+
+def future_record(ff, future):
+    """
+    Get the record of a file prepared in the pool of processes,
+    as a failure if the process could not return it
+    (for example, if the pool has been broken).
+
+    Parameters
+    -----------
+    ff : string
+        Name of the input file
+
+    future : concurrent.futures.Future
+        Future of novonix_prep.prepare_one
+
+    Returns
+    --------
+    record : dictionary
+        Record of the file, see novonix_prep.prepare_one
+
+    Examples
+    ---------
+    >>> from concurrent.futures import Future
+    >>> from preparenovonix.novonix_watch import future_record
+    >>> future = Future()
+    >>> future.set_exception(RuntimeError('pool broken'))
+    >>> print(future_record('a.csv',future)['status'])
+    failed
+    """
+
+    try:
+        return future.result()
+    except (Exception, KeyboardInterrupt) as err:
+        return {
+            "file": ff,
+            "status": "failed",
+            "nread": -1,
+            "nkept": -1,
+            "elapsed": 0.0,
+            "error": "{}: {}".format(type(err).__name__, err),
+            "error_type": type(err).__name__,
+        }
+
+
+def watch_counters(counters, start, now):
+    """
+    Update the throughput of the watch-folder service.
+
+    Parameters
+    -----------
+    counters : dictionary
+        Counters of the service, updated in place
+
+    start, now : float
+        Start of the service and current time, in seconds
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_watch import watch_counters
+    >>> counters = {'prepared':2,'bytes':100}
+    >>> watch_counters(counters,0.,10.)
+    >>> print(counters['files_per_sec'],counters['bytes_per_sec'])
+    0.2 10.0
+    """
+
+    uptime = max(now - start, 1e-9)
+    counters["uptime"] = round(now - start, 3)
+    counters["files_per_sec"] = counters["prepared"] / uptime
+    counters["bytes_per_sec"] = counters["bytes"] / uptime
+
+
+def write_status(status, counters):
+    """
+    Write the counters of the service as a JSON file, replacing
+    the previous one at once so that it is never read incomplete.
+
+    Parameters
+    -----------
+    status : string
+        Name of the status file
+
+    counters : dictionary
+        Counters of the service
+
+    Examples
+    ---------
+    >>> import os, shutil, tempfile
+    >>> from preparenovonix.novonix_watch import write_status
+    >>> tmp_dir = tempfile.mkdtemp()
+    >>> write_status(os.path.join(tmp_dir,'status.json'),{'queued':0})
+    >>> print(os.listdir(tmp_dir))
+    ['status.json']
+    >>> shutil.rmtree(tmp_dir)
+    """
+
+    with temporary_file(status) as tmp_file:
+        with open(tmp_file, "w") as ff:
+            json.dump(counters, ff, sort_keys=True)
+            ff.write("\n")
+        replace_file(tmp_file, status)
+
+
+def watch_folder(
+    inbox,
+    outdir=None,
+    workers=None,
+    addstate=True,
+    lprotocol=True,
+    chunk_rows=None,
+    manifest=None,
+    interval=1.0,
+    settle=2.0,
+    queue_size=None,
+    status=None,
+    counters=None,
+    max_cycles=None,
+    verbose=False,
+    segments=False,
+):
+    """
+    Watch a directory and prepare the Novonix data files landing in it,
+    and again the rows appended to them as they grow.
+    A file is handled once it has been unchanged for settle seconds and
+    only if it looks like a Novonix data file; other files are counted
+    as rejected, and reported if verbose. Files with a '_prep' file
+    newer than them are skipped, thus a restart does not prepare again
+    the files already done. The grown files are prepared in append mode,
+    reading only their new rows, see novonix_prep.prepare_novonix.
+    The directory is scanned every interval seconds, and also as soon
+    as inotify reports a change, where available.
+    The service stops after max_cycles scans or when interrupted
+    (Ctrl-C), once the files being prepared are done.
+
+    Parameters
+    -----------
+    inbox : string
+        Directory to be watched
+
+    outdir : string
+        Directory for the '_prep' files, None for inbox
+
+    workers : integer
+        Number of processes, None for the number of cores.
+        With 1 the files are prepared by the service process, without a pool.
+
+    addstate, lprotocol, chunk_rows, manifest, verbose, segments :
+        Parameters of novonix_prep.prepare_novonix
+
+    interval : float
+        Maximum number of seconds between scans
+
+    settle : float
+        Seconds a file has to remain unchanged before preparing it
+
+    queue_size : integer
+        Maximum number of files handed to the pool at a time,
+        None for twice the number of workers. The rest wait in the service.
+
+    status : string
+        Name of a JSON file where the counters are written after each scan
+
+    counters : dictionary
+        Dictionary to be updated in place with the counters, to be read
+        by the caller while the service runs
+
+    max_cycles : integer
+        Number of scans before stopping, None to run until interrupted
+
+    Returns
+    --------
+    counters : dictionary
+        queued (stable files waiting for the pool), running (files in the
+        pool), prepared, skipped (already prepared), failed and rejected
+        (not Novonix data files) number of files, bytes (input bytes
+        prepared), uptime (seconds), files_per_sec, bytes_per_sec and
+        inotify (True if used)
+
+    Examples
+    ---------
+    >>> from preparenovonix.novonix_watch import watch_folder
+    >>> counters = watch_folder('inbox',outdir='outbox',workers=2,max_cycles=5,interval=0.1,settle=0.)  # doctest: +SKIP
+    """
+
+    if not os.path.isdir(inbox):
+        raise OptionError(
+            "directory not found: " + str(inbox), where="novonix_watch.watch_folder"
+        )
+    if outdir is not None:
+        os.makedirs(outdir, exist_ok=True)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, workers)
+    if queue_size is None:
+        queue_size = 2 * workers
+    queue_size = max(1, queue_size)
+
+    options = {
+        "addstate": addstate,
+        "lprotocol": lprotocol,
+        "overwrite": False,
+        "verbose": verbose,
+        "chunk_rows": chunk_rows,
+        "outdir": outdir,
+        "append": True,
+        "segments": segments,
+    }
+
+    if counters is None:
+        counters = {}
+    counters.update(
+        {
+            "queued": 0,
+            "running": 0,
+            "prepared": 0,
+            "skipped": 0,
+            "failed": 0,
+            "rejected": 0,
+            "bytes": 0,
+        }
+    )
+
+    tracked = {}
+    ready = deque()
+    running = {}
+
+    def finish(ff, st, record):
+        counters[record["status"]] += 1
+        track = tracked.get(ff)
+        if record["status"] == "prepared":
+            prev = 0 if track is None else track["size"]
+            counters["bytes"] += st[0] - prev if st[0] >= prev else st[0]
+        elif record["status"] == "failed":
+            print("Failed {}: {}".format(ff, record["error"].strip()), file=sys.stderr)
+        if track is not None:
+            track["done"] = st
+            track["size"] = st[0]
+
+    fd = inotify_open(inbox)
+    counters["inotify"] = fd is not None
+    pool = None
+    if workers > 1:
+        pool = ProcessPoolExecutor(max_workers=workers)
+
+    start = time.monotonic()
+    cycles = 0
+    try:
+        while True:
+            now = time.monotonic()
+            scan = scan_folder(inbox, outdir=outdir)
+            for ff in stable_files(tracked, scan, now, settle):
+                if ff in running or ff in ready:
+                    continue
+                st = tracked[ff]["stat"]
+                if is_prepared(ff, outdir=outdir):
+                    counters["skipped"] += 1
+                    tracked[ff].update({"done": st, "size": st[0]})
+                elif not NovonixFile(ff).isnovonix:
+                    # Reported once per change of the file, if verbose
+                    counters["rejected"] += 1
+                    tracked[ff]["done"] = st
+                    if verbose:
+                        print("Not a Novonix data file: {}".format(ff))
+                else:
+                    ready.append(ff)
+
+            for ff in [ff for ff, (st, future) in running.items() if future.done()]:
+                st, future = running.pop(ff)
+                finish(ff, st, future_record(ff, future))
+
+            # Without a pool, at most queue_size files are prepared per scan
+            nserial = 0
+            while ready and len(running) + nserial < queue_size:
+                ff = ready.popleft()
+                if ff not in tracked:
+                    continue
+                st = tracked[ff]["stat"]
+                if pool is None:
+                    finish(ff, st, prepare_one(ff, options, manifest=manifest))
+                    nserial += 1
+                else:
+                    running[ff] = (
+                        st,
+                        pool.submit(prepare_worker, ff, options, manifest),
+                    )
+
+            counters["queued"] = len(ready)
+            counters["running"] = len(running)
+            watch_counters(counters, start, time.monotonic())
+            if status is not None:
+                write_status(status, counters)
+
+            cycles += 1
+            if max_cycles is not None and cycles >= max_cycles:
+                break
+            wait_events(fd, interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        try:
+            # Let the files being prepared finish
+            for ff, (st, future) in running.items():
+                finish(ff, st, future_record(ff, future))
+            running.clear()
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            if fd is not None:
+                os.close(fd)
+
+    counters["queued"] = len(ready)
+    counters["running"] = 0
+    watch_counters(counters, start, time.monotonic())
+    if status is not None:
+        write_status(status, counters)
+
+    return counters
@@ -1,3 +1,4 @@
+import re
 import pathlib
 from setuptools import find_packages, setup
 
@@ -7,6 +8,11 @@ HERE = pathlib.Path(__file__).parent
 # The text of the README file
 README = (HERE / "README.rst").read_text()
 
+# The version, kept in the package
+VERSION = re.search(
+    r'__version__ = "(.*)"', (HERE / "preparenovonix" / "__init__.py").read_text()
+).group(1)
+
 desc = (
     "Clean and add extra information to data "
     + "produced by the battery cyclers from Novonix."
@@ -15,7 +21,7 @@ desc = (
 # This call to setup() does all the work
 setup(
     name="preparenovonix",
-    version="1.0.3",
+    version=VERSION,
     packages=find_packages(exclude=("tests",)),
     description=desc,
     long_description=README,
@@ -28,6 +34,9 @@ setup(
         "Operating System :: OS Independent",
     ],
     include_package_data=True,
+    entry_points={
+        "console_scripts": ["preparenovonix=preparenovonix.novonix_cli:main"],
+    },
     install_requires=[
         "numpy>=1.15",
         # Note: Matplotlib is loaded for test plot
@@ -1,6 +1,7 @@
 import sys
 import os
 from preparenovonix import compare
+from preparenovonix.novonix_io import clear_cache
 
 exfile = "example_data/example_data.csv"
 exfile_prep = "example_data/example_data_prep.csv"
@@ -11,3 +12,7 @@ def test_plot_vct():
     dirname, fname = os.path.split(os.path.abspath(exfile))
     figname = os.path.join(dirname, "compare_vct.pdf")
     assert os.path.isfile(figname) is True
+    # Starting from a later loop
+    compare.plot_vct(exfile, first_loop=3)
+    assert os.path.isfile(figname) is True
+    clear_cache(exfile_prep)
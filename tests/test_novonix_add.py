@@ -1,11 +1,17 @@
 import sys
 import os
 from shutil import copy
+import numpy as np
+import pytest
 import preparenovonix.novonix_variables as nv
 import preparenovonix.novonix_add as prep
+import preparenovonix.novonix_clean as clean
+import preparenovonix.novonix_io as io
+from preparenovonix.novonix_errors import ProtocolSyntaxError
 
 exfile = "example_data/example_data.csv"
 exfile_prep = "example_data/example_data_prep.csv"
+ff = "dumfile"
 
 
 def test_column_cehck():
@@ -26,6 +32,179 @@ def test_novonix_add_state():
     os.remove(ff)
 
 
+def test_state_chunk():
+    lines = [b"r%d\n" % ii for ii in range(6)]
+    steps = ["1", "1", "1", "2", "3", "3"]
+    stimes = [0.0, 0.1, 0.2, 0.0, 0.0, 0.1]
+    carry = prep.state_carry(ff)
+    block, states = prep.state_chunk(b"".join(lines), steps, stimes, carry, final=True)
+    assert block == b"".join(lines)
+    assert states.tolist() == [0, 1, 2, -1, 0, 2]
+    # By chunks
+    carry = prep.state_carry(ff)
+    new_block = b""
+    new_states = []
+    for ii in range(6):
+        block, states = prep.state_chunk(
+            lines[ii],
+            steps[ii : ii + 1],
+            stimes[ii : ii + 1],
+            carry,
+            final=(ii == 5),
+        )
+        assert block.count(b"\n") == len(states)
+        new_block += block
+        new_states.extend(states.tolist())
+    assert new_block == b"".join(lines)
+    assert new_states == [0, 1, 2, -1, 0, 2]
+    assert prep.state_counts_check(
+        carry["first"], carry["last"], carry["nzeros"], carry["ntwos"]
+    )
+
+
+def loop_state(steps, stimes):
+    # Reference row by row State, as originally written
+    state = []
+    last_step = -99
+    last_t = 99.0
+    for step, stime in zip(steps, stimes):
+        if step == last_step and stime > last_t:
+            state.append(1)
+        else:
+            state.append(0)
+            if len(state) > 1:
+                if state[-2] == 0:
+                    if last_t < nv.eps:
+                        state[-2] = -1
+                    else:
+                        state[-2] = -99
+                        if len(state) > 2 and state[-3] == -1:
+                            state[-3] = -99
+                elif state[-2] == 1:
+                    state[-2] = 2
+        last_step = step
+        last_t = stime
+    state[-1] = 2
+    return state
+
+
+def chunked_state(steps, stimes, chunk_rows):
+    carry = prep.state_carry(ff)
+    states = []
+    for ii in range(0, len(steps), chunk_rows):
+        states.extend(
+            prep.state_values(
+                steps[ii : ii + chunk_rows],
+                stimes[ii : ii + chunk_rows],
+                carry,
+                final=(ii + chunk_rows >= len(steps)),
+            )
+        )
+    return states
+
+
+def test_state_values_example_data():
+    copy(exfile, ff)
+    clean.cleannovonix(ff)
+    cols = io.read_columns(ff, [nv.col_step, nv.col_tstep], ["str", "float"])
+    steps, stimes = cols[nv.col_step], cols[nv.col_tstep]
+    expected = loop_state(steps, stimes)
+    for chunk_rows in [1, 2, 3, 1000, len(steps)]:
+        assert chunked_state(steps, stimes, chunk_rows) == expected
+    os.remove(ff)
+    io.clear_cache(ff)
+
+
+def test_state_values_example_data_prep():
+    cols = io.read_columns(exfile_prep, [nv.col_step, nv.col_tstep], ["str", "float"])
+    steps, stimes = cols[nv.col_step], cols[nv.col_tstep]
+    expected = loop_state(steps, stimes)
+    for chunk_rows in [1, 2, 3, 1000, len(steps)]:
+        assert chunked_state(steps, stimes, chunk_rows) == expected
+
+
+def test_state_values_random():
+    # Sequences with single measurements and software bug rows
+    rng = np.random.RandomState(7)
+    for itest in range(20):
+        nrows = rng.randint(3, 300)
+        steps = rng.choice(["1", "2", "7", "8"], size=nrows, p=[0.7, 0.1, 0.1, 0.1])
+        stimes = rng.choice([0.0, 0.1, 0.2, 0.3], size=nrows)
+        expected = loop_state(steps, stimes)
+        for chunk_rows in [1, 2, 5, nrows]:
+            assert chunked_state(steps, stimes, chunk_rows) == expected
+
+
+def expected_segments(infile):
+    names = [nv.col_step, nv.col_t, nv.col_c, nv.state_col]
+    cols = io.read_columns(infile, names)
+    states = cols[nv.state_col]
+    segments = []
+    for irow, state in enumerate(states):
+        if state in [0, -1]:
+            first = irow
+        if state in [2, -1]:
+            segments.append(
+                (
+                    first,
+                    irow,
+                    cols[nv.col_step][first],
+                    states[first],
+                    cols[nv.col_t][first],
+                    cols[nv.col_t][irow],
+                    cols[nv.col_c][first],
+                    cols[nv.col_c][irow],
+                )
+            )
+    return segments
+
+
+def test_segments():
+    copy(exfile, ff)
+    clean.cleannovonix(ff)
+    prep.novonix_add_state(ff, chunk_rows=10, segments=True)
+    segments = io.read_segments(ff)
+    fields = ["start", "end", "step", "state", "t_start", "t_end", "c_start", "c_end"]
+    expected = expected_segments(ff)
+    assert segments[fields].tolist() == expected
+    assert (segments["line"] == -999).all()
+    # Same table from the State pass and the Loop number one
+    for rebuild in [False, True]:
+        copy(ff, ff + "2")
+        prep.novonix_add_state(ff + "2", chunk_rows=10, segments=True)
+        if rebuild:
+            io.clear_cache(ff + "2")
+        prep.novonix_add_loopnr(ff + "2", chunk_rows=7, segments=True)
+        segments = io.read_segments(ff + "2")
+        assert segments[fields].tolist() == expected
+        cols = io.read_columns(ff + "2", [nv.line_col, nv.loop_col], "int")
+        assert (segments["line"] == cols[nv.line_col][segments["start"]]).all()
+        assert (segments["loop"] == cols[nv.loop_col][segments["end"]]).all()
+        assert prep.protocol_check(ff + "2", 103) is True
+        os.remove(ff + "2")
+        io.clear_cache(ff + "2")
+    # The table is not used once the file changes
+    with open(ff, "a") as f1:
+        f1.write("\n")
+    assert io.read_segments(ff) is None
+    os.remove(ff)
+    io.clear_cache(ff)
+
+
+def test_novonix_add_state_chunks():
+    copy(exfile, ff)
+    clean.cleannovonix(ff)
+    copy(ff, ff + "2")
+    prep.novonix_add_state(ff)
+    prep.novonix_add_state(ff + "2", chunk_rows=10)
+    with open(ff, "rb") as f1, open(ff + "2", "rb") as f2:
+        assert f1.read() == f2.read()
+    os.remove(ff)
+    io.clear_cache(ff)
+    os.remove(ff + "2")
+    io.clear_cache(ff + "2")
+
+
 def test_select_com_val():
     one = "step == nv.com_val1[index]"
     two = "np.logical_or(step == nv.com_val1[index], step == nv.com_val2[index])"
@@ -40,6 +219,9 @@ def test_read_reduced_protocol():
     protocol, protocol_exists = prep.read_reduced_protocol(exfile_prep, verbose=False)
     assert len(protocol) > 1
     assert protocol_exists is True
+    protocol, protocol_exists = prep.read_reduced_protocol(exfile, verbose=False)
+    assert protocol == [nv.protocol_first]
+    assert protocol_exists is False
 
 
 def test_protocol_check():
@@ -53,6 +235,8 @@ def test_rep_info_not_fmtspace():
     assert ncount == 24
     assert nstep == 4
     assert unexpected is False
+    with pytest.raises(ProtocolSyntaxError):
+        prep.rep_info_not_fmtspace("[5 : Repeat 24 times]", True)
 
 
 def test_create_end_repeat():
@@ -74,3 +258,65 @@ def test_novonix_add_loopnr():
     prep.novonix_add_loopnr(ff, verbose=True)
     assert os.stat(exfile_prep).st_size <= os.stat(ff).st_size
     os.remove(ff)
+
+
+def test_loopnr_chunk():
+    prot, viable_prot = prep.create_reduced_protocol(exfile_prep)
+    cols = io.read_columns(exfile_prep, [nv.col_step, nv.state_col, nv.loop_col], "int")
+    steps = cols[nv.col_step]
+    states = cols[nv.state_col]
+    carry = prep.protocol_carry(exfile_prep, viable_prot)
+    linenr, loopnr = prep.loopnr_chunk(prot[1:-1], steps, states, carry)
+    assert (loopnr == cols[nv.loop_col]).all()
+    # By chunks
+    carry = prep.protocol_carry(exfile_prep, viable_prot)
+    for ii in range(0, len(steps), 100):
+        lnr, lpnr = prep.loopnr_chunk(
+            prot[1:-1], steps[ii : ii + 100], states[ii : ii + 100], carry
+        )
+        assert (lnr == linenr[ii : ii + 100]).all()
+        assert (lpnr == loopnr[ii : ii + 100]).all()
+
+
+def test_protocol_schedule():
+    prot = [
+        "[1 : Open_circuit_storage : ] \n",
+        "[2 : Repeat 3 times :] \n",
+        "[3 : CC-CV_charge : ] \n",
+        "[4 : Constant_current_discharge : ] \n",
+        "[5 : End Repeat 2 steps :] \n",
+        "[6 : Open_circuit_storage : ] \n",
+    ]
+    linenr, loopnr, stop = prep.protocol_schedule(prot)
+    assert linenr.tolist() == [1, 3, 4, 3, 4, 3, 4, 6]
+    assert loopnr.tolist() == [0, 1, 1, 2, 2, 3, 3, 0]
+    assert stop == ""
+    prot[4] = "[5 : End Repeat 3 steps :] \n"
+    linenr, loopnr, stop = prep.protocol_schedule(prot)
+    assert linenr.tolist() == [1, 3, 4]
+    assert "unexpected length" in stop
+    # The data going beyond the schedule
+    carry = prep.protocol_carry(ff, True)
+    with pytest.raises(ProtocolSyntaxError, match="unexpected length"):
+        prep.protocol_segments(prot, np.zeros(5, dtype=int), carry)
+
+
+def test_protocol_segments():
+    prot = [
+        "[1 : Open_circuit_storage : ] \n",
+        "[2 : Repeat 2 times :] \n",
+        "[3 : CC-CV_charge : ] \n",
+        "[4 : Open_circuit_storage : ] \n",
+        "[5 : End Repeat 2 steps :] \n",
+    ]
+    steps = np.array([0, 7, 8, 0, 7, 8, 0, 0])
+    carry = prep.protocol_carry(ff, True)
+    linenr, loopnr = prep.protocol_segments(prot, steps, carry)
+    assert linenr.tolist() == [1, 3, 3, 4, 3, 3, 4, -999]
+    assert loopnr.tolist() == [0, 1, 1, 1, 2, 2, 2, 0]
+    # One set of measurements at a time
+    carry = prep.protocol_carry(ff, True)
+    for ii, step in enumerate(steps):
+        lnr, lpnr = prep.protocol_segments(prot, steps[ii : ii + 1], carry)
+        assert lnr[0] == linenr[ii]
+        assert lpnr[0] == loopnr[ii]
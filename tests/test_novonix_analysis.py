@@ -0,0 +1,124 @@
+import sys
+import os
+import numpy as np
+from shutil import copy
+import preparenovonix.novonix_variables as nv
+import preparenovonix.novonix_analysis as prep
+from preparenovonix.novonix_io import read_columns
+from preparenovonix.novonix_io import clear_cache
+
+exfile = "example_data/example_data.csv"
+exfile_prep = "example_data/example_data_prep.csv"
+
+
+def test_cycle_summary():
+    cycles = prep.cycle_summary(exfile_prep, cache=False)
+    names = [nv.loop_col, nv.col_t, nv.col_c, nv.col_v, nv.col_temp]
+    cols = read_columns(exfile_prep, names)
+    loops = cols[nv.loop_col]
+    assert cycles["loop"].tolist() == [1, 2, 3, 4]
+    # Compare with a row by row selection
+    for cycle in cycles:
+        rows = np.flatnonzero(loops == cycle["loop"])
+        assert cycle["start"] == rows[0]
+        assert cycle["end"] == rows[-1]
+        times = cols[nv.col_t][rows]
+        assert np.isclose(cycle["duration"], times[-1] - times[0])
+        dcap = np.diff(cols[nv.col_c][rows[0] : rows[-1] + 2])
+        assert np.isclose(cycle["charge"], dcap[dcap > 0].sum())
+        assert np.isclose(cycle["discharge"], -dcap[dcap < 0].sum())
+        assert np.isclose(cycle["efficiency"], cycle["discharge"] / cycle["charge"])
+        assert np.isclose(cycle["v_mean"], cols[nv.col_v][rows].mean())
+        assert cycle["temp_min"] == cols[nv.col_temp][rows].min()
+        assert cycle["temp_max"] == cols[nv.col_temp][rows].max()
+
+
+def test_file_segments():
+    ff = "example_data/dum_analysis.csv"
+    copy(exfile_prep, ff)
+    chunked = prep.file_segments(ff, cache=False, chunk_rows=100)
+    segments = prep.file_segments(ff)
+    assert chunked.tolist() == segments.tolist()
+    assert segments["start"][0] == 0
+    assert (segments["end"][:-1] + 1 == segments["start"][1:]).all()
+    cycles = prep.cycle_summary(ff)
+    assert cycles.tolist() == prep.cycle_summary(exfile_prep, cache=False).tolist()
+    os.remove(ff)
+    clear_cache(ff)
+
+
+def test_binned_derivative():
+    x = np.array([0.0, 1.0, 2.0, 3.0, 0.0, 2.0])
+    y = np.array([0.0, 2.0, 4.0, 8.0, 0.0, 1.0])
+    sets = np.array([0, 0, 0, 0, 1, 1])
+    iset, center, deriv = prep.binned_derivative(x, y, sets, 1.0)
+    assert iset.tolist() == [0, 0, 0, 1]
+    assert center.tolist() == [0.5, 1.5, 2.5, 1.5]
+    assert deriv.tolist() == [2.0, 2.0, 4.0, 0.5]
+    # Moving sum over three bins of the same set
+    iset, center, deriv = prep.binned_derivative(x, y, sets, 1.0, window=3)
+    assert np.allclose(deriv[:3], [2.0, 8.0 / 3.0, 3.0])
+
+
+def test_dqdv():
+    table = prep.dqdv(exfile_prep, bin_width=0.01, cache=False)
+    segments = prep.file_segments(exfile_prep, cache=False)
+    cols = read_columns(exfile_prep, [nv.col_v, nv.col_c])
+    # Compare with a loop over the sets of measurements
+    for iset in np.unique(table["set"]):
+        seg = segments[iset]
+        assert seg["state"] == 0
+        vv = cols[nv.col_v][seg["start"] : seg["end"] + 1]
+        cc = cols[nv.col_c][seg["start"] : seg["end"] + 1]
+        mid = np.floor((vv[1:] + vv[:-1]) / 2.0 / 0.01)
+        rows = table[table["set"] == iset]
+        assert (rows["loop"] == seg["loop"]).all()
+        for key, val in zip(np.unique(mid), rows["dqdv"]):
+            dv = np.diff(vv)[mid == key].sum()
+            dq = np.diff(cc)[mid == key].sum()
+            if dv == 0:
+                assert np.isnan(val)
+            else:
+                assert np.isclose(val, dq / dv)
+
+    chunked = prep.dqdv(exfile_prep, bin_width=0.01, chunk_rows=500, cache=False)
+    assert chunked["set"].tolist() == table["set"].tolist()
+    assert np.allclose(chunked["dqdv"], table["dqdv"], equal_nan=True)
+
+
+def test_dvdq():
+    table = prep.dvdq(exfile_prep, loops=range(2, 4), window=3, cache=False)
+    assert set(table["loop"].tolist()) == {2, 3}
+    assert (table["capacity"] >= 0).all()
+    chunked = prep.dvdq(
+        exfile_prep, loops=range(2, 4), window=3, chunk_rows=300, cache=False
+    )
+    assert np.allclose(chunked["capacity"], table["capacity"])
+    assert np.allclose(chunked["dvdq"], table["dvdq"], equal_nan=True)
+
+
+def test_resample_segments():
+    npoints = 20
+    isets, data = prep.resample_segments(exfile_prep, npoints=npoints, cache=False)
+    segments = prep.file_segments(exfile_prep, cache=False)
+    cols = read_columns(exfile_prep, [nv.col_t, nv.col_v, nv.col_c])
+    assert data[nv.col_v].shape == (len(isets), npoints)
+    # Compare with a loop of np.interp over the sets
+    for ii, iset in enumerate(isets):
+        rows = slice(segments["start"][iset], segments["end"][iset] + 1)
+        tt = cols[nv.col_t][rows]
+        grid = np.linspace(tt[0], tt[-1], npoints)
+        for name in [nv.col_v, nv.col_c]:
+            expected = np.interp(grid, tt, cols[name][rows])
+            assert np.allclose(data[name][ii], expected)
+
+    isets, data = prep.resample_segments(
+        exfile_prep, names=[nv.col_c], grid="capacity", loops=[2], dtype="float32"
+    )
+    assert data[nv.col_c].dtype == np.float32
+    assert (segments["loop"][isets] == 2).all()
+    first = segments["start"][isets]
+    last = segments["end"][isets]
+    assert np.allclose(data[nv.col_c][:, 0], cols[nv.col_c][first])
+    assert np.allclose(data[nv.col_c][:, -1], cols[nv.col_c][last])
+    clear_cache(exfile_prep)
@@ -1,8 +1,11 @@
 import sys
 import os
+import numpy as np
+import pytest
 from shutil import copy
 import preparenovonix.novonix_variables as nv
 import preparenovonix.novonix_clean as prep
+from preparenovonix.novonix_errors import ColumnError
 
 
 exfile = "example_data/example_data.csv"
@@ -19,11 +22,24 @@ def test_header_data_columns():
     prep.header_data_columns("a,b", [1, 2, 3], header)
     lastl = header[-1].strip()
     assert lastl == "a,b,dum0"
+    with pytest.raises(ColumnError) as err:
+        prep.header_data_columns("a,b,c", [1, 2], header, infile="dum.csv")
+    assert err.value.infile == "dum.csv"
 
 
 def test_capacity_failed_tests():
     capacity = prep.capacity_failed_tests(7, 2, exfile)
     assert abs(capacity - 0.4956498) < nv.eps
+    # Three tests, with blank lines between them
+    ff = "dumfile"
+    with open(exfile, "r") as inf:
+        lines = inf.readlines()
+    with open(ff, "w") as outf:
+        outf.writelines(lines + ["\n", " \n"] + lines)
+    last = [line for line in lines if line.strip()][-1]
+    capacity3 = prep.capacity_failed_tests(7, 3, ff)
+    assert abs(capacity3 - capacity - float(last.split(",")[7])) < nv.eps
+    os.remove(ff)
 
 
 def test_cleannovonix():
@@ -33,3 +49,56 @@ def test_cleannovonix():
     prep.cleannovonix(ff)
     assert os.stat(ff).st_size < os.stat(exfile).st_size
     os.remove(ff)
+
+
+def test_clean_chunk():
+    carry = prep.clean_carry(exfile)
+    assert carry["ntests"] == 2
+    carry = {
+        "first_row": False,
+        "last_t": -1.0,
+        "icapacity": 2,
+        "ntests": 1,
+        "last_capacity": 0.0,
+    }
+    block = b"a,1,0.1\nb,0.5,0.2\r\nc,2,0.3\n"
+    new_block = prep.clean_chunk(block, [1.0, 0.5, 2.0], [0.1, 0.2, 0.3], carry)
+    assert new_block == b"a,1,0.1\nc,2,0.3\n"
+    assert carry["last_t"] == 2.0
+    # Failed tests
+    carry["last_t"] = -1.0
+    carry["ntests"] = 2
+    carry["last_capacity"] = 1.0
+    new_block = prep.clean_chunk(b"a,1,0.1,x\n", [1.0], [0.1], carry)
+    assert new_block == b"a,1,1.1,x\n"
+
+
+def test_clean_header():
+    header, start = prep.clean_header(exfile)
+    assert header[0].strip() == "[Summary]"
+    assert header[-2].strip() == "[Data]"
+    with open(exfile, "rb") as ff:
+        ff.seek(start)
+        line = ff.readline()
+    assert line.startswith(b"1/3/2019")
+
+
+def test_clean_mask():
+    carry = {"first_row": True, "last_t": -1.0}
+    keep = prep.clean_mask([3.0, 1.0, 2.0, 1.5], carry)
+    assert list(keep) == [True, True, True, False]
+    assert carry["last_t"] == 2.0
+    # Same as the row by row selection
+    times = np.random.RandomState(3).normal(size=500).cumsum()
+    times[::37] = np.nan
+    carry = {"first_row": True, "last_t": -1.0}
+    keep = np.concatenate(
+        [prep.clean_mask(times[ii : ii + 50], carry) for ii in range(0, 500, 50)]
+    )
+    expected = [True]
+    last_t = -1.0
+    for t in times[1:]:
+        expected.append(not t < last_t)
+        if not t < last_t:
+            last_t = t
+    assert keep.tolist() == expected
@@ -0,0 +1,66 @@
+import os
+import shutil
+from shutil import copy
+import pytest
+import preparenovonix.novonix_cli as cli
+
+exfile = "example_data/example_data.csv"
+exfile_prep = "example_data/example_data_prep.csv"
+
+
+def test_parse_args():
+    args = cli.parse_args(["prepare", "a.csv", "b.csv", "-j", "3", "--no-protocol"])
+    assert args.files == ["a.csv", "b.csv"]
+    assert args.jobs == 3
+    assert args.addstate is True
+    assert args.lprotocol is False
+    assert args.force is False
+    assert args.segments is False
+    assert cli.parse_args(["prepare", "a.csv", "--segments"]).segments is True
+    args = cli.parse_args(["watch", "inbox", "--out", "outbox", "-w", "2"])
+    assert args.inbox == "inbox"
+    assert args.out_dir == "outbox"
+    assert args.workers == 2
+    assert args.settle == 2.0
+    with pytest.raises(SystemExit):
+        cli.parse_args([])
+
+
+def test_expand_files():
+    files = cli.expand_files(["example_data/*.csv", exfile])
+    assert files == [exfile]
+    files = cli.expand_files(["b.csv", "a.csv", "b.csv"])
+    assert files == ["b.csv", "a.csv"]
+
+
+def test_main():
+    outdir = "dum_cli"
+    os.makedirs(outdir, exist_ok=True)
+    files = [os.path.join(outdir, "dum{}.csv".format(ii)) for ii in range(2)]
+    for ff in files:
+        copy(exfile, ff)
+    pattern = os.path.join(outdir, "*.csv")
+    assert cli.main(["prepare", pattern, "--jobs", "2"]) == 0
+    for ff in files:
+        ffout = ff.replace(".csv", "_prep.csv")
+        with open(ffout, "rb") as fo, open(exfile_prep, "rb") as fe:
+            assert fo.read() == fe.read()
+    # The '_prep' files are newer than the inputs
+    mtime = os.stat(files[0].replace(".csv", "_prep.csv")).st_mtime_ns
+    assert cli.main(["prepare", pattern, "--jobs", "2"]) == 0
+    assert os.stat(files[0].replace(".csv", "_prep.csv")).st_mtime_ns == mtime
+    # Output directory, without the extra columns
+    out = os.path.join(outdir, "out")
+    args = ["prepare", files[0], "--no-state", "--no-protocol", "--out-dir", out]
+    assert cli.main(args) == 0
+    assert os.path.isfile(os.path.join(out, "dum0_prep.csv"))
+    # Not a Novonix file
+    with open(os.path.join(outdir, "bad.csv"), "w") as fb:
+        fb.write("a,b\n")
+    assert cli.main(["prepare", os.path.join(outdir, "bad.csv"), "--jobs", "1"]) == 1
+    # Watched directory
+    out = os.path.join(outdir, "watched")
+    args = ["watch", outdir, "--out", out, "-w", "1", "--settle", "0"]
+    assert cli.main(args + ["--interval", "0.01", "--max-cycles", "3"]) == 0
+    assert os.path.isfile(os.path.join(out, "dum1_prep.csv"))
+    shutil.rmtree(outdir)
@@ -0,0 +1,40 @@
+import pickle
+import pytest
+import preparenovonix.novonix_errors as errors
+from preparenovonix.novonix_io import NovonixFile
+
+exfile = "example_data/example_data.csv"
+
+
+def test_NovonixError():
+    err = errors.ProtocolSyntaxError(
+        "nested loops", infile=exfile, line=12, where="novonix_add.create_reduced_protocol"
+    )
+    assert isinstance(err, errors.NovonixError)
+    assert str(err) == (
+        "STOP novonix_add.create_reduced_protocol \n"
+        + "    at header line: 12 \n"
+        + "REASON nested loops \n"
+        + "       "
+        + exfile
+        + " \n"
+    )
+    # Sent from a worker process
+    back = pickle.loads(pickle.dumps(err))
+    assert type(back) is errors.ProtocolSyntaxError
+    assert (back.reason, back.infile, back.line) == ("nested loops", exfile, 12)
+    # Given the header index of the file
+    assert errors.NotNovonixError("bad", infile=NovonixFile(exfile)).infile == exfile
+    assert isinstance(errors.OptionError("bad"), ValueError)
+
+
+def test_exit_on_error():
+    def bad_file(infile):
+        raise errors.StateMismatchError("unexpected State", infile=infile)
+
+    with pytest.raises(errors.StateMismatchError):
+        bad_file("a.csv")
+    with pytest.raises(SystemExit) as err:
+        errors.exit_on_error(bad_file)("a.csv")
+    assert err.value.code == "STOP REASON unexpected State \n       a.csv \n"
+    assert errors.exit_on_error(len)([1, 2]) == 2
@@ -1,7 +1,13 @@
 import sys
 import os
+import hashlib
+import numpy as np
+import pytest
+from shutil import copy
 import preparenovonix.novonix_variables as nv
 import preparenovonix.novonix_io as prep
+from preparenovonix.novonix_errors import NotNovonixError
+from preparenovonix.novonix_errors import ColumnError
 
 exfile = "example_data/example_data.csv"
 exfile_prep = "example_data/example_data_prep.csv"
@@ -11,6 +17,8 @@ def test_after_file_name():
     after_file = prep.after_file_name("example_data/example_data.csv")
     dirname, fname = os.path.split(os.path.abspath(exfile_prep))
     assert after_file == os.path.join(dirname, fname)
+    after_file = prep.after_file_name("example_data/example_data.csv", outdir="out")
+    assert after_file == os.path.join(os.path.abspath("out"), fname)
 
 
 def test_get_infile():
@@ -20,15 +28,47 @@ def test_get_infile():
     os.remove(exprep)
 
 
+def test_NovonixFile():
+    nf = prep.NovonixFile(exfile)
+    assert nf.isnovonix is True
+    assert nf.ntests == 2
+    assert len(nf.sections["Data"]) == 2
+    assert nf.icolumn(nv.col_step.upper()) == 2
+    assert nf.icolumn("Random name") == -1
+    with open(exfile, "rb") as ff:
+        ff.seek(nf.sections["Data"][-1])
+        assert ff.readline().strip() == b"[Data]"
+        ff.seek(nf.data_start)
+        assert ff.readline()[0:1] in b"0123456789"
+
+    nf = prep.NovonixFile(exfile_prep)
+    assert nf.ntests == 1
+    assert len(nf.sections["Reduced Protocol"]) == 1
+    assert prep.NovonixFile("novonix_add").isnovonix is False
+
+
+def test_novonix_file():
+    nf = prep.NovonixFile(exfile_prep)
+    assert prep.novonix_file(nf) is nf
+    assert prep.novonix_file(exfile_prep).col_names == nf.col_names
+    with pytest.raises(NotNovonixError) as err:
+        prep.novonix_file("novonix_add")
+    assert err.value.infile == "novonix_add"
+    assert err.value.reason == "Input file not found"
+
+
 def test_isnovonix():
     assert prep.isnovonix(exfile) is True
     assert prep.isnovonix("novonix_add") is False
+    assert prep.isnovonix(prep.NovonixFile(exfile)) is True
 
 
 def test_icolumn():
     assert prep.icolumn(exfile_prep, nv.col_step) > -1
     assert prep.icolumn(exfile_prep, nv.col_tstep) > -1
     assert prep.icolumn(exfile_prep, "Random name") == -1
+    nf = prep.NovonixFile(exfile_prep)
+    assert prep.icolumn(nf, nv.col_step) == prep.icolumn(exfile_prep, nv.col_step)
 
 
 def test_read_column():
@@ -37,6 +77,252 @@ def test_read_column():
     assert min(col) > -1
 
 
+def test_read_columns():
+    cols = prep.read_columns(exfile_prep, [nv.col_step, nv.col_t], ["int", "float"])
+    assert sorted(cols.keys()) == sorted([nv.col_step, nv.col_t])
+    assert cols[nv.col_step].dtype.kind == "i"
+    assert len(cols[nv.col_t]) == prep.get_num_measurements(exfile_prep)
+    col = prep.read_column(exfile_prep, nv.col_t)
+    assert (cols[nv.col_t] == col).all()
+    cols = prep.read_columns(exfile_prep, ["Date and Time"], "str")
+    assert cols["Date and Time"][0] == "1/3/2019 7:41:32 PM"
+
+
+def test_data_blocks():
+    nf = prep.NovonixFile(exfile_prep)
+    blocks = [block for offset, block in prep.data_blocks(nf, size=1000)]
+    assert all(block.endswith(b"\n") for block in blocks)
+    with open(exfile_prep, "rb") as ff:
+        ff.seek(nf.data_start)
+        assert b"".join(blocks) == ff.read()
+
+
+def test_parse_data_block():
+    ival, fval = prep.parse_data_block(b"a,1,0.5\nb,2,1.5\n", [1, 2], ["int", "float"])
+    assert list(ival) == [1, 2]
+    assert list(fval) == [0.5, 1.5]
+    # Windows ends of line and last row without one
+    fval, sval = prep.parse_data_block(b"a,1,0.5\r\nb,-2,1e-3", [2, 0], ["float", "str"])
+    assert list(fval) == [0.5, 0.001]
+    assert list(sval) == ["a", "b"]
+    # Rows with a different number of columns
+    block = b"a,1,0.5\nb,2,1.5,7\nc,3,2.5\n"
+    ival, fval = prep.parse_data_block(block, [1, 2], ["int", "float"])
+    assert list(ival) == [1, 2, 3]
+    assert list(fval) == [0.5, 1.5, 2.5]
+    # Integers not exact as floats, and values that are not integers
+    block = b"a,9007199254740993,0.5\n"
+    ival, fval = prep.parse_data_block(block, [1, 2], ["int64", "float"])
+    assert ival[0] == 9007199254740993
+    with pytest.raises(ValueError):
+        prep.parse_data_block(b"a,1.5,0.5\nb,2,1.5\n", [1, 2], ["int", "float"])
+    # Blank or short rows
+    for block in [b"a,1,0.5\n\nc,3,2.5\n", b"a,1,0.5\nb,2\nc,3,2.5\n"]:
+        with pytest.raises(ColumnError) as err:
+            prep.parse_data_block(block, [1, 2], ["int", "float"], infile="a.csv", row=5)
+        assert err.value.infile == "a.csv"
+        assert "data row 6" in err.value.reason
+
+
+def test_read_columns_rows():
+    # Compare with reading row by row
+    nf = prep.NovonixFile(exfile_prep)
+    names = [nv.col_step, nv.col_t, nv.col_v, nv.col_c, nv.state_col]
+    cols = prep.read_columns(nf, names)
+    with open(exfile_prep, "r") as ff:
+        ff.seek(nf.data_start)
+        rows = [line.split(",") for line in ff]
+    for name in names:
+        icol = nf.icolumn(name)
+        assert (cols[name] == [float(row[icol]) for row in rows]).all()
+
+
+def test_iter_data_chunks():
+    nf = prep.NovonixFile(exfile_prep)
+    names = [nv.col_step, nv.col_t]
+    cols = prep.read_columns(nf, names, ["int", "float"])
+    nrows = prep.get_num_measurements(nf)
+    for chunk_rows in [1, 1000, nrows, nrows + 1]:
+        chunks = list(prep.iter_data_chunks(nf, names, chunk_rows, ["int", "float"]))
+        assert len(chunks) == -(-nrows // chunk_rows)
+        assert [row for row, offset, vals, chunk in chunks] == list(
+            range(0, nrows, chunk_rows)
+        )
+        for row, offset, vals, chunk in chunks:
+            assert chunk.count(b"\n") == len(vals[nv.col_t])
+            assert (vals[nv.col_step] == cols[nv.col_step][row : row + chunk_rows]).all()
+        # Restart from the offset of a chunk
+        if len(chunks) > 1:
+            row, offset, vals, chunk = chunks[-1]
+            restart = list(
+                prep.iter_data_chunks(nf, names, chunk_rows, start=offset, first_row=row)
+            )
+            assert restart[0][0] == row
+            assert restart[0][3] == chunk
+            # Restart from the row, with the file index
+            restart = list(prep.iter_data_chunks(nf, names, chunk_rows, first_row=row))
+            assert restart[0][3] == chunk
+    prep.clear_cache(nf)
+
+
+def test_select_rows():
+    block = b"a,1\nb,2\nc,3"
+    assert prep.select_rows(block, [True, True, True]) == block
+    assert prep.select_rows(block, [False, True, True]) == b"b,2\nc,3"
+    assert prep.select_rows(block + b"\n", [True, False, False]) == b"a,1\n"
+    assert prep.split_rows(block, 1) == (b"a,1\nb,2\n", b"c,3")
+    assert prep.split_rows(block + b"\n", 0) == (block + b"\n", b"")
+    assert prep.split_rows(block, 4) == (b"", block)
+
+
+def test_format_column():
+    values = np.array([0, 7, -1, -999, 12345678901, -10])
+    assert prep.format_column(values).tolist() == [str(val).encode() for val in values]
+    values = np.array([0.1, 2.0, 1e-05, -3.25, 1e16])
+    assert prep.format_column(values).tolist() == [str(val).encode() for val in values]
+    assert len(prep.format_column(np.array([], dtype=int))) == 0
+
+
+def test_append_columns():
+    block = b"a,1 \r\nb,2\nc,3"
+    new_block = prep.append_columns(block, [[0, 1, 2], [-999, 4, 5]])
+    assert new_block == b"a,1,0,-999\nb,2,1,4\nc,3,2,5\n"
+    new_block = prep.append_columns(block, [[0, 1, 2]], keep=[True, False, True])
+    assert new_block == b"a,1,0\nc,3,2\n"
+    assert prep.append_columns(b"", [[]]) == b""
+    # Same as the text lines
+    nf = prep.NovonixFile(exfile_prep)
+    chunk = next(prep.iter_data_chunks(nf, [nv.col_step], None))[3]
+    lines = chunk.decode().splitlines(True)
+    new_lines = [line.rstrip() + ",{}\n".format(ii) for ii, line in enumerate(lines)]
+    new_block = prep.append_columns(chunk, [np.arange(len(lines))])
+    assert new_block.decode() == "".join(new_lines)
+
+
+def test_replace_column():
+    block = b"a,1,x\nb,2,y\nc,3\n"
+    new_block = prep.replace_column(block, 1, np.array([1.5, 2.5, 3.0]))
+    assert new_block == b"a,1.5,x\nb,2.5,y\nc,3.0\n"
+    new_block = prep.replace_column(block, 0, np.array([7, 8, 9]))
+    assert new_block == b"7,1,x\n8,2,y\n9,3\n"
+    assert prep.replace_column(b"", 1, np.array([])) == b""
+
+
+def test_write_columns():
+    ff = "dumfile"
+    header = ["[Data] \n", "a, b, c \n"]
+    blocks = [(b"x,1\n", [[2]], None), (b"y,3\nz,4\n", None, [False, True])]
+    prep.write_columns(ff, header, blocks)
+    with open(ff, "r") as tf:
+        assert tf.read() == "[Data] \na, b, c \nx,1,2\nz,4\n"
+    os.remove(ff)
+
+
+def test_last_line_before():
+    with open("dumfile", "wb") as ff:
+        ff.write(b"a,1\nb,2 \r\n\n  \nc,3\n")
+    with open("dumfile", "rb") as ff:
+        assert prep.last_line_before(ff, 14) == b"b,2"
+        assert prep.last_line_before(ff, 14, size=2) == b"b,2"
+        assert prep.last_line_before(ff, 4) == b"a,1"
+        assert prep.last_line_before(ff, 0) == b""
+    os.remove("dumfile")
+
+
+def test_read_columns_cache():
+    dumfile = "example_data/dum_cache.csv"
+    copy(exfile_prep, dumfile)
+    cdir = prep.cache_dir(dumfile)
+    names = [nv.col_step, nv.col_t]
+    cols = prep.read_columns(dumfile, names, ["int", "float"], cache=True)
+    assert os.path.isdir(cdir)
+    assert isinstance(cols[nv.col_t], np.memmap)
+    expected = prep.read_columns(exfile_prep, names, ["int", "float"])
+    for name in names:
+        assert (cols[name] == expected[name]).all()
+    # Cached and new columns together
+    col = prep.read_column(dumfile, nv.col_v, cache=True)
+    assert len(os.listdir(cdir)) == 4
+    # The cache is rebuilt when the file changes
+    with open(dumfile, "a") as ff:
+        ff.write(",".join(["1/3/2019 7:41:32 PM"] + ["1"] * 12) + "\n")
+    col = prep.read_column(dumfile, nv.col_t, cache=True)
+    assert len(col) == len(expected[nv.col_t]) + 1
+    assert len(os.listdir(cdir)) == 2
+    prep.clear_cache(dumfile)
+    assert not os.path.isdir(cdir)
+    os.remove(dumfile)
+
+
+def test_file_index():
+    dumfile = "example_data/dum_index.csv"
+    copy(exfile, dumfile)
+    assert prep.read_index(dumfile) is None
+    index = prep.build_index(dumfile, every=1000)
+    assert os.path.isfile(prep.index_file(dumfile))
+    assert index["sections"] == prep.NovonixFile(dumfile).sections
+    assert prep.read_index(dumfile) == index
+    assert prep.file_index(dumfile) == index
+    # Offsets of the data rows
+    with open(dumfile, "rb") as ff:
+        ff.seek(index["data_start"])
+        lines = ff.readlines()
+    assert index["nrows"] == len(lines)
+    for row in [0, 1, 999, 1000, 2345, len(lines) - 1]:
+        offset = prep.row_offset(dumfile, row)
+        assert offset == index["data_start"] + sum(len(x) for x in lines[:row])
+    assert prep.row_offset(dumfile, len(lines)) == os.path.getsize(dumfile)
+    # The index is rebuilt once the file changes
+    size = os.path.getsize(dumfile)
+    with open(dumfile, "a") as ff:
+        ff.write("[Summary]\n")
+    assert prep.read_index(dumfile) is None
+    assert prep.NovonixFile(dumfile).ntests == 3
+    assert prep.file_index(dumfile)["sections"]["Summary"][-1] == size
+    prep.clear_cache(dumfile)
+    os.remove(dumfile)
+
+
+def test_read_rows():
+    dumfile = "example_data/dum_rows.csv"
+    copy(exfile_prep, dumfile)
+    names = [nv.col_t, nv.loop_col, nv.col_step]
+    cols = prep.read_columns(dumfile, names)
+    times = cols[nv.col_t]
+    loops = cols[nv.loop_col]
+    for every in [1, 50, 10000]:
+        prep.build_index(dumfile, every=every)
+        queries = [
+            (None, None, None),
+            (times[1000], times[3000], None),
+            (times[2000], None, None),
+            (None, times[10], [0]),
+            (None, None, range(2, 4)),
+            (times[100], times[5000], [0, 3]),
+            (None, None, []),
+        ]
+        for t_min, t_max, lvals in queries:
+            rows = prep.read_rows(dumfile, names, t_min=t_min, t_max=t_max, loops=lvals)
+            keep = np.ones(len(times), dtype=bool)
+            if t_min is not None:
+                keep &= times >= t_min
+            if t_max is not None:
+                keep &= times <= t_max
+            if lvals is not None:
+                keep &= np.isin(loops, list(lvals))
+            for name in names:
+                assert (rows[name] == cols[name][keep]).all()
+    # Only the rows around the selection are read
+    prep.build_index(dumfile, every=50)
+    start, end = prep.data_range(dumfile, t_min=times[3000], t_max=times[3100])
+    assert prep.row_offset(dumfile, 2900) <= start <= prep.row_offset(dumfile, 3000)
+    assert prep.row_offset(dumfile, 3101) <= end <= prep.row_offset(dumfile, 3200)
+    assert prep.loop_limits(range(2, 5)) == (2, 4)
+    assert prep.loop_limits([3, 1]) == (1, 3)
+    prep.clear_cache(dumfile)
+    os.remove(dumfile)
+
+
 def test_replace_file():
     longf = "test_l.txt"
     lf = open(longf, "w")
@@ -46,11 +332,54 @@ def test_replace_file():
     sf = open(shortf, "w")
     sf.write("Short file")
     sf.close()
+    os.chmod(shortf, 0o640)
     prep.replace_file(longf, shortf, newbigger=True)
     assert os.path.isfile(longf) is False
+    assert os.stat(shortf).st_mode & 0o777 == 0o640
     os.remove(shortf)
 
 
+def test_temporary_file():
+    outfile = "example_data/dum_tmp.csv"
+    with prep.temporary_file(outfile) as tmp1, prep.temporary_file(outfile) as tmp2:
+        assert tmp1 != tmp2
+        assert os.path.dirname(tmp1) == os.path.dirname(os.path.abspath(outfile))
+        with open(tmp1, "w") as tf:
+            tf.write("Example")
+        prep.replace_file(tmp1, outfile)
+    assert not os.path.isfile(tmp2)
+    with open(outfile) as ff:
+        assert ff.read() == "Example"
+    os.remove(outfile)
+    # The temporary file is removed on failure
+    try:
+        with prep.temporary_file(outfile) as tmp_file:
+            raise ValueError
+    except ValueError:
+        pass
+    assert not os.path.isfile(tmp_file)
+
+
+def test_appended_file():
+    outfile = "example_data/dum_append.csv"
+    with open(outfile, "wb") as ff:
+        ff.write(b"1,2\n3,")
+    with prep.appended_file(outfile, 4):
+        prep.write_columns(outfile, None, [(b"3,4\n5,6\n", None, None)], offset=4)
+    with open(outfile, "rb") as ff:
+        assert ff.read() == b"1,2\n3,4\n5,6\n"
+    # The replaced bytes and the modification time are restored on failure
+    mtime = os.stat(outfile).st_mtime_ns
+    with pytest.raises(ValueError):
+        with prep.appended_file(outfile, 4):
+            prep.write_columns(outfile, None, [(b"7,8\n", None, None)], offset=4)
+            raise ValueError
+    with open(outfile, "rb") as ff:
+        assert ff.read() == b"1,2\n3,4\n5,6\n"
+    assert os.stat(outfile).st_mtime_ns == mtime
+    os.remove(outfile)
+
+
 def test_get_format():
     fmt_space, commands = prep.get_format("[0: Open_circuit_storage:]")
     assert fmt_space is False
@@ -72,3 +401,74 @@ def test_get_col_names():
 def test_get_num_measurements():
     nm = prep.get_num_measurements('example_data/example_data_prep.csv')
     assert nm == 5752
+    nf = prep.NovonixFile(exfile_prep)
+    assert prep.get_num_measurements(nf) == 5752
+
+
+def test_manifest():
+    manifest = "dummanifest.jsonl"
+    prep.append_manifest(manifest, {"source": "a", "sha1": "1"})
+    prep.append_manifest(manifest, {"source": "b", "sha1": "2"})
+    with open(manifest, "a") as ff:
+        ff.write('{"source": "a", "sha\n')
+    prep.append_manifest(manifest, {"source": "a", "sha1": "3"})
+    entries = prep.read_manifest(manifest)
+    assert entries["a"] == {"source": "a", "sha1": "3"}
+    assert entries["b"] == {"source": "b", "sha1": "2"}
+    os.remove(manifest)
+    assert prep.read_manifest(manifest) == {}
+    with open(exfile, "rb") as ff:
+        assert prep.file_hash(exfile, size=1000) == hashlib.sha1(ff.read()).hexdigest()
+
+
+def test_rows_end():
+    ff = "dumfile.csv"
+    with open(ff, "wb") as fo:
+        fo.write(b"a,b\n1,2\n3,")
+    assert prep.rows_end(ff, size=2) == 8
+    with open(ff, "wb") as fo:
+        fo.write(b"1,2")
+    assert prep.rows_end(ff) == 0
+    os.remove(ff)
+
+
+def test_write_columns_offset():
+    ff = "dumfile.csv"
+    prep.write_columns(ff, ["[Data] \n", "a, b \n"], [(b"x\ny\n", [[1, 2]], None)])
+    prep.write_columns(ff, None, [(b"z\n", [[3]], None)], offset=18)
+    with open(ff, "rb") as fo:
+        assert fo.read() == b"[Data] \na, b \nx,1\nz,3\n"
+    os.remove(ff)
+
+
+def test_checkpoint():
+    ff = "dumfile.csv"
+    copy(exfile_prep, ff)
+    segment = np.zeros(2, dtype=[("start", "i8"), ("t_end", "f8")])
+    checkpoint = {
+        "end": 10,
+        "scarry": {"data": b"1,2\n", "last_step": np.bytes_(b"7"), "steps": [1, 2]},
+        "schedule": (np.arange(3), "stop"),
+        "gcarry": {"open": segment, "last": np.int64(4), "none": None},
+    }
+    prep.save_checkpoint(ff, checkpoint)
+    back = prep.read_checkpoint(ff)
+    assert back["end"] == 10
+    assert back["scarry"]["data"] == b"1,2\n"
+    assert back["scarry"]["last_step"] == np.bytes_(b"7")
+    assert isinstance(back["schedule"], tuple)
+    assert back["schedule"][0].tolist() == [0, 1, 2]
+    assert back["gcarry"]["open"].dtype == segment.dtype
+    assert back["gcarry"]["last"].dtype == np.int64
+    assert back["gcarry"]["none"] is None
+    # A malformed checkpoint is no checkpoint
+    cdir = prep.cache_dir(prep.NovonixFile(ff))
+    with open(os.path.join(cdir, "checkpoint.npz"), "wb") as fo:
+        fo.write(b"not an archive")
+    assert prep.read_checkpoint(ff) is None
+    prep.save_checkpoint(ff, checkpoint)
+    with open(os.path.join(cdir, "checkpoint.json"), "w") as fo:
+        fo.write("[1, 2]")
+    assert prep.read_checkpoint(ff) is None
+    os.remove(ff)
+    prep.clear_cache(ff)
@@ -0,0 +1,119 @@
+import os
+import json
+import shutil
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+import preparenovonix.novonix_watch as watch
+
+exfile = "example_data/example_data.csv"
+exfile_prep = "example_data/example_data_prep.csv"
+
+
+def test_scan_folder():
+    scan = watch.scan_folder("example_data")
+    assert list(scan) == [exfile]
+    assert scan[exfile][0] == os.path.getsize(exfile)
+    # The '_prep' files are only left out if they would be written there
+    assert exfile_prep in watch.scan_folder("example_data", outdir="dum_out")
+
+
+def test_stable_files():
+    tracked = {}
+    assert watch.stable_files(tracked, {"a.csv": (10, 1)}, 0.0, 1.0) == []
+    # Unchanged, but not for long enough
+    assert watch.stable_files(tracked, {"a.csv": (10, 1)}, 0.5, 1.0) == []
+    assert watch.stable_files(tracked, {"a.csv": (10, 1)}, 1.0, 1.0) == ["a.csv"]
+    # Growing
+    assert watch.stable_files(tracked, {"a.csv": (20, 2)}, 2.0, 1.0) == []
+    assert watch.stable_files(tracked, {"a.csv": (20, 2)}, 3.0, 1.0) == ["a.csv"]
+    # Already handled
+    tracked["a.csv"]["done"] = (20, 2)
+    assert watch.stable_files(tracked, {"a.csv": (20, 2)}, 4.0, 1.0) == []
+    # Removed
+    assert watch.stable_files(tracked, {}, 5.0, 1.0) == []
+    assert tracked == {}
+
+
+def test_watch_counters():
+    counters = {"prepared": 3, "bytes": 600}
+    watch.watch_counters(counters, 10.0, 40.0)
+    assert counters["uptime"] == 30.0
+    assert counters["files_per_sec"] == 0.1
+    assert counters["bytes_per_sec"] == 20.0
+
+
+def test_future_record():
+    future = Future()
+    future.set_result({"file": "a.csv", "status": "prepared"})
+    assert watch.future_record("a.csv", future)["status"] == "prepared"
+    future = Future()
+    future.set_exception(BrokenProcessPool("worker killed"))
+    record = watch.future_record("a.csv", future)
+    assert record["status"] == "failed"
+    assert record["error_type"] == "BrokenProcessPool"
+
+
+def test_watch_folder(capsys):
+    inbox = "dum_inbox"
+    outbox = "dum_outbox"
+    status = os.path.join(outbox, "status.json")
+    os.makedirs(inbox, exist_ok=True)
+    with open(exfile, "rb") as fe:
+        data = fe.read()
+    with open(exfile_prep, "rb") as fe:
+        expected = fe.read()
+    files = [os.path.join(inbox, "dum{}.csv".format(ii)) for ii in range(2)]
+    with open(files[0], "wb") as fo:
+        fo.write(data)
+    # File still being written
+    with open(files[1], "wb") as fo:
+        fo.write(data[:450017])
+    with open(os.path.join(inbox, "bad.csv"), "w") as fb:
+        fb.write("a,b\n")
+    args = {"outdir": outbox, "interval": 0.01, "settle": 0.0, "status": status}
+
+    counters = watch.watch_folder(inbox, workers=2, max_cycles=3, **args)
+    assert counters["prepared"] == 2
+    assert counters["rejected"] == 1
+    assert counters["failed"] == 0
+    # Rejected files are only reported if verbose
+    assert "Novonix" not in capsys.readouterr().out
+    assert counters["queued"] == 0 and counters["running"] == 0
+    assert counters["bytes"] == len(data) + 450017
+    with open(status) as fs:
+        assert json.load(fs)["prepared"] == 2
+    assert [ff for ff in os.listdir(outbox) if ff.endswith(".tmp")] == []
+    with open(os.path.join(outbox, "dum0_prep.csv"), "rb") as fo:
+        assert fo.read() == expected
+
+    # Restarted after the second file grew: only that one is prepared,
+    # reading its new rows
+    with open(files[1], "ab") as fo:
+        fo.write(data[450017:])
+    counters = watch.watch_folder(inbox, workers=1, max_cycles=3, **args)
+    assert counters["prepared"] == 1
+    assert counters["skipped"] == 1
+    assert counters["bytes"] == len(data)
+    with open(os.path.join(outbox, "dum1_prep.csv"), "rb") as fo:
+        assert fo.read() == expected
+
+    # A bounded queue holds the rest of the stable files
+    counters = {}
+    shutil.rmtree(outbox)
+    watch.watch_folder(
+        inbox, workers=1, queue_size=1, max_cycles=2, counters=counters, **args
+    )
+    assert counters["prepared"] == 1
+    assert counters["queued"] == 1
+
+    # A rejected file is counted and reported once
+    bad = os.path.join(inbox, "bad.csv")
+    os.remove(files[0])
+    os.remove(files[1])
+    capsys.readouterr()
+    counters = watch.watch_folder(inbox, workers=1, max_cycles=4, verbose=True, **args)
+    assert counters["rejected"] == 1
+    assert capsys.readouterr().out.count("Not a Novonix data file: " + bad) == 1
+
+    shutil.rmtree(inbox)
+    shutil.rmtree(outbox)
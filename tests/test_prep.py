@@ -1,9 +1,26 @@
 import sys
 import os
+import threading
+import numpy as np
+import pytest
 from shutil import copy
 import preparenovonix.novonix_prep as prep
+from preparenovonix.novonix_clean import cleannovonix
+from preparenovonix.novonix_add import novonix_add_state
+from preparenovonix.novonix_add import novonix_add_loopnr
+from preparenovonix.novonix_add import state_carry
+from preparenovonix.novonix_clean import clean_header
+from preparenovonix.novonix_clean import clean_carry
+from preparenovonix.novonix_io import clear_cache
+from preparenovonix.novonix_io import read_segments
+from preparenovonix.novonix_io import read_manifest
+from preparenovonix.novonix_io import read_checkpoint
+from preparenovonix.novonix_io import file_hash
+from preparenovonix.novonix_errors import ColumnError
+from preparenovonix import __version__
 
 exfile = "example_data/example_data.csv"
+exfile_prep = "example_data/example_data_prep.csv"
 
 
 def test_prepare_novonix():
@@ -17,3 +34,254 @@ def test_prepare_novonix():
     assert os.stat(ff).st_size > os.stat(ffout).st_size
     os.remove(ff)
     os.remove(ffout)
+
+
+def test_prepare_novonix_chunks():
+    ff = "dumfile.csv"
+    ffout = "dumfile_prep.csv"
+    copy(exfile, ff)
+    prep.prepare_novonix(ff, addstate=True, lprotocol=True)
+    with open(ffout, "rb") as fo:
+        expected = fo.read()
+    for chunk_rows in [3, 1000]:
+        prep.prepare_novonix(ff, addstate=True, lprotocol=True, chunk_rows=chunk_rows)
+        with open(ffout, "rb") as fo:
+            assert fo.read() == expected
+    os.remove(ff)
+    clear_cache(ff)
+    os.remove(ffout)
+    clear_cache(ffout)
+
+
+def test_prepare_novonix_single_write():
+    ff = "dumfile.csv"
+    ffout = "dumfile_prep.csv"
+    copy(exfile, ff)
+    prep.prepare_novonix(ff, addstate=True, lprotocol=True)
+    with open(ffout, "rb") as fo, open(exfile_prep, "rb") as fe:
+        assert fo.read() == fe.read()
+    # Compare with the step by step preparation
+    prep.prepare_novonix(ff, addstate=True)
+    cleannovonix(ff)
+    novonix_add_state(ff)
+    with open(ffout, "rb") as fo, open(ff, "rb") as fs:
+        assert fo.read() == fs.read()
+    # Already prepared file
+    copy(exfile_prep, ff)
+    prep.prepare_novonix(ff, addstate=True, lprotocol=True, overwrite=True)
+    with open(ff, "rb") as fo, open(exfile_prep, "rb") as fe:
+        assert fo.read() == fe.read()
+    os.remove(ff)
+    clear_cache(ff)
+    os.remove(ffout)
+    clear_cache(ffout)
+
+
+def test_prepare_novonix_segments():
+    ff = "dumfile.csv"
+    ffout = "dumfile_prep.csv"
+    copy(exfile, ff)
+    # The table is only saved when asked for
+    prep.prepare_novonix(ff, addstate=True, lprotocol=True)
+    assert not os.path.isdir(ffout + ".cache")
+    prep.prepare_novonix(
+        ff, addstate=True, lprotocol=True, chunk_rows=100, segments=True
+    )
+    segments = read_segments(ffout)
+    assert len(segments) > 0
+    # Same as the step by step preparation
+    cleannovonix(ff)
+    novonix_add_state(ff, segments=True)
+    novonix_add_loopnr(ff, segments=True)
+    assert read_segments(ff).tolist() == segments.tolist()
+    os.remove(ff)
+    clear_cache(ff)
+    os.remove(ffout)
+    clear_cache(ffout)
+
+
+def test_prepared_chunks():
+    header, start = clean_header(exfile)
+    chunks = prep.prepared_chunks(
+        exfile, start, clean_carry(exfile), scarry=state_carry(exfile), chunk_rows=100
+    )
+    states = np.concatenate([st for lines, steps, st in chunks])
+    assert states[0] == 0
+    assert states[-1] == 2
+    assert (states > -99).all()
+
+
+def test_prepare_novonix_concurrent():
+    files = ["dumfile{}.csv".format(ii) for ii in range(4)]
+    for ff in files:
+        copy(exfile, ff)
+    threads = [
+        threading.Thread(
+            target=prep.prepare_novonix,
+            args=(ff,),
+            kwargs={"addstate": True, "lprotocol": True},
+        )
+        for ff in files
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with open(exfile_prep, "rb") as fe:
+        expected = fe.read()
+    for ff in files:
+        ffout = ff.replace(".csv", "_prep.csv")
+        with open(ffout, "rb") as fo:
+            assert fo.read() == expected
+        os.remove(ff)
+        clear_cache(ff)
+        os.remove(ffout)
+        clear_cache(ffout)
+    assert not [ff for ff in os.listdir(".") if ff.endswith(".tmp")]
+
+
+def test_prepare_many():
+    files = ["dumfile{}.csv".format(ii) for ii in range(3)]
+    for ff in files:
+        copy(exfile, ff)
+    # Not a Novonix file and a missing file
+    with open("dumfile_bad.csv", "w") as fb:
+        fb.write("a,b\n1,2\n")
+    files = files + ["dumfile_bad.csv", "dumfile_missing.csv"]
+    records = prep.prepare_many(files, jobs=2, addstate=True, lprotocol=True)
+    assert [rec["file"] for rec in records] == files
+    assert [rec["status"] for rec in records] == ["prepared"] * 3 + ["failed"] * 2
+    assert records[0]["nread"] == 5758
+    assert records[0]["nkept"] == 5752
+    assert "STOP" in records[3]["error"]
+    assert records[3]["error_type"] == "NotNovonixError"
+    assert records[4]["error"] != ""
+    with open(exfile_prep, "rb") as fe:
+        expected = fe.read()
+    for ff in files[:3]:
+        ffout = ff.replace(".csv", "_prep.csv")
+        with open(ffout, "rb") as fo:
+            assert fo.read() == expected
+        os.remove(ff)
+        clear_cache(ff)
+        os.remove(ffout)
+        clear_cache(ffout)
+    os.remove("dumfile_bad.csv")
+    clear_cache("dumfile_bad.csv")
+    # Serial run
+    records = prep.prepare_many(["dumfile_missing.csv"], jobs=1)
+    assert records[0]["status"] == "failed"
+
+
+def test_prepare_novonix_manifest():
+    ff = "dumfile.csv"
+    ffout = "dumfile_prep.csv"
+    manifest = "dummanifest.jsonl"
+    copy(exfile, ff)
+    assert prep.prepare_novonix(ff, addstate=True, lprotocol=True, manifest=manifest)
+    entry = read_manifest(manifest)[os.path.abspath(ff)]
+    assert entry["sha1"] == file_hash(ff)
+    assert entry["output"] == os.path.abspath(ffout)
+    assert entry["version"] == __version__
+    assert entry["nread"] == 5758
+    assert entry["nkept"] == 5752
+    mtime = os.stat(ffout).st_mtime_ns
+    # Unchanged file, also once copied again
+    report = {}
+    prep.prepare_novonix(
+        ff, addstate=True, lprotocol=True, manifest=manifest, report=report
+    )
+    assert report["status"] == "skipped"
+    copy(exfile, ff)
+    records = prep.prepare_many(
+        [ff], jobs=1, addstate=True, lprotocol=True, manifest=manifest
+    )
+    assert records[0]["status"] == "skipped"
+    assert records[0]["nkept"] == 5752
+    assert os.stat(ffout).st_mtime_ns == mtime
+    # Different options
+    records = prep.prepare_many([ff], jobs=1, addstate=True, manifest=manifest)
+    assert records[0]["status"] == "prepared"
+    # Changed prepared file
+    records = prep.prepare_many(
+        [ff], jobs=1, addstate=True, lprotocol=True, manifest=manifest
+    )
+    assert records[0]["status"] == "prepared"
+    with open(ffout, "rb") as fo, open(exfile_prep, "rb") as fe:
+        assert fo.read() == fe.read()
+    assert len(open(manifest).readlines()) == 3
+    os.remove(ff)
+    clear_cache(ff)
+    os.remove(ffout)
+    clear_cache(ffout)
+    os.remove(manifest)
+
+
+def test_prepare_novonix_append(capsys):
+    ff = "dumfile.csv"
+    ffout = "dumfile_prep.csv"
+    with open(exfile, "rb") as fe:
+        data = fe.read()
+    with open(exfile_prep, "rb") as fe:
+        expected = fe.read()
+    # Growing file, with a last row still being written
+    cuts = [300000, 450017, 600001, len(data)]
+    for cut in cuts:
+        with open(ff, "wb") as fo:
+            fo.write(data[:cut])
+        nread, nkept = prep.prepare_novonix(
+            ff,
+            addstate=True,
+            lprotocol=True,
+            append=True,
+            chunk_rows=100,
+            segments=True,
+        )
+    assert (nread, nkept) == (5758, 5752)
+    assert capsys.readouterr().out.count("reading only its new rows") == 3
+    with open(ffout, "rb") as fo:
+        assert fo.read() == expected
+    segments = read_segments(ffout)
+    # No new rows
+    mtime = os.stat(ffout).st_mtime_ns
+    assert prep.prepare_novonix(ff, addstate=True, lprotocol=True, append=True) == (
+        5758,
+        5752,
+    )
+    assert os.stat(ffout).st_mtime_ns == mtime
+    # Same as preparing the whole file
+    prep.prepare_novonix(ff, addstate=True, lprotocol=True, segments=True)
+    assert read_segments(ffout).tolist() == segments.tolist()
+    # Data rows changed before the checkpoint
+    with open(ff, "wb") as fo:
+        fo.write(data[:500000])
+    prep.prepare_novonix(ff, addstate=True, lprotocol=True, append=True)
+    with open(ff, "r+b") as fo:
+        fo.seek(499990)
+        fo.write(b"9")
+        fo.seek(0, 2)
+        fo.write(data[500000:])
+    prep.prepare_novonix(ff, addstate=True, lprotocol=True, append=True)
+    with open(ffout, "rb") as fo:
+        appended = fo.read()
+    prep.prepare_novonix(ff, addstate=True, lprotocol=True)
+    with open(ffout, "rb") as fo:
+        assert fo.read() == appended
+    # New rows that can not be prepared leave the prepared file as it was
+    with open(ff, "wb") as fo:
+        fo.write(data[:450017])
+    prep.prepare_novonix(ff, addstate=True, lprotocol=True, append=True)
+    with open(ffout, "rb") as fo:
+        before = fo.read()
+    checkpoint = read_checkpoint(ffout)
+    with open(ff, "ab") as fo:
+        fo.write(data[450017:500000].rsplit(b"\n", 1)[0] + b"\n1,2,abc\n")
+    with pytest.raises(ColumnError):
+        prep.prepare_novonix(ff, addstate=True, lprotocol=True, append=True)
+    with open(ffout, "rb") as fo:
+        assert fo.read() == before
+    assert read_checkpoint(ffout)["end"] == checkpoint["end"]
+    os.remove(ff)
+    clear_cache(ff)
+    os.remove(ffout)
+    clear_cache(ffout)